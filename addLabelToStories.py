@@ -13,8 +13,10 @@ def main():
 	stories = sys.argv[2:]
 
 	tracker = Tracker(settings.project_id, settings.token)
-	for story_id in stories:
-		story = tracker.GetStory(story_id)
+	for story_id, story, error in tracker.GetStoriesByIds(stories):
+		if error is not None:
+			print("{}: {}".format(story_id, error))
+			continue
 		story.AddLabel(label)
 		tracker.UpdateStory(story)
 		print("{}-{}", story.GetStoryId(), story.GetName())
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""Benchmarks for pytracker on synthetic stories; no Tracker access needed.
+
+usage: benchmark.py memory [count] [other_pytracker.py]
+       benchmark.py statistics [count]
+       benchmark.py csv [count]
+       benchmark.py csvimport [count] [processes]
+       benchmark.py xml [count]
+       benchmark.py snapshot [count]
+       benchmark.py archive [count]
+       benchmark.py query [count]
+
+memory: bytes per decoded Story. Pass another pytracker.py (for example
+`git show HEAD~1:pytracker.py > /tmp/old_pytracker.py`) to compare.
+statistics: PivotalStatistics over Story objects vs. a StoryTable.
+csv: Story.ToCsv vs. StoryCsvWriter.
+csvimport: IterCsvFile vs. IterCsvFileParallel on a Tracker style export.
+xml: Story.ToXml built with xml.dom.minidom vs. Story.ToXml vs. StoryXmlWriter.
+snapshot: loading stories from JSON (as import_from_json.py does), JSON Lines
+and StoryList snapshots.
+archive: random access by story id to a StoryArchive.
+query: Tracker filters answered by a StoryIndex vs. by scanning the stories.
+"""
+import csv
+import gc
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.dom import minidom
+
+import pytracker
+
+OWNERS = ['Gorbachev', 'Stalin', 'Lenin', 'Khrushchev', 'Brezhnev']
+STATES = ['unstarted', 'started', 'finished', 'delivered', 'accepted']
+TYPES = ['feature', 'bug', 'chore']
+LABELS = ['backend', 'frontend', 'ui', 'api', 'week106', 'week107', 'customer']
+
+STORY_XML = """<story>
+    <id type="integer">%(id)d</id>
+    <story_type>%(type)s</story_type>
+    <url>http://www.pivotaltracker.com/story/show/%(id)d</url>
+    <estimate type="integer">%(estimate)d</estimate>
+    <current_state>%(state)s</current_state>
+    <description>Story %(id)d needs doing because the customer asked for it twice.</description>
+    <name>Do the thing number %(id)d</name>
+    <requested_by>%(requester)s</requested_by>
+    <owned_by>%(owner)s</owned_by>
+    <created_at type="datetime">2009/04/17 00:47:50 UTC</created_at>
+    <updated_at type="datetime">2009/04/22 20:46:56 UTC</updated_at>
+    <labels>%(labels)s</labels>%(tasks)s
+</story>"""
+
+TASK_XML = """<task><id type="integer">%d</id><description>check item %d</description>
+    <position>%d</position><complete type="boolean">false</complete></task>"""
+
+
+def StoryXmls(count):
+    """Returns the XML of count varied stories."""
+    stories = []
+    for i in range(1, count + 1):
+        tasks = ''
+        if i % 3 == 0:
+            tasks = '<tasks type="array">%s</tasks>' % ''.join(
+                    TASK_XML % (i * 10 + n, n, n) for n in range(1, 3))
+        stories.append(STORY_XML % dict(
+                id=i, type=TYPES[i % len(TYPES)], estimate=i % 4, state=STATES[i % len(STATES)],
+                requester=OWNERS[i % 3], owner=OWNERS[i % len(OWNERS)],
+                labels=','.join(LABELS[(i + n) % len(LABELS)] for n in range(i % 3 + 1)),
+                tasks=tasks))
+    return stories
+
+
+def LoadModule(path):
+    spec = importlib.util.spec_from_file_location('other_pytracker', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def Decode(module, story_xmls):
+    if hasattr(module, 'StoryXmlDecoder'):
+        return module.StoryXmlDecoder.Decode(
+                ('<?xml version="1.0" encoding="UTF-8"?><stories type="array">%s</stories>' %
+                 ''.join(story_xmls)).encode('utf-8'))
+    # versions before StoryXmlDecoder
+    return [module.Story.FromXml(story_xml) for story_xml in story_xmls]
+
+
+def MeasureMemory(module, story_xmls):
+    """Returns the bytes per story held by the decoded stories."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    stories = Decode(module, story_xmls)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert len(stories) == len(story_xmls)
+    return held / float(len(stories))
+
+
+def Memory(count, other=None):
+    story_xmls = StoryXmls(count)
+    modules = [('pytracker', pytracker)]
+    if other:
+        modules.append((other, LoadModule(other)))
+    for name, module in modules:
+        print("{}: {:.0f} bytes/story ({} stories)".format(
+                name, MeasureMemory(module, story_xmls), count))
+
+
+def Timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def DecodedStories(count):
+    return pytracker.StoryXmlDecoder.Decode(
+            ('<?xml version="1.0" encoding="UTF-8"?><stories type="array">%s</stories>' %
+             ''.join(StoryXmls(count))).encode('utf-8'))
+
+
+def Statistics(count):
+    stories = DecodedStories(count)
+
+    def Serial():
+        stats = pytracker.PivotalStatistics()
+        for story in stories:
+            stats.CalculateStatistics(story)
+        return stats
+
+    expected, serial = Timed(Serial)
+    table, build = Timed(pytracker.StoryTable.FromStories, stories)
+    stats, columnar = Timed(table.CalculateStatistics)
+    assert stats.RenderStatistics() == expected.RenderStatistics()
+    print("{} stories; PivotalStatistics: {:.3f}s; StoryTable ({}): {:.3f}s, built in {:.3f}s".format(
+            count, serial, "numpy" if pytracker.numpy else "no numpy", columnar, build))
+
+
+def Csv(count):
+    stories = DecodedStories(count)
+
+    def WithToCsv():
+        output = io.StringIO()
+        output.write(pytracker.Story.CsvHeader())
+        output.write("\n")
+        for story in stories:
+            output.write(story.ToCsv())
+            output.write("\n")
+        return output.tell()
+
+    def WithWriter():
+        output = io.StringIO()
+        pytracker.StoryCsvWriter(output).WriteStories(iter(stories))
+        return output.tell()
+
+    size, to_csv = Timed(WithToCsv)
+    print("Story.ToCsv: {:.0f} stories/s ({} chars)".format(count / to_csv, size))
+    size, writer = Timed(WithWriter)
+    print("StoryCsvWriter: {:.0f} stories/s ({} chars)".format(count / writer, size))
+
+
+def CsvImport(count, processes=None):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'stories.csv')
+        with open(path, 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(pytracker.StoryCsvReader.TRACKER_HEADER + ['Comment'] * 20 + ['Task', 'Task Status'] * 4)
+            for i in range(1, count + 1):
+                writer.writerow([i, 'Do the thing number %d' % i, ', '.join(LABELS[i % 3:i % 3 + 2]), i % 50,
+                                 '', '', TYPES[i % len(TYPES)], i % 4, STATES[i % len(STATES)],
+                                 'Apr %d, 2009' % (i % 28 + 1), 'May %d, 2009' % (i % 28 + 1), '',
+                                 OWNERS[i % 3], 'Story %d needs doing,\nbecause "the customer" asked.' % i,
+                                 'http://www.pivotaltracker.com/story/show/%d' % i, '', '',
+                                 OWNERS[i % len(OWNERS)], ''] + ['a comment'] * 20 + ['task', 'done'] * 4)
+        serial, serial_time = Timed(lambda: [story.ToDictionary() for story in pytracker.IterCsvFile(path)])
+        parallel, parallel_time = Timed(lambda: [story.ToDictionary() for story in
+                                                 pytracker.IterCsvFileParallel(path, processes)])
+        assert serial == parallel
+        print("{} stories ({} bytes); IterCsvFile: {:.3f}s; IterCsvFileParallel: {:.3f}s".format(
+                count, os.path.getsize(path), serial_time, parallel_time))
+    finally:
+        shutil.rmtree(directory)
+
+
+def MinidomToXml(story):
+    """Story.ToXml(include_tasks=True) as it was built with xml.dom.minidom."""
+    doc = minidom.getDOMImplementation().createDocument(None, 'story', None)
+    element = doc.documentElement
+    for field_name in pytracker.Story.UPDATE_FIELDS:
+        if field_name in story.updated_fields and getattr(story, field_name) is not None:
+            child = doc.createElement(field_name)
+            child.appendChild(doc.createTextNode(str(getattr(story, field_name))))
+            element.appendChild(child)
+    if story.labels is not None:
+        child = doc.createElement('labels')
+        child.appendChild(doc.createTextNode(story.GetLabelsAsString()))
+        element.appendChild(child)
+    if story.GetTasks():
+        tasks = doc.createElement('tasks')
+        tasks.setAttribute('type', 'array')
+        for task in story.GetTasks():
+            task_element = doc.createElement('task')
+            description = doc.createElement('description')
+            description.appendChild(doc.createTextNode(task.GetDictionary()['description']))
+            task_element.appendChild(description)
+            complete = doc.createElement('complete')
+            complete.setAttribute('type', 'boolean')
+            complete.appendChild(doc.createTextNode('true' if task.GetDictionary()['complete'] else 'false'))
+            task_element.appendChild(complete)
+            tasks.appendChild(task_element)
+        element.appendChild(tasks)
+    return doc.toxml('utf-8')
+
+
+def Xml(count):
+    stories = DecodedStories(count)
+    for story in stories:
+        story.SetName(story.GetName()) # so that there are fields to write
+        story.SetEstimate(story.GetEstimate())
+        story.SetCurrentState(story.GetCurrentState())
+        story.SetOwnedBy(story.GetOwnedBy())
+
+    with_minidom, minidom_time = Timed(lambda: [MinidomToXml(story) for story in stories])
+    with_to_xml, to_xml_time = Timed(lambda: [story.ToXml(include_tasks=True) for story in stories])
+    with_writer, writer_time = Timed(
+            lambda: list(pytracker.StoryXmlWriter(include_tasks=True).ToXmls(stories)))
+    # minidom's escaping differs between Python versions, so it only sets the pace.
+    assert with_to_xml == with_writer
+    for name, elapsed in (('minidom', minidom_time), ('Story.ToXml', to_xml_time),
+                          ('StoryXmlWriter', writer_time)):
+        print("{}: {:.0f} stories/s".format(name, count / elapsed))
+
+
+def Snapshot(count):
+    stories = DecodedStories(count)
+    expected = [story.ToDictionary() for story in stories]
+    directory = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(directory, 'stories.json')
+        with open(json_path, 'w') as output:
+            output.write('[' + ','.join(story.ToJson() for story in stories) + ']')
+        jsonl_path = os.path.join(directory, 'stories.jsonl')
+        with pytracker.OpenJsonLinesFile(jsonl_path, 'w') as output:
+            pytracker.StoryJsonLinesWriter(output).WriteStories(stories)
+        snapshot_path = os.path.join(directory, 'stories.snapshot')
+        ignored, save_time = Timed(pytracker.StoryList(stories).SaveSnapshot, snapshot_path)
+        del stories
+        gc.collect()
+
+        def FromJson():
+            with open(json_path) as content_file:
+                return [pytracker.Story.FromJson(item) for item in json.loads(content_file.read())]
+
+        for name, load, path in (
+                ('JSON', FromJson, json_path),
+                ('JSON Lines', lambda: list(pytracker.IterJsonLinesFile(jsonl_path)), jsonl_path),
+                ('snapshot', lambda: pytracker.StoryList.LoadSnapshot(snapshot_path).stories,
+                 snapshot_path)):
+            loaded, elapsed = Timed(load)
+            assert [story.ToDictionary() for story in loaded] == expected
+            del loaded
+            gc.collect()
+            print("{}: loaded {} stories in {:.3f}s ({} bytes)".format(
+                    name, count, elapsed, os.path.getsize(path)))
+        print("snapshot saved in {:.3f}s".format(save_time))
+    finally:
+        shutil.rmtree(directory)
+
+
+def Archive(count):
+    stories = DecodedStories(count)
+    directory = tempfile.mkdtemp()
+    try:
+        archive = pytracker.StoryArchive(os.path.join(directory, 'stories.archive'),
+                                         reindex_after=count + 1)
+        ignored, put_time = Timed(archive.PutStories, 1, stories)
+        ignored, reindex_time = Timed(archive.Reindex)
+        print("{} stories archived in {:.3f}s, indexed in {:.3f}s".format(
+                count, put_time, reindex_time))
+        reader = pytracker.StoryArchive(os.path.join(directory, 'stories.archive'))
+        story_ids = [story.GetStoryId() for story in stories]
+        random.shuffle(story_ids)
+        story_ids = story_ids[:10000]
+        found, get_time = Timed(lambda: [reader.Get(1, story_id) for story_id in story_ids])
+        assert [story.GetStoryId() for story in found] == story_ids
+        print("Get: {:.1f}us per story".format(get_time / len(story_ids) * 1e6))
+        archive.Close()
+        reader.Close()
+    finally:
+        shutil.rmtree(directory)
+
+
+QUERIES = ['label:week106 includedone:true', 'owner:lenin state:started,finished',
+           'type:bug label:ui,api includedone:true', 'id:1,50,99999 includedone:true']
+
+
+def Query(count):
+    stories = DecodedStories(count)
+    index, build_time = Timed(pytracker.StoryIndex, stories)
+    print("{} stories indexed in {:.3f}s".format(count, build_time))
+    for filt in QUERIES:
+        parsed = pytracker.TrackerFilter.Parse(filt)
+        expected, scan_time = Timed(lambda: [story for story in stories if parsed.Matches(story)])
+        found, query_time = Timed(index.Query, filt)
+        assert found == expected
+        print("{}: {} stories; scan: {:.2f}ms; StoryIndex: {:.2f}ms".format(
+                filt, len(found), scan_time * 1000, query_time * 1000))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('memory', 'statistics', 'csv', 'csvimport', 'xml',
+                                                      'snapshot', 'archive', 'query'):
+        print(__doc__)
+        sys.exit(1)
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    if sys.argv[1] == 'memory':
+        Memory(count, sys.argv[3] if len(sys.argv) > 3 else None)
+    elif sys.argv[1] == 'statistics':
+        Statistics(count)
+    elif sys.argv[1] == 'csv':
+        Csv(count)
+    elif sys.argv[1] == 'csvimport':
+        CsvImport(count, int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    elif sys.argv[1] == 'xml':
+        Xml(count)
+    elif sys.argv[1] == 'snapshot':
+        Snapshot(count)
+    elif sys.argv[1] == 'archive':
+        Archive(count)
+    else:
+        Query(count)
@@ -1,22 +1,34 @@
 #!/usr/bin/env python3
 import settings
-from pytracker import Tracker, PivotalStatistics
+from pytracker import Tracker, PivotalStatistics, SqliteStoryCache, StoryArchive, StoryIndex, StoryList
 import sys
 
 if len(sys.argv) < 2:
-	print("usage: {} [label_for_stocores_to_be_calculated]\nexample: {} week106".format(sys.argv[0],sys.argv[0]))
+	print("usage: {} [label_for_stocores_to_be_calculated] [store.sqlite|store.archive|stories.snapshot]\nexample: {} week106 stories.archive".format(sys.argv[0],sys.argv[0]))
 	sys.exit(1)
 
 tracker = Tracker(settings.project_id, settings.token)
-print("Grabbing data from label [{}]...".format(sys.argv[1]))
-the_stories = tracker.GetStories("label:{} includedone:true".format(sys.argv[1]))
-
-print("Got {} stories".format(len(the_stories)))
+the_filter = "label:{} includedone:true".format(sys.argv[1])
+if len(sys.argv) > 2:
+	local_copy = sys.argv[2]
+	print("Looking up label [{}] in {}...".format(sys.argv[1], local_copy))
+	if local_copy.endswith('.snapshot'):
+		index = StoryIndex.FromStoryList(StoryList.LoadSnapshot(local_copy))
+	elif local_copy.endswith('.archive'):
+		index = StoryIndex.FromStore(StoryArchive(local_copy), settings.project_id)
+	else:
+		index = StoryIndex.FromStore(SqliteStoryCache(local_copy, max_stories=None), settings.project_id)
+	the_stories = index.Query(the_filter, fallback=tracker)
+else:
+	print("Grabbing data from label [{}]...".format(sys.argv[1]))
+	the_stories = tracker.IterStories(the_filter)
 
 stats = PivotalStatistics()
+num_stories = 0
 for story in the_stories:
+	num_stories += 1
 	stats.CalculateStatistics(story)
 
-print(stats.RenderStatistics())
-
+print("Got {} stories".format(num_stories))
 
+print(stats.RenderStatistics())
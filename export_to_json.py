@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 from __future__ import unicode_literals
 import settings
-from pytracker import Tracker, Story
+from pytracker import Tracker, Story, OpenJsonLinesFile, StoryJsonLinesWriter, JSON_LINES_EXTENSIONS
 import sys
 import codecs
 
 if len(sys.argv) < 3:
-    print("usage: {} [label] [outputfile.json]\nexample: {} ui outputfile.json".format(sys.argv[0],sys.argv[0]))
+    print("usage: {} [label] [outputfile.json]\nexample: {} ui outputfile.json\n"
+          "A .jsonl or .ndjson file (optionally .gz) gets one story per line.".format(sys.argv[0],sys.argv[0]))
     sys.exit(1)
 
 label = sys.argv[1]
@@ -15,20 +16,24 @@ file_name = sys.argv[2]
 tracker = Tracker(settings.project_id, settings.token)
 num_stories = 0
 
-with codecs.open(file_name, "w", "utf-8") as output:
-    print("Fetching stories...")
-    the_stories = tracker.GetStories("includedone:true".format(label))
-    output.write("[\n")
-    first_time = True
-    for a_story in the_stories:
-        if first_time:
-            first_time = False
-        else:
-            output.write(",")
-        num_stories+=1
-        #print(a_story.GetStoryId())
-        output.write(a_story.ToJson())
-        output.write("\n")
-    output.write("]")
+print("Fetching stories...")
+the_stories = tracker.IterStories("includedone:true".format(label))
+if file_name.endswith(JSON_LINES_EXTENSIONS):
+    with OpenJsonLinesFile(file_name, "w") as output:
+        num_stories = StoryJsonLinesWriter(output).WriteStories(the_stories)
+else:
+    with codecs.open(file_name, "w", "utf-8") as output:
+        output.write("[\n")
+        first_time = True
+        for a_story in the_stories:
+            if first_time:
+                first_time = False
+            else:
+                output.write(",")
+            num_stories+=1
+            #print(a_story.GetStoryId())
+            output.write(a_story.ToJson())
+            output.write("\n")
+        output.write("]")
 
 print("Saved {} stories to {}".format(num_stories, file_name))
@@ -1,23 +1,31 @@
 #!/usr/bin/env python3
 import settings
-from pytracker import Story
+from pytracker import Story, IterJsonLinesFile, JSON_LINES_EXTENSIONS
 import json
 import sys
 
 if len(sys.argv) < 2:
-    print("usage: {} [inputfile.json]\nexample: {} inputfile.json".format(sys.argv[0],sys.argv[0]))
+    print("usage: {} [inputfile.json]\nexample: {} inputfile.json\n"
+          "A .jsonl or .ndjson file (optionally .gz) is read one story at a time.".format(sys.argv[0],sys.argv[0]))
     sys.exit(1)
 
 filename = sys.argv[1]
-with open(filename, 'r') as content_file:
-    content = content_file.read()
+num_stories = 0
+if filename.endswith(JSON_LINES_EXTENSIONS):
+    for story in IterJsonLinesFile(filename):
+        num_stories += 1
+        print(story.GetOwnedBy())
+else:
+    with open(filename, 'r') as content_file:
+        content = content_file.read()
 
-json_content = json.loads(content)
-stories = []
-for json_story in json_content:
-    story = Story.FromJson(json_story)
-    stories.append(story)
-    print(story.GetOwnedBy())
+    json_content = json.loads(content)
+    stories = []
+    for json_story in json_content:
+        story = Story.FromJson(json_story)
+        stories.append(story)
+        print(story.GetOwnedBy())
+    num_stories = len(stories)
 
 
-print("Loaded {} stories from {}".format(len(stories), filename))
+print("Loaded {} stories from {}".format(num_stories, filename))
@@ -25,23 +25,57 @@ if sys.version_info[0] == 2: #python2
     import urllib as parse
     import urllib2 as request
     import urllib2 as error
+    import httplib as client
+    from urlparse import urlsplit
+    try:
+        from concurrent import futures # the "futures" backport
+    except ImportError:
+        futures = None
 else: #python3
     from http import cookiejar
+    from http import client
     from urllib import request
     from urllib import error
     from urllib import parse
+    from urllib.parse import urlsplit
+    from concurrent import futures
 
+import array
 import calendar
+import collections
+import copy
+import email.utils
+import gc
+import gzip
+import io
+import mmap
+import operator
+import os
+import random
 import re
+import socket
+import sqlite3
+import struct
+import threading
 import time
+import zlib
 
-import xml.dom
 from xml.dom import minidom
 import xml.parsers.expat
 import xml.sax.saxutils
 import json
 import csv
 
+try:
+    import numpy
+except ImportError: # StoryTable falls back to pure Python
+    numpy = None
+
+try:
+    import fcntl
+except ImportError: # StoryArchive can't lock between processes (Windows)
+    fcntl = None
+
 DEFAULT_BASE_API_URL = 'https://www.pivotaltracker.com/services/v3/'
 # Some fields specify UTC, some GMT?
 _TRACKER_DATETIME_RE = re.compile(r'^\d{4}/\d{2}/\d{2} .*(GMT|UTC)$')
@@ -54,18 +88,609 @@ def _is_string(the_object):
     else:
         return isinstance(the_object, str)
 
+def _intern(value):
+    """Interns a string that repeats across stories (owners, states, labels).
+
+    Thousands of stories then share one copy of each such string.
+    """
+    if value is None or sys.version_info[0] == 2: # unicode can't be interned
+        return value
+    return sys.intern(value)
+
+# array typecode of 64 bit integers
+_INT64 = 'q' if sys.version_info[0] >= 3 else 'l'
+
+def _ArrayToBytes(values):
+    if sys.version_info[0] == 2: #python2
+        return values.tostring()
+    return values.tobytes()
+
+def _ArrayFromBytes(values, data):
+    """Appends the items packed in data to an array."""
+    if sys.version_info[0] == 2: #python2
+        values.fromstring(data)
+    else:
+        values.frombytes(data)
+
+def _ReplaceFile(source, destination):
+    """Atomically renames source over destination."""
+    if sys.version_info[0] == 2: #python2, where rename replaces on POSIX only
+        os.rename(source, destination)
+    else:
+        os.replace(source, destination)
+
 def TrackerDatetimeToYMD(pdt):
     assert _TRACKER_DATETIME_RE.match(pdt)
-    pdt = pdt.split()[0]
-    pdt = pdt.replace('/', '-')
-    return pdt
+    return TrackerDatetime.ToYMD(pdt)
+
+
+# Story.ToXml and Task.ToXml write UTF-8 with this declaration, no whitespace
+# between elements, and a story without fields as <story/>.
+_XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>'
+
+
+def _XmlEscape(text):
+    """Escapes element text: &, <, \" and > become &amp;, &lt;, &quot; and &gt;."""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(
+            "\"", "&quot;").replace(">", "&gt;")
+
+
+class TrackerDatetime(object):
+    """Parses and formats the datetimes of the Tracker API and CSV exports.
+
+    The API writes '2009/04/17 00:47:50 UTC' (or GMT) and CSV exports
+    'Apr 17, 2009'. Both have fixed layouts, so fields are sliced out
+    instead of going through time.strptime, and the seconds at the start of
+    each date are memoized: the stories of a project share few dates.
+    Strings that don't have the layout fall back to time.strptime.
+    """
+    FORMAT = '%Y/%m/%d %H:%M:%S UTC'
+    CSV_FORMAT = '%b %d, %Y'
+    MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+              'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+    # 'YYYY/MM/DD' or 'Mon D, YYYY' -> secs at midnight UTC; day -> 'YYYY/MM/DD'
+    _dates = {}
+    _csv_dates = {}
+    _days = {}
+
+    @staticmethod
+    def Parse(data):
+        """Parses a Tracker datetime string into seconds-since-epoch."""
+        if (len(data) == 23 and data[4] == '/' and data[7] == '/' and data[10] == ' '
+                and data[13] == ':' and data[16] == ':'
+                and data[11:13].isdigit() and data[14:16].isdigit() and data[17:19].isdigit()):
+            hours, minutes, seconds = int(data[11:13]), int(data[14:16]), int(data[17:19])
+            if hours < 24 and minutes < 60 and seconds < 62:
+                midnight = TrackerDatetime._dates.get(data[:10])
+                if midnight is None:
+                    midnight = TrackerDatetime._ParseDate(data[:10], '%Y/%m/%d')
+                    TrackerDatetime._dates[data[:10]] = midnight
+                return midnight + hours * 3600 + minutes * 60 + seconds
+        # Tracker emits datetime strings in UTC or GMT.
+        # The [:-4] strips the timezone indicator
+        return calendar.timegm(time.strptime(data[:-4].strip(), '%Y/%m/%d %H:%M:%S'))
+
+    @staticmethod
+    def ParseCsvDate(data):
+        """Parses a date of a Tracker CSV export into seconds-since-epoch."""
+        midnight = TrackerDatetime._csv_dates.get(data)
+        if midnight is None:
+            midnight = TrackerDatetime._ParseCsvDate(data)
+            TrackerDatetime._csv_dates[data] = midnight
+        return midnight
+
+    @staticmethod
+    def _ParseDate(data, date_format):
+        # calendar.timegm treats the tuple as GMT
+        return calendar.timegm(time.strptime(data, date_format))
+
+    @staticmethod
+    def _ParseCsvDate(data):
+        # %b depends on the locale; exports are in English.
+        month, _, rest = data.partition(' ')
+        day, _, year = rest.partition(', ')
+        if month in TrackerDatetime.MONTHS and day.isdigit() and year.isdigit():
+            return TrackerDatetime._ParseDate(
+                    '%s/%02d/%s' % (year, TrackerDatetime.MONTHS.index(month) + 1, int(day)),
+                    '%Y/%m/%d')
+        return TrackerDatetime._ParseDate(data, TrackerDatetime.CSV_FORMAT)
+
+    @staticmethod
+    def ParseColumn(values, csv_dates=False):
+        """Parses many datetime strings at once, each distinct one only once.
+
+        Args:
+            values: an iterable of datetime strings; None or '' for no value.
+            csv_dates: whether these are dates of a CSV export.
+        Returns:
+            an array('d') of seconds-since-epoch, with NaN for no value, as
+            in StoryTable columns.
+        """
+        parse = TrackerDatetime.ParseCsvDate if csv_dates else TrackerDatetime.Parse
+        parsed = {None: float('nan'), '': float('nan')}
+        column = array.array('d')
+        for value in values:
+            secs = parsed.get(value)
+            if secs is None:
+                secs = parsed[value] = float(parse(value))
+            column.append(secs)
+        return column
+
+    @staticmethod
+    def Format(secs):
+        """Formats seconds-since-epoch as a Tracker datetime string."""
+        day, secs = divmod(int(secs), 86400)
+        date = TrackerDatetime._days.get(day)
+        if date is None:
+            date = TrackerDatetime._days[day] = time.strftime('%Y/%m/%d', time.gmtime(day * 86400))
+        minutes, secs = divmod(secs, 60)
+        return '%s %02d:%02d:%02d UTC' % (date, minutes // 60, minutes % 60, secs)
+
+    @staticmethod
+    def ToYMD(data):
+        """Returns the 'YYYY-MM-DD' date of a Tracker datetime string."""
+        return data.split()[0].replace('/', '-')
+
+
+def _map_concurrently(function, items, max_workers):
+    """Calls function on every item, at most max_workers at a time.
+
+    Returns a list of (result, exception) pairs in the order of items; an
+    exception raised for one item does not stop the others.
+    """
+    def Call(item):
+        try:
+            return function(item), None
+        except Exception as e:
+            return None, e
+
+    items = list(items)
+    if futures is None or max_workers <= 1 or len(items) <= 1:
+        return [Call(item) for item in items]
+    with futures.ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(Call, items))
+
+
+# Size of the reads _Api makes from a response.
+_READ_CHUNK_SIZE = 64 * 1024
+
+# Sizes of one response body, as sent and after Content-Encoding was undone.
+TransferStats = collections.namedtuple(
+        'TransferStats', 'method url status content_encoding wire_bytes decoded_bytes')
+
+
+class _BodyReadError(Exception):
+    """Wraps the error raised while reading a response body, so it can be retried."""
+
+    def __init__(self, error):
+        Exception.__init__(self, error)
+        self.error = error
+
+
+class ContentDecoder(object):
+    """Incrementally undoes a gzip or deflate Content-Encoding.
+
+    Counts the bytes fed in (wire_bytes) and handed out (decoded_bytes).
+    """
+
+    def __init__(self, encoding=None):
+        encoding = (encoding or 'identity').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._zlib = zlib.decompressobj()
+        elif encoding == 'identity':
+            self._zlib = None
+        else:
+            raise TrackerApiException('Unsupported Content-Encoding: %s' % encoding)
+        self.encoding = encoding
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def Decompress(self, data):
+        """Returns the decoded bytes available after this chunk."""
+        first = self.wire_bytes == 0
+        self.wire_bytes += len(data)
+        if self._zlib is None:
+            decoded = data
+        elif first and self.encoding == 'deflate':
+            # Some servers send raw deflate data without the zlib header.
+            try:
+                decoded = self._zlib.decompress(data)
+            except zlib.error:
+                self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+                decoded = self._zlib.decompress(data)
+        else:
+            decoded = self._zlib.decompress(data)
+        self.decoded_bytes += len(decoded)
+        return decoded
+
+    def Flush(self):
+        """Returns whatever decoded bytes are left at the end of the body."""
+        if self._zlib is None:
+            return b''
+        decoded = self._zlib.flush()
+        self.decoded_bytes += len(decoded)
+        return decoded
+
+
+def _AsChunks(response):
+    """Returns a response body given as bytes or as chunks as chunks."""
+    if isinstance(response, bytes):
+        return [response]
+    return response
+
+
+# Errors that mean a kept-alive socket was closed by the server while idle.
+_STALE_CONNECTION_ERRORS = (client.BadStatusLine, socket.error)
+
+
+class PooledResponse(object):
+    """A response read from a pooled connection.
+
+    The connection goes back to the pool once the body has been fully read
+    (or the response is closed), so callers must either read() everything or
+    call close().
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        if self.conn is None:
+            return b''
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        if amt is None or not data:
+            self._Release()
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed():
+            self._Release()
+        else:
+            # The body was not consumed, so the socket can't be reused.
+            self.conn.close()
+            self.conn = None
+
+    def _Release(self):
+        conn, self.conn = self.conn, None
+        if self.response.will_close:
+            conn.close()
+        else:
+            self.pool._Release(self.key, conn)
+
+
+class HttpConnectionPool(object):
+    """Persistent HTTP/1.1 transport for Tracker.
+
+    Connections are kept alive and reused per (scheme, host, port), which
+    saves a TCP and TLS handshake on every API call. At most `maxsize` idle
+    connections are kept per host, connections idle for longer than
+    `idle_timeout` seconds are closed instead of reused, and an idempotent
+    request that fails on a reused socket the server has already closed is
+    retried once on a fresh connection. Other requests, such as the POSTs
+    that create stories and comments, are not resent because the server may
+    have acted on them already; their errors propagate.
+
+    Unlike OpenerTransport, this transport does not follow redirects and does
+    not keep cookies; the Tracker API needs neither when using a token.
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=60, timeout=60):
+        """Constructor.
+
+        Args:
+            maxsize: number of idle connections kept per host.
+            idle_timeout: seconds after which an idle connection is evicted.
+            timeout: socket timeout in seconds, or None to block.
+        """
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _NewConnection(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return client.HTTPSConnection(host, port, timeout=self.timeout)
+        return client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _GetConnection(self, key):
+        """Returns (connection, reused), preferring the most recent idle one."""
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self._NewConnection(key), False
+
+    def _Release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def Evict(self):
+        """Closes idle connections that exceeded idle_timeout."""
+        now = time.time()
+        stale = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                fresh = [(c, t) for c, t in idle if now - t <= self.idle_timeout]
+                stale.extend(c for c, t in idle if now - t > self.idle_timeout)
+                self._idle[key] = fresh
+        for conn in stale:
+            conn.close()
+
+    def Close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+    def Open(self, method, url, headers, body=None):
+        """Sends a request and returns a PooledResponse."""
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn, reused = self._GetConnection(key)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except _STALE_CONNECTION_ERRORS as e:
+            conn.close()
+            if (not reused or isinstance(e, socket.timeout) or
+                    method not in RetryPolicy.METHODS):
+                raise
+            # The server dropped the idle socket; try once on a new one.
+            conn = self._NewConnection(key)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        return PooledResponse(self, key, conn, response, url)
+
+
+class OpenerTransport(object):
+    """Transport that sends every request through a urllib OpenerDirector.
+
+    This is how Tracker talked to the API before HttpConnectionPool became
+    the default; every request opens a new connection.
+    """
+
+    def __init__(self, opener=None):
+        if opener is None:
+            cookies = cookiejar.CookieJar()
+            opener = request.build_opener(request.HTTPCookieProcessor(cookies))
+        self.opener = opener
+
+    def Open(self, method, url, headers, body=None):
+        req = request.Request(url, body, headers)
+        req.get_method = lambda: method
+        try:
+            res = self.opener.open(req)
+        except error.HTTPError as e:
+            res = e
+        return _OpenerResponse(res)
+
+    def Close(self):
+        pass
+
+
+class _OpenerResponse(object):
+    """Adapts a urllib response (or HTTPError) to the PooledResponse API."""
+
+    def __init__(self, res):
+        self.res = res
+        self.status = res.getcode()
+        self.reason = res.msg
+
+    def getheader(self, name, default=None):
+        return self.res.info().get(name, default)
+
+    def geturl(self):
+        return self.res.geturl()
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.res.read()
+        return self.res.read(amt)
+
+    def close(self):
+        self.res.close()
+
+
+class _TrackerRequests(object):
+    """Builds the API requests; shared by Tracker and AsyncTracker."""
+
+    # Longest API URL GetStoriesByIds will build for an id: filter.
+    MAX_URL_LENGTH = 2000
+
+    def _ApiUrl(self, the_request):
+        return self.base_api_url + 'projects/%d/%s' % (self.project_id, the_request)
+
+    def _ApiHeaders(self, method, body=None):
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if self.token:
+            headers['X-TrackerToken'] = self.token
+
+        if body or method != 'GET':
+            headers['Content-Type'] = 'application/xml'
+        return headers
+
+    @staticmethod
+    def _ApiError(status, reason, url, body):
+        message = "HTTP Status Code: %s\nMessage: %s\nURL: %s\nError: %s" % (status, reason, url, body)
+        return TrackerApiException(message)
+
+    @staticmethod
+    def _PagingParams(offset=None, limit=None):
+        params = []
+        if offset:
+            params.append('offset=%s' % parse.quote_plus(str(offset)))
+        if limit:
+            params.append('limit=%s' % parse.quote_plus(str(limit)))
+        return params
+
+    def _StoriesRequest(self, query=None, offset=None, limit=None):
+        params = self._PagingParams(offset, limit)
+        if query:
+            params.insert(0, 'filter=' + parse.quote_plus(query))
+        if params:
+            return 'stories?' + '&'.join(params)
+        return 'stories'
+
+    def _IterationsRequest(self, iteration=None, offset=None, limit=None):
+        iteration = ('/%s' % iteration) if iteration else ''
+        params = self._PagingParams(offset, limit)
+        return 'iterations%s?%s' % (iteration, '&'.join(params))
+
+    @staticmethod
+    def _DecodeStory(response):
+        return Story.FromXml(response.decode("utf-8"))
+
+    @staticmethod
+    def _DecodeStoriesPage(response):
+        """Returns (stories, number of stories) for a stories response.
+
+        The response may be bytes or an iterable of byte chunks.
+        """
+        stories = list(StoryXmlDecoder.IterDecode(_AsChunks(response)))
+        return stories, len(stories)
+
+    @staticmethod
+    def _DecodeIterationsPage(response):
+        """Returns (stories, number of iterations) for an iterations response.
+
+        The response may be bytes or an iterable of byte chunks.
+        """
+        decoder = StoryXmlDecoder()
+        stories = []
+        for chunk in _AsChunks(response):
+            stories.extend(decoder.Feed(chunk))
+        stories.extend(decoder.Feed(b'', True))
+        return stories, len(decoder.iterations)
+
+    @staticmethod
+    def _MergeTasks(updated, story, written):
+        """Patches the tasks written after a story PUT into its response.
 
+        Args:
+            updated: the Story() parsed from the PUT response.
+            story: the Story() that was PUT.
+            written: Task() objects returned by the task writes.
+        Returns:
+            updated
+        """
+        if not written:
+            return updated
+        if not updated.GetTasks():
+            # By now the written tasks have their ids, and are replaced below.
+            updated.tasks = [copy.deepcopy(task) for task in story.GetTasks()]
+        positions = dict((str(task.GetDictionary()['id']), i)
+                         for i, task in enumerate(updated.tasks))
+        for saved in written:
+            position = positions.get(str(saved.GetDictionary()['id']))
+            if position is None:
+                updated.tasks.append(saved)
+            else:
+                updated.tasks[position] = saved
+        return updated
 
-class Tracker(object):
+    @staticmethod
+    def _TasksNotCreated(created, story):
+        """Returns copies of the tasks of story missing from created.
+
+        Tracker creates nested tasks along with the story; should a server
+        ignore them, AddNewStory falls back to creating them one by one.
+        """
+        created.tasks = list(created.GetTasks())
+        missing = story.GetTasks()[len(created.tasks):]
+        return [Task.FromDictionary(dict(description=task.GetDictionary()['description'],
+                                         complete=task.GetDictionary()['complete']))
+                for task in missing]
+
+    @staticmethod
+    def _CommentXml(comment):
+        comment_post_body = '<note><text>%s</text></note>' % xml.sax.saxutils.escape(comment)
+        return comment_post_body.encode()
+
+    def _parse_story_id(self, story_id):
+      #story id can be an integer, an integer disguised as a string or
+      # "https://www.pivotaltracker.com/story/show/46440725" or
+      # "https://www.pivotaltracker.com/projects/227033#!/stories/44107229"
+        if story_id.__class__ == int:
+          return story_id
+        temp = re.findall(r"\d+", story_id)
+        if temp:
+          return int(temp[-1])
+        raise ValueError("Can't get story_id from [{}]".format(story_id))
+
+    def _IdFilterQueries(self, story_ids):
+        """Packs story ids into as few "id:" filters as the URL length allows."""
+        base_length = len(self.base_api_url + 'projects/%d/' % self.project_id)
+        queries = []
+        ids = []
+        for story_id in story_ids:
+            candidate = 'id:%s includedone:true' % ','.join(str(i) for i in ids + [story_id])
+            if ids and base_length + len(self._StoriesRequest(candidate)) > self.MAX_URL_LENGTH:
+                queries.append('id:%s includedone:true' % ','.join(str(i) for i in ids))
+                ids = []
+            ids.append(story_id)
+        if ids:
+            queries.append('id:%s includedone:true' % ','.join(str(i) for i in ids))
+        return queries
+
+
+class Tracker(_TrackerRequests):
     """Tracker API."""
 
     def __init__(self, project_id, token,
-                             base_api_url=DEFAULT_BASE_API_URL):
+                             base_api_url=DEFAULT_BASE_API_URL, transport=None,
+                             cache=None, memory_cache=None, conditional_gets=False,
+                             retry_policy=None, rate_limiter=None):
         """Constructor.
 
         If you are debugging API calls, you may want to use a non-HTTPS API URL:
@@ -75,43 +700,155 @@ class Tracker(object):
             project_id: the Tracker ID (integer).
             auth: a TrackerAuth instance.
             base_api_url: the base URL of the HTTP API (with trailing /).
+            transport: object used to send HTTP requests. Defaults to a
+                HttpConnectionPool; pass OpenerTransport(tracker.opener) to go
+                through urllib as older versions did.
+            cache: an optional SqliteStoryCache or StoryArchive. Fetched
+                stories are stored in it, and GetStory/GetStories serve from
+                it when called with a max_age.
+            memory_cache: an optional MemoryCache for GetStory and
+                GetComments, invalidated by this Tracker's writes.
+            conditional_gets: remember ETag/Last-Modified validators and make
+                repeated GetStory, GetStories, GetComments and
+                GetIterationStories calls conditional. Their bodies are then
+                buffered and kept (see ConditionalGetCache); the pages of
+                IterStories never are.
+            retry_policy: a RetryPolicy; defaults to RetryPolicy(). Pass
+                RetryPolicy(max_retries=0) to never retry.
+            rate_limiter: an optional RateLimiter every request waits for.
         """
         self.project_id = project_id
         self.base_api_url = base_api_url
 
         cookies = cookiejar.CookieJar()
         self.opener = request.build_opener(request.HTTPCookieProcessor(cookies))
+        if transport is None:
+            transport = HttpConnectionPool()
+        self.transport = transport
+        self.cache = cache
+        self.memory_cache = memory_cache
+        self.conditional_cache = ConditionalGetCache() if conditional_gets else None
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        # TransferStats of the most recent responses, oldest first.
+        self.transfer_stats = collections.deque(maxlen=100)
 
         self.token = token
 
-    def _Api(self, the_request, method, body=None):
-        url = self.base_api_url + 'projects/%d/%s' % (self.project_id, the_request)
-        headers = {}
-        if self.token:
-            headers['X-TrackerToken'] = self.token
+    def _Api(self, the_request, method, body=None, decode=None, stream=False,
+             conditional=False):
+        """Sends a request and returns the response body.
 
-        if not body and method == 'GET':
-            # Do a GET
-            req = request.Request(url, None, headers)
-        else:
-            headers['Content-Type'] = 'application/xml'
-            req = request.Request(url, body, headers)
-            req.get_method = lambda: method
+        Responses may come gzip or deflate compressed and are decompressed as
+        they are read; the sizes of every body are appended to
+        transfer_stats. Conditional GETs send the validators of a previous
+        response with an ETag or Last-Modified header; on 304 Not Modified
+        the remembered body is used, and if it was evicted meanwhile the GET
+        is sent again without validators. Failed calls are retried as
+        retry_policy says, and every attempt waits for rate_limiter.
 
+        Args:
+            decode: optional function applied to the body. Its result is
+                remembered too and returned (as a copy) on 304, so an
+                unchanged resource is neither downloaded nor parsed again.
+            stream: pass decode an iterator over the decompressed chunks as
+                they arrive instead of the whole body.
+            conditional: make a GET conditional if the Tracker was created
+                with conditional_gets. The body is then read whole and
+                remembered, even with stream.
+        """
+        url = self._ApiUrl(the_request)
+        conditional = conditional and method == 'GET' and self.conditional_cache is not None
+        attempt = 0
+        while True:
+            try:
+                return self._ApiAttempt(url, method, body, decode, stream, conditional)
+            except _BodyReadError as e:
+                # The connection broke while the body was read; the whole
+                # request is sent again.
+                if not self.retry_policy.ShouldRetry(method, attempt, error=e.error):
+                    raise e.error
+            time.sleep(self.retry_policy.GetDelay(attempt))
+            attempt += 1
+
+    def _ApiAttempt(self, url, method, body, decode, stream, conditional):
+        while True:
+            headers = self._ApiHeaders(method, body)
+            validated = conditional and self.conditional_cache.AddValidators(url, headers)
+            res = self._Open(method, url, headers, body)
+            chunks = self._ReadChunks(method, url, res)
+            if res.status != 304:
+                break
+            for _ in chunks:
+                pass
+            if not validated:
+                raise self._ApiError(res.status, res.reason, res.geturl(), b'')
+            result = self.conditional_cache.Get(url, decode)
+            if result is not ConditionalGetCache.MISSING:
+                return result
+            # The entry was evicted after its validators were sent; ask for
+            # the whole body.
+            conditional = False
+        if res.status >= 400:
+            raise self._ApiError(res.status, res.reason, res.geturl(), b''.join(chunks))
+
+        if stream and decode is not None and not conditional:
+            return decode(chunks)
+        data = b''.join(chunks)
+        result = data if decode is None else decode(data)
+        if conditional:
+            self.conditional_cache.Put(url, res.getheader('ETag'),
+                                       res.getheader('Last-Modified'), data)
+        return result
+
+    def _Open(self, method, url, headers, body):
+        """Opens the request, retrying as retry_policy allows."""
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.Acquire()
+            try:
+                res = self.transport.Open(method, url, headers, body)
+            except Exception as e:
+                if not self.retry_policy.ShouldRetry(method, attempt, error=e):
+                    raise
+                delay = self.retry_policy.GetDelay(attempt)
+            else:
+                if not self.retry_policy.ShouldRetry(method, attempt, status=res.status):
+                    return res
+                delay = self.retry_policy.GetDelay(attempt, res.getheader('Retry-After'))
+                for _ in self._ReadChunks(method, url, res):
+                    pass
+            time.sleep(delay)
+            attempt += 1
+
+    def _ReadChunks(self, method, url, res):
+        """Yields the decompressed body of res and records its TransferStats."""
+        decoder = ContentDecoder(res.getheader('Content-Encoding'))
         try:
-            res = self.opener.open(req)
-        except error.HTTPError as e:
-            message = "HTTP Status Code: %s\nMessage: %s\nURL: %s\nError: %s" % (e.code, e.msg, e.geturl(), e.read())
-            raise TrackerApiException(message)
-
-        return res.read()
+            while True:
+                try:
+                    data = res.read(_READ_CHUNK_SIZE)
+                except Exception as e:
+                    raise _BodyReadError(e)
+                if not data:
+                    break
+                data = decoder.Decompress(data)
+                if data:
+                    yield data
+            data = decoder.Flush()
+            if data:
+                yield data
+        finally:
+            res.close()
+            self.transfer_stats.append(TransferStats(
+                    method, url, res.status, decoder.encoding,
+                    decoder.wire_bytes, decoder.decoded_bytes))
 
     def _ApiQueryStories(self, query=None):
-        if query:
-            output = self._Api('stories?filter=' + parse.quote_plus(query),
-                                                 'GET')
-        else:
-            output = self._Api('stories', 'GET')
+        output = self._Api(self._StoriesRequest(query), 'GET')
 
         # Hack: throw an exception if we didn't get valid XML.
         xml.parsers.expat.ParserCreate('utf-8').Parse(output, True)
@@ -126,87 +863,213 @@ class Tracker(object):
 
 
     def GetIterationStories(self, iteration=None, offset=None, limit=None):
-        iteration = ('/%s' % iteration) if iteration else ''
-        params = []
-        if offset:
-            params.append('offset=%s' % parse.quote_plus(str(offset)))
-        if limit:
-            params.append('limit=%s' % parse.quote_plus(str(limit)))
-
-        response = self._Api('iterations%s?%s' % (iteration, '&'.join(params)), 'GET')
-
-        # Hack: throw an exception if we didn't get valid XML.
-        xml.parsers.expat.ParserCreate('utf-8').Parse(response, True)
-
-        parsed = xml.dom.minidom.parseString(response)
-        els = parsed.getElementsByTagName('story')
-        lst = []
-        for el in els:
-            lst.append(Story.FromXml(el.toxml()))
-        return lst
-
+        # Raises ExpatError if we didn't get valid XML.
+        return self._Api(self._IterationsRequest(iteration, offset, limit), 'GET',
+                         decode=self._DecodeIterationsPage, stream=True, conditional=True)[0]
+
+    def _GetStoryPage(self, filt, iteration, offset, limit):
+        """Returns (stories, number of items paged) for one page."""
+        if iteration is None:
+            return self._Api(self._StoriesRequest(filt, offset, limit), 'GET',
+                             decode=self._DecodeStoriesPage, stream=True)
+        return self._Api(self._IterationsRequest(iteration, offset, limit), 'GET',
+                         decode=self._DecodeIterationsPage, stream=True)
+
+    def IterStories(self, filt=None, iteration=None, page_size=100, prefetch=True):
+        """Yields the Stories that satisfy the filter, a page at a time.
+
+        Stories are fetched with offset/limit paging, so only one or two pages
+        are held in memory and the first stories are available as soon as the
+        first page arrives. With prefetch, the next page is requested in a
+        background thread while the caller works on the current one.
 
-    def GetStories(self, filt=None):
+        Args:
+            filt: a Tracker search filter.
+            iteration: page through the stories of an iteration group (for
+                example 'done' or 'backlog') instead of a filter. Pages then
+                count iterations, not stories.
+            page_size: number of stories (or iterations) per request.
+            prefetch: fetch the next page while the current one is consumed.
+        Returns:
+            Generator of Story().
+        """
+        if futures is None:
+            prefetch = False
+        executor = futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            offset = 0
+            pending = None
+            while True:
+                if pending is None:
+                    page, count = self._GetStoryPage(filt, iteration, offset, page_size)
+                else:
+                    page, count = pending.result()
+                    pending = None
+                offset += page_size
+                last_page = count < page_size
+                if not last_page and executor is not None:
+                    pending = executor.submit(self._GetStoryPage, filt, iteration,
+                                              offset, page_size)
+                for story in page:
+                    yield story
+                if last_page:
+                    return
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def GetStories(self, filt=None, max_age=None):
         """Fetch all Stories that satisfy the filter.
 
         Args:
             filt: a Tracker search filter.
+            max_age: if the Tracker has a cache, accept a cached result for
+                the same filter fetched at most this many seconds ago.
         Returns:
             List of Story().
         """
-        stories = self._ApiQueryStories(filt)
-        parsed = xml.dom.minidom.parseString(stories)
-        els = parsed.getElementsByTagName('story')
-        lst = []
-        for el in els:
-            lst.append(Story.FromXml(el.toxml()))
-        return lst
+        if self.cache is not None and max_age is not None:
+            stories = self.cache.GetQuery(self.project_id, filt, max_age)
+            if stories is not None:
+                return stories
+        # Raises ExpatError if we didn't get valid XML.
+        stories = self._Api(self._StoriesRequest(filt), 'GET',
+                            decode=self._DecodeStoriesPage, stream=True, conditional=True)[0]
+        if self.cache is not None:
+            self.cache.PutQuery(self.project_id, filt, stories)
+        return stories
+
+    def GetStory(self, story_id, max_age=None):
+        """Fetch a Story.
 
-    def _parse_story_id(self, story_id):
-      #story id can be an integer, an integer disguised as a string or
-      # "https://www.pivotaltracker.com/story/show/46440725" or
-      # "https://www.pivotaltracker.com/projects/227033#!/stories/44107229"
-        if story_id.__class__ == int:
-          return story_id
-        temp = re.findall("\d+", story_id)
-        if temp is not None:
-          return int(temp[-1])
-        raise ValueError("Can't get story_id from [{}]".format(story_id))
-
-    def GetStory(self, story_id):
+        Args:
+            story_id: the story id, as an integer, string or story URL.
+            max_age: if the Tracker has a cache, accept a cached copy fetched
+                at most this many seconds ago.
+        Returns:
+            Story()
+        """
         story_id = self._parse_story_id(story_id)
-        story_xml = self._Api('stories/%d' % story_id, 'GET')
+        if self.memory_cache is not None:
+            story = self.memory_cache.Get(('story', story_id))
+            if story is not None:
+                return story
+        story = None
+        if self.cache is not None and max_age is not None:
+            story = self.cache.GetStory(self.project_id, story_id, max_age)
+        if story is None:
+            story = self._Api('stories/%d' % story_id, 'GET', decode=self._DecodeStory,
+                              conditional=True)
+            if self.cache is not None:
+                self.cache.PutStories(self.project_id, [story])
+        if self.memory_cache is not None:
+            self.memory_cache.Put(('story', story_id), story)
+        return story
+
+    def _StoryChanged(self, story_id, story=None):
+        """Writes a changed story through to the caches, or drops it."""
+        if self.memory_cache is not None:
+            self.memory_cache.Invalidate(('story', story_id))
+        if self.cache is None:
+            return
+        if story is not None:
+            self.cache.PutStories(self.project_id, [story])
+        else:
+            self.cache.DeleteStory(self.project_id, story_id)
+        self.cache.InvalidateQueries(self.project_id)
 
-        return Story.FromXml(story_xml.decode("utf-8"))
+    def GetStoriesByIds(self, story_ids, max_workers=4, use_filter=True, max_age=None):
+        """Fetches many stories concurrently.
+
+        Args:
+            story_ids: story ids in any form GetStory accepts (ints, strings
+                or story URLs).
+            max_workers: maximum number of requests in flight.
+            use_filter: when fetching more than one story, ask for them in
+                batches with "id:" filter queries (each URL is kept under
+                MAX_URL_LENGTH) and only fetch one by one the stories a
+                batch did not return.
+            max_age: if the Tracker has a cache, accept cached copies fetched
+                at most this many seconds ago.
+        Returns:
+            BatchResult with one entry per input, in input order, holding
+            either the Story() or the exception raised while fetching it.
+            A story id given more than once is fetched once, and its
+            entries share the same Story(). Failed "id:" filter queries are
+            in batch_errors; their stories are fetched one by one.
+        """
+        story_ids = list(story_ids)
+        parsed = []
+        for story_id in story_ids:
+            try:
+                parsed.append((self._parse_story_id(story_id), None))
+            except (ValueError, TypeError, AttributeError) as e:
+                parsed.append((None, e))
+        unique_ids = list(collections.OrderedDict(
+                (story_id, None) for story_id, _ in parsed if story_id is not None))
+
+        found = {}
+        if self.cache is not None and max_age is not None:
+            for story_id in unique_ids:
+                story = self.cache.GetStory(self.project_id, story_id, max_age)
+                if story is not None:
+                    found[story_id] = (story, None)
+        unique_ids = [story_id for story_id in unique_ids if story_id not in found]
+
+        result = BatchResult()
+        if use_filter and len(unique_ids) > 1:
+            queries = self._IdFilterQueries(unique_ids)
+            for query, (stories, e) in zip(queries, _map_concurrently(self.GetStories, queries,
+                                                                      max_workers)):
+                if e is not None:
+                    result.batch_errors.append((query, e))
+                for story in stories or []:
+                    found[story.GetStoryId()] = (story, None)
+
+        missing = [story_id for story_id in unique_ids if story_id not in found]
+        for story_id, outcome in zip(missing, _map_concurrently(self.GetStory, missing,
+                                                                 max_workers)):
+            found[story_id] = outcome
+
+        for key, (story_id, e) in zip(story_ids, parsed):
+            if e is not None:
+                result.Add(key, None, e)
+            else:
+                story, e = found[story_id]
+                result.Add(key, story, e)
+        return result
 
     def AddComment(self, story_id, comment):
         if story_id is None:
             return
-        comment_post_body = '<note><text>%s</text></note>' % xml.sax.saxutils.escape(comment)
-        self._Api('stories/%d/notes' % story_id, 'POST', comment_post_body.encode())
+        self._Api('stories/%d/notes' % story_id, 'POST', self._CommentXml(comment))
+        if self.memory_cache is not None:
+            self.memory_cache.Invalidate(('comments', story_id))
 
     def GetComments(self, story_id):
-        comments_xml = self._Api('stories/%d/notes' % story_id, 'GET')
-        return Comment.ExtractAllFromXml(comments_xml)
+        if self.memory_cache is not None:
+            comments = self.memory_cache.Get(('comments', story_id))
+            if comments is not None:
+                return comments
+        comments = self._Api('stories/%d/notes' % story_id, 'GET',
+                             decode=Comment.ExtractAllFromXml, conditional=True)
+        if self.memory_cache is not None:
+            self.memory_cache.Put(('comments', story_id), comments)
+        return comments
 
     def AddNewStory(self, story):
-        """Persists a new story to Tracker and returns the new Story."""
-        story_xml = story.ToXml()
-        res = self._Api('stories', 'POST', story_xml)
-        toAddStory = story
-        story = Story.FromXml(res)
-
-        if len(toAddStory.GetTasks()) < 1:
-            return story
-
-        for task in toAddStory.GetTasks():
-            path = 'stories/%d' % story.GetStoryId()
-            path += task.GetSubPath()
-            res = self._Api(path, task.GetMethod(), task.ToXml())
+        """Persists a new story to Tracker and returns the new Story.
 
-        return self.GetStory(story.GetStoryId())
-
-    def UpdateStoryById(self, story_id, story):
+        The story and its tasks are created with a single POST.
+        """
+        res = self._Api('stories', 'POST', story.ToXml(include_tasks=True))
+        created = Story.FromXml(res)
+        for task in self._TasksNotCreated(created, story):
+            created.tasks.append(self._WriteTask(created.GetStoryId(), task))
+        self._StoryChanged(created.GetStoryId(), created)
+        return created
+
+    def UpdateStoryById(self, story_id, story, parse_response=True):
         """Persist changes to an existing story to Tracker.
 
         Use this method if you are changing a story without first retreiving the
@@ -215,44 +1078,194 @@ class Tracker(object):
         Args:
             story_id: The ID of the story to mutate
             story: The Story containing values to change.
+            parse_response: set to False to skip parsing the response.
         Returns:
-            The updated Story().
+            The updated Story(), or None if parse_response is False.
         """
         if story_id is None:
             return None
         story_xml = story.ToXml()
         res = self._Api('stories/%d' % story_id, 'PUT', story_xml)
-        return Story.FromXml(res)
+        if not parse_response:
+            self._StoryChanged(story_id)
+            return None
+        updated = Story.FromXml(res)
+        self._StoryChanged(story_id, updated)
+        return updated
 
-    def UpdateStory(self, story):
+    def UpdateStory(self, story, parse_response=True, max_workers=4):
         """Persists changes to an existing story to Tracker.
 
         Use this method if you have a full Story object created by one of the query
-        methods.
+        methods. Only the tasks that are new or were changed since they were
+        fetched are written, concurrently; they are marked clean afterwards.
 
         Args:
             story: a Story()
+            parse_response: set to False to skip parsing the response.
+            max_workers: maximum number of task writes in flight.
         Returns:
-            The updated Story().
+            The updated Story(), or None if parse_response is False.
         """
         if story.GetStoryId() is None:
             return None
-        story_xml = story.ToXml()
-        res = self._Api('stories/%d' % story.GetStoryId(), 'PUT', story_xml)
+        story_id = story.GetStoryId()
+        res = self._Api('stories/%d' % story_id, 'PUT', story.ToXml())
+
+        dirty = [task for task in story.GetTasks() if task.IsDirty()]
+        written = _map_concurrently(lambda task: self._WriteTask(story_id, task),
+                                    dirty, max_workers)
+        errors = [e for _, e in written if e is not None]
+        if errors or not parse_response:
+            self._StoryChanged(story_id)
+            if errors:
+                raise errors[0]
+            return None
 
-        if len(story.GetTasks()) < 1:
-            return Story.FromXml(res.decode("utf-8"))
+        updated = self._MergeTasks(Story.FromXml(res.decode("utf-8")), story,
+                                   [saved for saved, _ in written])
+        self._StoryChanged(story_id, updated)
+        return updated
 
-        for task in story.GetTasks():
-            path = 'stories/%d' % story.GetStoryId()
-            path += task.GetSubPath()
-            res = self._Api(path, task.GetMethod(), task.ToXml())
+    def _WriteTask(self, story_id, task):
+        """Saves a task, marks it clean and returns Tracker's copy of it."""
+        res = self._Api('stories/%d%s' % (story_id, task.GetSubPath()), task.GetMethod(),
+                        task.ToXml())
+        saved = Task.FromXml(res)
+        if task.GetDictionary()['id'] is None:
+            task.GetDictionary()['id'] = saved.GetDictionary()['id']
+        task.MarkClean()
+        return saved
 
-        return self.GetStory(story.GetStoryId())
+    def UpdateStories(self, stories_or_changes, max_workers=4, parse_response=True):
+        """Persists changes to many stories concurrently.
+
+        Unlike calling UpdateStory in a loop, a failed update does not stop
+        the others; every outcome is reported in the returned BatchResult.
+
+        Args:
+            stories_or_changes: Story() objects to save as with UpdateStory,
+                and/or (story_id, changes) pairs to apply as with
+                UpdateStoryById.
+            max_workers: maximum number of requests in flight.
+            parse_response: set to False to skip parsing the responses when
+                the updated stories are not needed.
+        Returns:
+            BatchResult keyed by story id, in input order, holding the updated
+            Story() (None if parse_response is False) or the exception raised.
+        """
+        def Update(item):
+            if isinstance(item, Story):
+                if item.GetStoryId() is None:
+                    raise ValueError("Can't update a story without a story_id")
+                return self.UpdateStory(item, parse_response)
+            story_id, changes = item
+            return self.UpdateStoryById(self._parse_story_id(story_id), changes,
+                                        parse_response)
+
+        items = list(stories_or_changes)
+        result = BatchResult()
+        for item, (story, e) in zip(items, _map_concurrently(Update, items, max_workers)):
+            key = item.GetStoryId() if isinstance(item, Story) else item[0]
+            result.Add(key, story, e)
+        return result
 
     def DeleteStory(self, story_id):
         """Deletes a story by story ID."""
         self._Api('stories/%d' % story_id, 'DELETE', b"")
+        self._StoryChanged(story_id)
+
+    def SyncProject(self, store, full=False, page_size=100):
+        """Brings a local copy of the project's stories up to date.
+
+        The first sync (or one with full=True) fetches every story, and drops
+        from the store the stories Tracker no longer has. Later syncs only
+        fetch the stories modified since the high-water mark, the most recent
+        updated_at seen, and learn about deleted stories from the activity
+        feed.
+
+        Args:
+            store: where stories are kept, for example a SqliteStoryCache
+                created with max_stories=None. It must provide PutStories,
+                DeleteStory, GetStoryIds, InvalidateQueries, GetSyncMark and
+                SetSyncMark; the filter results it caches are dropped when
+                the sync changed anything.
+            full: fetch everything even if the store has a high-water mark.
+            page_size: number of stories per request.
+        Returns:
+            SyncResult().
+        """
+        mark = store.GetSyncMark(self.project_id)
+        result = SyncResult(full or mark is None)
+        if result.full:
+            query = 'includedone:true'
+        else:
+            # modified_since has day granularity, in the project's time zone,
+            # so step back a day; re-fetching a few stories is harmless.
+            since = time.strftime('%m/%d/%Y', time.gmtime(mark - 24 * 60 * 60))
+            query = 'modified_since:%s includedone:true' % since
+
+        new_mark = mark
+        page = []
+        for story in self.IterStories(query, page_size=page_size):
+            page.append(story)
+            result.updated.append(story.GetStoryId())
+            if story.GetUpdatedAt() is not None:
+                new_mark = max(new_mark or 0, story.GetUpdatedAt())
+            if len(page) == page_size:
+                store.PutStories(self.project_id, page)
+                page = []
+        store.PutStories(self.project_id, page)
+
+        if result.full:
+            fetched = set(result.updated)
+            deleted = [i for i in store.GetStoryIds(self.project_id) if i not in fetched]
+        else:
+            deleted = self._GetDeletedStoryIds(mark, page_size)
+        for story_id in deleted:
+            store.DeleteStory(self.project_id, story_id)
+        result.deleted = deleted
+        if result.updated or result.deleted:
+            store.InvalidateQueries(self.project_id)
+
+        if new_mark is not None:
+            store.SetSyncMark(self.project_id, new_mark)
+        result.mark = new_mark
+        return result
+
+    def _GetDeletedStoryIds(self, since, page_size=100):
+        """Returns the ids of the stories deleted since a time, from activities.
+
+        Tracker caps the activity feed, so it is read page by page until a
+        page comes back short, or with no activity not seen before (as when
+        the offset is ignored).
+        """
+        since = TrackerDatetime.Format(since)
+        request = 'activities?occurred_since_date=' + parse.quote_plus(since)
+        story_ids = []
+        seen = set()
+        offset = 0
+        while True:
+            activities = self._Api('&'.join([request] + self._PagingParams(offset, page_size)),
+                                   'GET')
+            activities = minidom.parseString(activities).getElementsByTagName('activity')
+            new = False
+            for activity in activities:
+                activity_id = XmlNodeList.toInt(activity.getElementsByTagName('id'))
+                if activity_id is not None and activity_id in seen:
+                    continue
+                seen.add(activity_id)
+                new = True
+                event_type = XmlNodeList.toText(activity.getElementsByTagName('event_type'))
+                if event_type != 'story_delete':
+                    continue
+                for story in activity.getElementsByTagName('story'):
+                    story_id = XmlNodeList.toInt(story.getElementsByTagName('id'))
+                    if story_id is not None and story_id not in story_ids:
+                        story_ids.append(story_id)
+            if len(activities) < page_size or not new:
+                return story_ids
+            offset += page_size
 
 
 class TrackerAuth(object):
@@ -286,6 +1299,840 @@ class TrackerApiException(Exception):
     """Raised when Tracker returns an error."""
 
 
+class BatchResult(object):
+    """Outcome of a bulk operation, with one entry per input in input order.
+
+    Each entry is a (key, value, error) tuple: key is the input as given by
+    the caller, value the resulting Story (or None) and error the exception
+    raised for that input, or None if it succeeded.
+
+    batch_errors holds (request, error) for the requests covering several
+    inputs that failed, when the inputs were then retried on their own.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.batch_errors = []
+
+    def Add(self, key, value=None, error=None):
+        self.entries.append((key, value, error))
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def GetStories(self):
+        """Returns the values of the successful entries, in input order."""
+        return [value for key, value, e in self.entries if e is None]
+
+    def GetSucceeded(self):
+        """Returns (key, value) for every successful entry."""
+        return [(key, value) for key, value, e in self.entries if e is None]
+
+    def GetFailed(self):
+        """Returns (key, error) for every failed entry."""
+        return [(key, e) for key, value, e in self.entries if e is not None]
+
+    def HasErrors(self):
+        return any(e is not None for key, value, e in self.entries)
+
+
+class RetryPolicy(object):
+    """When and how long to wait before retrying a failed API call.
+
+    Only idempotent methods are retried: on 429 Too Many Requests, on 502,
+    503 and 504, and when the connection is reset. The n-th retry waits a
+    random time between 0 and min(max_backoff, backoff * 2 ** n) seconds,
+    or what the Retry-After header asks for if the response has one, up to
+    max_retry_after seconds.
+    """
+
+    METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+    STATUSES = frozenset([429, 502, 503, 504])
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30, max_retry_after=120):
+        """Constructor.
+
+        Args:
+            max_retries: retries per call; 0 disables retrying.
+            backoff: base delay in seconds.
+            max_backoff: cap of the exponential delay, in seconds.
+            max_retry_after: cap of the delay a Retry-After header asks
+                for, in seconds.
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+
+    def ShouldRetry(self, method, attempt, status=None, error=None):
+        """Returns True if the attempt-th retry of a call should be made.
+
+        Args:
+            status: the HTTP status of the response, if there was one.
+            error: the exception raised instead of a response, if any.
+        """
+        if attempt >= self.max_retries or method not in self.METHODS:
+            return False
+        if error is not None:
+            return (isinstance(error, (socket.error, client.HTTPException)) and
+                    not isinstance(error, socket.timeout))
+        return status in self.STATUSES
+
+    def GetDelay(self, attempt, retry_after=None):
+        """Returns the seconds to wait before the attempt-th retry."""
+        if retry_after:
+            delay = self.ParseRetryAfter(retry_after)
+            if delay is not None:
+                return min(delay, self.max_retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def ParseRetryAfter(value):
+        """Returns the seconds a Retry-After header value asks to wait."""
+        value = value.strip()
+        if value.isdigit():
+            return int(value)
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class RateLimiter(object):
+    """Token bucket limiting the rate of API calls.
+
+    Allows `rate` calls per second on average and bursts of up to `burst`
+    calls. One limiter may be shared by any number of threads (and
+    Trackers); callers that are over the quota are scheduled in turn rather
+    than spinning.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self._clock = getattr(time, 'monotonic', time.time)
+        self._tokens = self.burst
+        self._updated = self._clock()
+        self._lock = threading.Lock()
+
+    def Reserve(self):
+        """Takes a token and returns the seconds to wait before using it."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def Acquire(self):
+        """Blocks until a call may be made."""
+        delay = self.Reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ConditionalGetCache(object):
+    """Remembers validated GET responses for conditional requests.
+
+    For each URL answered with an ETag or Last-Modified header, keeps the
+    validators, the body and, once it's needed, the decoded body. Only the
+    most recently used `max_entries` URLs are kept.
+    """
+
+    # Returned by Get for a URL no longer remembered.
+    MISSING = object()
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def AddValidators(self, url, headers):
+        """Adds If-None-Match/If-Modified-Since headers; True if it did."""
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is None:
+            return False
+        etag, last_modified = entry[0], entry[1]
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return True
+
+    def Put(self, url, etag, last_modified, body):
+        with self._lock:
+            self._entries.pop(url, None)
+            if not etag and not last_modified:
+                return
+            self._entries[url] = [etag, last_modified, body, None, None]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def Get(self, url, decode=None):
+        """Returns the remembered body, or a copy of it decoded, or MISSING."""
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is None:
+                return self.MISSING
+            self._entries[url] = entry
+        if decode is None:
+            return entry[2]
+        if entry[3] != decode:
+            # Decoded lazily: what decode returned the first time went to a
+            # caller who may have changed it.
+            decoded = decode(entry[2])
+            with self._lock:
+                entry[3], entry[4] = decode, decoded
+        else:
+            decoded = entry[4]
+        return copy.deepcopy(decoded)
+
+
+class MemoryCache(object):
+    """In-process LRU cache with a per-entry time to live.
+
+    Values are deep-copied going in and coming out, so callers can mutate
+    what they get without corrupting the cache. `hits` and `misses` count
+    lookups.
+    """
+
+    def __init__(self, capacity=1000, ttl=60):
+        """Constructor.
+
+        Args:
+            capacity: number of entries kept before evicting the least
+                recently used.
+            ttl: seconds an entry stays valid.
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def Get(self, key):
+        """Returns a copy of the cached value, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Python 2 has no move_to_end.
+            del self._entries[key]
+            self._entries[key] = entry
+            value = entry[1]
+        return copy.deepcopy(value)
+
+    def Put(self, key, value):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def Invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def Clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SyncResult(object):
+    """What Tracker.SyncProject changed in the local store."""
+
+    def __init__(self, full):
+        self.full = full
+        self.updated = []
+        self.deleted = []
+        self.mark = None
+
+
+class SqliteStoryCache(object):
+    """Persistent read-through story cache in a local SQLite file.
+
+    Stories are stored per (project_id, story_id) with their updated_at, so a
+    copy is only replaced by one at least as recent, and the time they were
+    fetched, so readers can bound how stale an answer they accept. Filter
+    results are kept as lists of story ids. The least recently used stories
+    are evicted beyond max_stories, and the oldest filter results beyond
+    max_queries.
+
+    It can also be the local store of Tracker.SyncProject, which keeps its
+    high-water mark here; create it with max_stories=None so that synced
+    stories are never evicted.
+
+    The cache can be shared by the threads of one process.
+    """
+
+    def __init__(self, path, max_stories=50000, max_queries=500):
+        """Constructor.
+
+        Args:
+            path: the SQLite file, or ':memory:'.
+            max_stories: number of stories kept before evicting, or None.
+            max_queries: number of filter results kept before evicting.
+        """
+        self.max_stories = max_stories
+        self.max_queries = max_queries
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS stories (
+                    project_id INTEGER NOT NULL,
+                    story_id INTEGER NOT NULL,
+                    updated_at INTEGER,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    story TEXT NOT NULL,
+                    PRIMARY KEY (project_id, story_id))""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS stories_accessed_at
+                    ON stories (accessed_at)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS queries (
+                    project_id INTEGER NOT NULL,
+                    filter TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    story_ids TEXT NOT NULL,
+                    PRIMARY KEY (project_id, filter))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS sync_marks (
+                    project_id INTEGER PRIMARY KEY,
+                    mark INTEGER NOT NULL)""")
+
+    def Close(self):
+        with self._lock:
+            self.db.close()
+
+    def GetStory(self, project_id, story_id, max_age):
+        """Returns the cached Story if fetched less than max_age secs ago."""
+        stories = self._GetStories(project_id, [story_id], max_age)
+        if stories is None:
+            return None
+        return stories[0]
+
+    def _GetStories(self, project_id, story_ids, max_age):
+        """Returns all the stories, or None if any of them is missing."""
+        now = time.time()
+        stories = []
+        with self._lock:
+            for story_id in story_ids:
+                row = self.db.execute(
+                        'SELECT story, fetched_at FROM stories WHERE project_id = ? AND story_id = ?',
+                        (project_id, story_id)).fetchone()
+                if row is None or now - row[1] > max_age:
+                    return None
+                stories.append(row[0])
+            with self.db:
+                self.db.executemany(
+                        'UPDATE stories SET accessed_at = ? WHERE project_id = ? AND story_id = ?',
+                        [(now, project_id, story_id) for story_id in story_ids])
+        stories = [Story.FromJson(story) for story in stories]
+        for story in stories:
+            # The cache mirrors Tracker, so the tasks are saved ones.
+            for task in story.GetTasks():
+                task.MarkClean()
+        return stories
+
+    def PutStories(self, project_id, stories):
+        """Stores stories, unless the cache has a more recent copy."""
+        now = time.time()
+        rows = [(project_id, story.GetStoryId(), story.GetUpdatedAt(), now, now, story.ToJson())
+                for story in stories]
+        with self._lock:
+            with self.db:
+                self.db.executemany("""INSERT INTO stories
+                        (project_id, story_id, updated_at, fetched_at, accessed_at, story)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (project_id, story_id) DO UPDATE SET
+                            updated_at = excluded.updated_at,
+                            fetched_at = excluded.fetched_at,
+                            accessed_at = excluded.accessed_at,
+                            story = excluded.story
+                        WHERE stories.updated_at IS NULL OR excluded.updated_at IS NULL
+                            OR excluded.updated_at >= stories.updated_at""", rows)
+                self._Evict('stories', 'accessed_at', self.max_stories)
+
+    def DeleteStory(self, project_id, story_id):
+        with self._lock:
+            with self.db:
+                self.db.execute('DELETE FROM stories WHERE project_id = ? AND story_id = ?',
+                                (project_id, story_id))
+
+    def GetQuery(self, project_id, filt, max_age):
+        """Returns the stories of a cached filter result, or None."""
+        with self._lock:
+            row = self.db.execute(
+                    'SELECT story_ids, fetched_at FROM queries WHERE project_id = ? AND filter = ?',
+                    (project_id, filt or '')).fetchone()
+        if row is None or time.time() - row[1] > max_age:
+            return None
+        return self._GetStories(project_id, json.loads(row[0]), max_age)
+
+    def PutQuery(self, project_id, filt, stories):
+        """Stores the stories and the result of the filter."""
+        self.PutStories(project_id, stories)
+        story_ids = json.dumps([story.GetStoryId() for story in stories])
+        with self._lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)',
+                                (project_id, filt or '', time.time(), story_ids))
+                self._Evict('queries', 'fetched_at', self.max_queries)
+
+    def InvalidateQueries(self, project_id):
+        """Drops the filter results, which a change to any story may affect."""
+        with self._lock:
+            with self.db:
+                self.db.execute('DELETE FROM queries WHERE project_id = ?', (project_id,))
+
+    def GetStoryIds(self, project_id):
+        with self._lock:
+            rows = self.db.execute('SELECT story_id FROM stories WHERE project_id = ?',
+                                   (project_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def IterStories(self, project_id):
+        """Yields the cached Stories of a project, by story id."""
+        with self._lock:
+            rows = self.db.execute(
+                    'SELECT story FROM stories WHERE project_id = ? ORDER BY story_id',
+                    (project_id,)).fetchall()
+        for row in rows:
+            story = Story.FromJson(row[0])
+            for task in story.GetTasks():
+                task.MarkClean()
+            yield story
+
+    def GetSyncMark(self, project_id):
+        """Returns the updated_at high-water mark of the last sync, or None."""
+        with self._lock:
+            row = self.db.execute('SELECT mark FROM sync_marks WHERE project_id = ?',
+                                  (project_id,)).fetchone()
+        return row[0] if row else None
+
+    def SetSyncMark(self, project_id, mark):
+        with self._lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO sync_marks VALUES (?, ?)',
+                                (project_id, mark))
+
+    def Compact(self):
+        """Rebuilds the database without its free pages; returns the bytes saved."""
+        with self._lock:
+            before = self._Size()
+            self.db.execute('VACUUM')
+            return before - self._Size()
+
+    def _Size(self):
+        return (self.db.execute('PRAGMA page_count').fetchone()[0] *
+                self.db.execute('PRAGMA page_size').fetchone()[0])
+
+    def _Evict(self, table, column, limit):
+        if limit is None:
+            return
+        count = self.db.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+        if count > limit:
+            self.db.execute('DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY %s LIMIT ?)'
+                            % (table, table, column), (count - limit,))
+
+
+class StoryArchive(object):
+    """Append-only story file with an on-disk index, read through mmap.
+
+    Stories are appended to the archive file as records: kind, project and
+    story ids, updated_at, the time they were archived, the story as
+    compact JSON and a CRC32. The index file next to it (path + '.idx')
+    maps (project_id, story_id) to the offset of the latest record, sorted,
+    so a story is found by binary search over the mapped index without
+    reading the rest of the archive. Records appended after the index was
+    written are found by scanning them once; Reindex() (run automatically
+    every reindex_after such records) folds them into the index. Deletes
+    append tombstones, and Compact() rewrites the archive with only the
+    live stories.
+
+    Any number of processes can read an archive while one process at a time
+    appends: appends hold an exclusive lock (fcntl.flock on path + '.lock',
+    when fcntl is available) and become visible to readers whole, since
+    readers stop at the first incomplete record. Reindex() and Compact()
+    replace files by renaming new ones over them, so readers keep using the files they
+    have mapped until their next call notices the change.
+
+    It provides the methods of SqliteStoryCache, so it can be a Tracker's
+    cache or the store of Tracker.SyncProject; filter results are not
+    kept. An instance can be shared by the threads of one process.
+    """
+    MAGIC = b'PTARCHIV'
+    INDEX_MAGIC = b'PTARCIDX'
+    FORMAT_VERSION = 1
+    # magic, format version, generation (shared by an archive and its index)
+    _HEADER = struct.Struct('<8sHQ')
+    # kind, project_id, story_id, updated_at (or the sync mark), archived at,
+    # length of the JSON that follows; then the CRC32 of both
+    _RECORD = struct.Struct('<BqqqdI')
+    _CRC = struct.Struct('<I')
+    # magic, format version, generation, archive bytes indexed, entries, marks
+    _INDEX_HEADER = struct.Struct('<8sHQQQQ')
+    _ENTRY = struct.Struct('<qqq')
+    _MARK = struct.Struct('<qq')
+    STORY, DELETED, MARK = 1, 2, 3
+    _NO_TIME = -(1 << 63)
+
+    def __init__(self, path, reindex_after=1000):
+        """Constructor.
+
+        Args:
+            path: the archive file, created if missing.
+            reindex_after: rewrite the index once this many records were
+                appended since it was written.
+        """
+        self.path = path
+        self.index_path = path + '.idx'
+        self.lock_path = path + '.lock'
+        self.reindex_after = reindex_after
+        self._lock = threading.RLock()
+        self._data = None
+        self._index = None
+        with self._lock:
+            if not os.path.exists(path):
+                with self._FileLock():
+                    if not os.path.exists(path):
+                        self._Replace(path, self._HEADER.pack(
+                                self.MAGIC, self.FORMAT_VERSION, random.getrandbits(64)))
+            self._Open()
+
+    def Close(self):
+        with self._lock:
+            self._CloseMaps()
+
+    def _CloseMaps(self):
+        for mapped in (self._data, self._index):
+            if mapped is not None:
+                mapped.close()
+        self._data = self._index = None
+
+    def _FileLock(self):
+        """Returns a context manager holding the archive's writer lock."""
+        return _ArchiveFileLock(self.lock_path)
+
+    @staticmethod
+    def _Replace(path, *chunks):
+        """Writes a file through a temporary one, so it appears whole."""
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
+            output.flush()
+            os.fsync(output.fileno())
+        _ReplaceFile(temporary, path)
+
+    @staticmethod
+    def _Map(path):
+        with open(path, 'rb') as mapped_file:
+            return mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ), os.fstat(
+                    mapped_file.fileno())
+
+    def _Open(self):
+        """Maps the archive and its index, and scans what isn't indexed."""
+        self._CloseMaps()
+        for attempt in range(3):
+            self._data, data_stat = self._Map(self.path)
+            if len(self._data) < self._HEADER.size:
+                raise ValueError('%s is not a story archive' % self.path)
+            magic, version, generation = self._HEADER.unpack_from(self._data, 0)
+            if magic != self.MAGIC:
+                raise ValueError('%s is not a story archive' % self.path)
+            if version > self.FORMAT_VERSION:
+                raise ValueError('story archive format %d is newer than %d' %
+                                 (version, self.FORMAT_VERSION))
+            self._data_id = (data_stat.st_dev, data_stat.st_ino)
+            self._index_id = None
+            self._indexed = self._HEADER.size
+            self._entries = 0
+            self.marks = {}
+            try:
+                index, index_stat = self._Map(self.index_path)
+            except (IOError, OSError, ValueError): # no index (yet), or empty
+                break
+            self._index_id = (index_stat.st_dev, index_stat.st_ino)
+            header = self._INDEX_HEADER.unpack_from(index, 0)
+            if header[0] == self.INDEX_MAGIC and header[2] == generation:
+                self._index = index
+                self._indexed, self._entries, marks = header[3:]
+                for i in range(marks):
+                    project_id, mark = self._MARK.unpack_from(
+                            index, self._INDEX_HEADER.size + i * self._MARK.size)
+                    self.marks[project_id] = mark
+                break
+            # The index is of another generation: a compaction is replacing
+            # both files, so look again; at worst, do without the index.
+            index.close()
+            if attempt < 2:
+                self._data.close()
+        self._entries_start = self._INDEX_HEADER.size + len(self.marks) * self._MARK.size
+        self._tail = {}
+        self._scanned = self._indexed
+        self._ScanTail()
+
+    def _ScanTail(self):
+        """Reads the complete records after the last one read."""
+        data = self._data
+        size = len(data)
+        position = self._scanned
+        while position + self._RECORD.size <= size:
+            kind, project_id, story_id, updated_at, archived_at, length = (
+                    self._RECORD.unpack_from(data, position))
+            end = position + self._RECORD.size + length
+            if end + self._CRC.size > size:
+                break
+            if self._CRC.unpack_from(data, end)[0] != zlib.crc32(data[position:end]) & 0xffffffff:
+                break # being written, or torn by a crash
+            if kind == self.MARK:
+                self.marks[project_id] = updated_at
+            else:
+                self._tail[(project_id, story_id)] = position if kind == self.STORY else None
+            position = end + self._CRC.size
+        self._scanned = position
+
+    def _Refresh(self):
+        """Catches up with appends, reindexing and compaction by others."""
+        data_stat = os.stat(self.path)
+        try:
+            index_stat = os.stat(self.index_path)
+            index_id = (index_stat.st_dev, index_stat.st_ino)
+        except OSError:
+            index_id = None
+        if ((data_stat.st_dev, data_stat.st_ino) != self._data_id or
+                (index_id is not None and index_id != self._index_id)):
+            self._Open()
+        elif data_stat.st_size > len(self._data):
+            self._data.close()
+            self._data = self._Map(self.path)[0]
+            self._ScanTail()
+
+    def _Find(self, project_id, story_id):
+        """Returns the offset of the story's record, or None."""
+        key = (project_id, story_id)
+        if key in self._tail:
+            return self._tail[key]
+        low, high = 0, self._entries
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._ENTRY.unpack_from(self._index,
+                                            self._entries_start + middle * self._ENTRY.size)
+            if entry[:2] < key:
+                low = middle + 1
+            elif entry[:2] > key:
+                high = middle
+            else:
+                return entry[2]
+        return None
+
+    def _ReadRecord(self, offset):
+        """Returns the updated_at, archive time and Story of a record."""
+        kind, project_id, story_id, updated_at, archived_at, length = (
+                self._RECORD.unpack_from(self._data, offset))
+        start = offset + self._RECORD.size
+        story = Story.FromJson(self._data[start:start + length].decode('utf-8'))
+        # The archive mirrors Tracker, so the tasks are saved ones.
+        for task in story.GetTasks():
+            task.MarkClean()
+        return (None if updated_at == self._NO_TIME else updated_at), archived_at, story
+
+    def Get(self, project_id, story_id):
+        """Returns the archived Story, or None."""
+        with self._lock:
+            self._Refresh()
+            offset = self._Find(project_id, story_id)
+            if offset is None:
+                return None
+            return self._ReadRecord(offset)[2]
+
+    def GetStory(self, project_id, story_id, max_age):
+        """Returns the archived Story if archived less than max_age secs ago."""
+        with self._lock:
+            self._Refresh()
+            offset = self._Find(project_id, story_id)
+            if offset is None:
+                return None
+            updated_at, archived_at, story = self._ReadRecord(offset)
+        if time.time() - archived_at > max_age:
+            return None
+        return story
+
+    def _Items(self):
+        """Returns the sorted ((project_id, story_id), offset) of the live stories."""
+        items = {}
+        for i in range(self._entries):
+            entry = self._ENTRY.unpack_from(self._index, self._entries_start + i * self._ENTRY.size)
+            items[entry[:2]] = entry[2]
+        items.update(self._tail)
+        return sorted((key, offset) for key, offset in items.items() if offset is not None)
+
+    def GetStoryIds(self, project_id):
+        with self._lock:
+            self._Refresh()
+            return [key[1] for key, offset in self._Items() if key[0] == project_id]
+
+    def IterStories(self, project_id):
+        """Yields the archived Stories of a project, by story id."""
+        for story_id in self.GetStoryIds(project_id):
+            story = self.Get(project_id, story_id)
+            if story is not None:
+                yield story
+
+    def _Record(self, kind, project_id, story_id, updated_at=None, payload=b''):
+        if updated_at is None:
+            updated_at = self._NO_TIME
+        record = self._RECORD.pack(kind, project_id, story_id, updated_at, time.time(),
+                                   len(payload)) + payload
+        return record + self._CRC.pack(zlib.crc32(record) & 0xffffffff)
+
+    def _Append(self, records):
+        """Appends records while holding the writer lock."""
+        with open(self.path, 'ab') as output:
+            if output.tell() != self._scanned:
+                output.truncate(self._scanned) # drop a record torn by a crash
+            output.write(b''.join(records))
+            output.flush()
+            os.fsync(output.fileno())
+        self._Refresh()
+        if len(self._tail) >= self.reindex_after:
+            self._Reindex()
+
+    def PutStories(self, project_id, stories):
+        """Archives stories, unless the archive has a more recent copy."""
+        with self._lock:
+            with self._FileLock():
+                self._Refresh()
+                records = []
+                for story in stories:
+                    offset = self._Find(project_id, story.GetStoryId())
+                    if offset is not None and story.GetUpdatedAt() is not None:
+                        updated_at = self._RECORD.unpack_from(self._data, offset)[3]
+                        if updated_at != self._NO_TIME and updated_at > story.GetUpdatedAt():
+                            continue
+                    records.append(self._Record(self.STORY, project_id, story.GetStoryId(),
+                                                story.GetUpdatedAt(),
+                                                story.ToJson(compact=True).encode('utf-8')))
+                if records:
+                    self._Append(records)
+
+    def DeleteStory(self, project_id, story_id):
+        with self._lock:
+            with self._FileLock():
+                self._Refresh()
+                if self._Find(project_id, story_id) is not None:
+                    self._Append([self._Record(self.DELETED, project_id, story_id)])
+
+    def GetQuery(self, project_id, filt, max_age):
+        """Filter results are not archived."""
+        return None
+
+    def PutQuery(self, project_id, filt, stories):
+        self.PutStories(project_id, stories)
+
+    def InvalidateQueries(self, project_id):
+        pass
+
+    def GetSyncMark(self, project_id):
+        """Returns the updated_at high-water mark of the last sync, or None."""
+        with self._lock:
+            self._Refresh()
+            return self.marks.get(project_id)
+
+    def SetSyncMark(self, project_id, mark):
+        with self._lock:
+            with self._FileLock():
+                self._Refresh()
+                self._Append([self._Record(self.MARK, project_id, 0, mark)])
+
+    def _IndexChunks(self, generation, indexed, items, marks):
+        chunks = [self._INDEX_HEADER.pack(self.INDEX_MAGIC, self.FORMAT_VERSION, generation,
+                                          indexed, len(items), len(marks))]
+        chunks.extend(self._MARK.pack(project_id, mark) for project_id, mark in sorted(marks.items()))
+        chunks.extend(self._ENTRY.pack(key[0], key[1], offset) for key, offset in items)
+        return chunks
+
+    def Reindex(self):
+        """Rewrites the index to cover every record appended so far."""
+        with self._lock:
+            with self._FileLock():
+                self._Refresh()
+                self._Reindex()
+
+    def _Reindex(self):
+        generation = self._HEADER.unpack_from(self._data, 0)[2]
+        self._Replace(self.index_path, *self._IndexChunks(
+                generation, self._scanned, self._Items(), self.marks))
+        self._Open()
+
+    def Compact(self):
+        """Rewrites the archive with only the latest copy of the live stories.
+
+        Returns:
+            the number of bytes saved.
+        """
+        with self._lock:
+            with self._FileLock():
+                self._Refresh()
+                before = self._scanned
+                generation = random.getrandbits(64)
+                chunks = [self._HEADER.pack(self.MAGIC, self.FORMAT_VERSION, generation)]
+                position = self._HEADER.size
+                items = []
+                for key, offset in self._Items():
+                    length = self._RECORD.unpack_from(self._data, offset)[5]
+                    end = offset + self._RECORD.size + length + self._CRC.size
+                    chunks.append(self._data[offset:end])
+                    items.append((key, position))
+                    position += end - offset
+                for project_id, mark in sorted(self.marks.items()):
+                    chunks.append(self._Record(self.MARK, project_id, 0, mark))
+                    position += len(chunks[-1])
+                index_chunks = self._IndexChunks(generation, position, items, self.marks)
+                self._CloseMaps()
+                # Readers that see the new archive with the old index look
+                # again, as their generations differ.
+                self._Replace(self.path, *chunks)
+                self._Replace(self.index_path, *index_chunks)
+                self._Open()
+                return before - position
+
+
+class _ArchiveFileLock(object):
+    """Exclusive lock between processes on a lock file (none without fcntl)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
 class HostedTrackerAuth(TrackerAuth):
     """Authentication rules for hosted Tracker instances."""
 
@@ -355,14 +2202,12 @@ class XmlDocument(object):
         if not el:
             return None
         assert el[0].getAttribute('type') == 'datetime'
-        data = el[0].firstChild.data
+        return XmlDocument.DatetimeToSecs(el[0].firstChild.data)
 
-        # Tracker emits datetime strings in UTC or GMT.
-        # The [:-4] strips the timezone indicator
-        parsable_date=("{}".format(data[:-4])).strip()
-        when = time.strptime(parsable_date, '%Y/%m/%d %H:%M:%S')
-        # calendar.timegm treats the tuple as GMT
-        return calendar.timegm(when)
+    @staticmethod
+    def DatetimeToSecs(data):
+        """Parses a Tracker datetime string into seconds-since-epoch."""
+        return TrackerDatetime.Parse(data)
 
 class XmlNodeList(object):
     @staticmethod
@@ -398,13 +2243,214 @@ class XmlNodeList(object):
     def toSeconds(nodelist):
         for node in nodelist:
             if node.nodeType == node.TEXT_NODE:
-                when = time.strptime(node.data[:-4], '%Y/%m/%d %H:%M:%S')
-                return calendar.timegm(when)
+                return TrackerDatetime.Parse(node.data)
             if node.nodeType == node.ELEMENT_NODE:
                 return XmlNodeList.toSeconds(node.childNodes)
         return None
 
 
+
+class StoryXmlDecoder(object):
+    """Single-pass, event-driven decoder for Tracker story XML.
+
+    Feed() accepts the response bytes in as many chunks as convenient and
+    returns the Story objects completed so far, so memory stays bounded by
+    one story no matter how large the document is. It accepts a single
+    <story> document as well as <stories> and <iterations> listings, and
+    builds exactly what Story.FromXml would build from each <story> element.
+
+    Iterations seen outside of stories are collected in `iterations` as
+    dictionaries with their id, number, start, finish and story_ids.
+    """
+
+    def __init__(self):
+        self.parser = xml.parsers.expat.ParserCreate('utf-8')
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._StartElement
+        self.parser.EndElementHandler = self._EndElement
+        self.parser.CharacterDataHandler = self._CharacterData
+        self.iterations = []
+        self._ready = []
+        self._iteration = None
+        self._iteration_depth = None
+        self._iteration_field = None
+        self._depth = 0
+        self._story_depth = None
+        # Per story: first occurrence of every tag, in document order, as
+        # [attributes, text before the first child element, has_child].
+        self._first = None
+        self._stack = None
+        self._tasks = None
+        self._task = None
+        self._task_depth = None
+        self._task_field = None
+
+    @staticmethod
+    def Decode(as_xml):
+        """Returns the list of Story() in a Tracker XML document."""
+        decoder = StoryXmlDecoder()
+        return decoder.Feed(as_xml, True)
+
+    @staticmethod
+    def IterDecode(chunks):
+        """Yields Story() objects from an iterable of XML byte chunks."""
+        decoder = StoryXmlDecoder()
+        for chunk in chunks:
+            for story in decoder.Feed(chunk):
+                yield story
+        for story in decoder.Feed(b'', True):
+            yield story
+
+    def Feed(self, data, final=False):
+        """Parses the next chunk and returns the stories completed by it.
+
+        Raises xml.parsers.expat.ExpatError if the document is not valid XML.
+        """
+        self.parser.Parse(data, final)
+        ready, self._ready = self._ready, []
+        return ready
+
+    def _StartElement(self, name, attrs):
+        self._depth += 1
+        if self._story_depth is None:
+            if name == 'story':
+                self._story_depth = self._depth
+                self._first = {}
+                self._stack = []
+                self._tasks = []
+            elif name == 'iteration':
+                self._iteration = dict(id=None, number=None, start=None,
+                                       finish=None, story_ids=[])
+                self._iteration_depth = self._depth
+                self.iterations.append(self._iteration)
+            elif (self._iteration is not None and name in self._iteration and
+                  self._depth == self._iteration_depth + 1 and name != 'story_ids'):
+                self._iteration[name] = ''
+                self._iteration_field = name
+            return
+
+        if self._stack:
+            self._stack[-1][2] = True
+        entry = [attrs, '', False]
+        if name not in self._first:
+            self._first[name] = entry
+        self._stack.append(entry)
+
+        if name == 'task' and self._task is None:
+            self._task = dict(description=[], complete=None, id=[])
+            self._task_depth = self._depth
+        elif (self._task is not None and self._task_field is None and
+              name in ('description', 'id')):
+            self._task_field = (name, self._depth)
+
+    def _CharacterData(self, data):
+        if self._story_depth is None:
+            if self._iteration_field is not None:
+                self._iteration[self._iteration_field] += data
+            return
+        if self._stack:
+            entry = self._stack[-1]
+            if not entry[2]:
+                entry[1] += data
+        if self._task_field is not None:
+            self._task[self._task_field[0]].append(data)
+
+    def _EndElement(self, name):
+        depth = self._depth
+        self._depth -= 1
+        if self._story_depth is None:
+            if self._iteration is not None and depth == self._iteration_depth:
+                self._FinishIteration()
+            self._iteration_field = None
+            return
+
+        if depth == self._story_depth:
+            story = self._BuildStory()
+            self._story_depth = None
+            self._stack = None
+            if self._iteration is not None:
+                self._iteration['story_ids'].append(story.GetStoryId())
+            self._ready.append(story)
+            return
+
+        entry = self._stack.pop()
+        if self._task is None:
+            return
+        if self._task_field is not None and self._task_field[1] == depth:
+            self._task_field = None
+        if name == 'complete' and self._task['complete'] is None:
+            # like XmlNodeList.toBool, only the first <complete> counts
+            self._task['complete'] = entry[1] == 'true'
+        if depth == self._task_depth:
+            task = Task.FromDictionary(dict(
+                    description=''.join(self._task['description']),
+                    complete=bool(self._task['complete']),
+                    id=''.join(self._task['id'])))
+            task.MarkClean()
+            self._tasks.append(task)
+            self._task = None
+
+    def _FinishIteration(self):
+        iteration = self._iteration
+        for key in ('id', 'number'):
+            if iteration[key]:
+                iteration[key] = int(iteration[key])
+        for key in ('start', 'finish'):
+            if iteration[key]:
+                iteration[key] = TrackerDatetime.Parse(iteration[key])
+        self._iteration = None
+        self._iteration_depth = None
+
+    def _GetData(self, tag):
+        entry = self._first.get(tag)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def _GetSecs(self, tag):
+        entry = self._first.get(tag)
+        if entry is None:
+            return None
+        assert entry[0].get('type') == 'datetime'
+        return TrackerDatetime.Parse(entry[1])
+
+    def _BuildStory(self):
+        """Mirrors Story.FromXml on the collected fields."""
+        story = Story()
+        story.story_id = int(self._GetData('id'))
+        story.url = self._GetData('url')
+        story.owned_by = _intern(self._GetData('owned_by'))
+        story.created_at = self._GetSecs('created_at')
+        story.updated_at = self._GetSecs('updated_at')
+        story.requested_by = _intern(self._GetData('requested_by'))
+        iteration = self._GetData('number')
+        story.jira_url = self._GetData('jira_url')
+        story.jira_id = self._GetData('jira_id')
+        story.zendesk_url = self._GetData('zendesk_url')
+        story.zendesk_id = self._GetData('zendesk_id')
+
+        if iteration:
+            story.iteration_number = int(iteration)
+
+        if 'task' in self._first:
+            story.tasks = self._tasks
+
+        story.SetStoryType(_intern(self._GetData('story_type')))
+        story.SetCurrentState(_intern(self._GetData('current_state')))
+        story.SetName(self._GetData('name'))
+        story.SetDescription(self._GetData('description'))
+        story.SetDeadline(self._GetSecs('deadline'))
+
+        estimate = self._GetData('estimate')
+        if estimate is not None:
+                story.estimate = _intern(estimate)
+        labels = self._GetData('labels')
+        if labels is not None:
+            story.AddLabelsFromString(labels)
+
+        story.ClearUpdatedFields()
+        return story
+
 class Story(object):
     """Represents a Story.
 
@@ -433,43 +2479,49 @@ class Story(object):
 
     CSV_FIELDS = ["story_id" , "labels", "story_type", "estimate", "zendesk_id", "owned_by", "name"]
 
-    updated_fields = []
-
-    # Type: immutable ints.
-    story_id = None
-    iteration_number = None
-
-    # Type: immutable times (secs since epoch)
-    created_at = None
-    updated_at = None
+    __slots__ = (
+        # Type: immutable ints.
+        'story_id', 'iteration_number',
+        # Type: immutable times (secs since epoch)
+        'created_at', 'updated_at',
+        # Type: mutable time (secs since epoch)
+        'deadline',
+        # Type: mutable set (API methods expose as string)
+        'labels',
+        # Type: immutable strings
+        'url',
+        # Type: mutable strings
+        'requested_by', 'owned_by', 'story_type', 'current_state', 'description',
+        'name', 'estimate', 'jira_url', 'jira_id', 'zendesk_url', 'zendesk_id',
+        # Type: list of Task (tasks are not mutable)
+        'tasks',
+        # Type: list of the UPDATE_FIELDS set since the last ClearUpdatedFields
+        'updated_fields')
 
-    # Type: mutable time (secs since epoch)
-    deadline = None
-
-    # Type: mutable set (API methods expose as string)
-    labels = None
-
-    # Type: immutable strings
-    url = None
-
-    # Type: mutable strings
-    requested_by = None
-    owned_by = None
-    story_type = None
-    current_state = None
-    description = None
-    name = None
-    estimate = None
-    jira_url = None
-    jira_id = None
-    zendesk_url = None
-    zendesk_id = None
-
-    # tasks are not mutable
-    tasks = []
+    def __init__(self):
+        self.story_id = None
+        self.iteration_number = None
+        self.created_at = None
+        self.updated_at = None
+        self.deadline = None
+        self.labels = None
+        self.url = None
+        self.requested_by = None
+        self.owned_by = None
+        self.story_type = None
+        self.current_state = None
+        self.description = None
+        self.name = None
+        self.estimate = None
+        self.jira_url = None
+        self.jira_id = None
+        self.zendesk_url = None
+        self.zendesk_id = None
+        self.tasks = []
+        self.updated_fields = []
 
     def __str__(self):
-        return "Story(%r)" % self.__dict__
+        return "Story(%r)" % self.ToDictionary()
 
     def _add_to_updated_fields(self, field_name):
         if field_name not in self.updated_fields:
@@ -477,45 +2529,12 @@ class Story(object):
 
     @staticmethod
     def FromCsv(row):
-        "Receives a Story from Pivotal Tracker's exported CSV and converts into a Story Object"
+        """Receives a Story from Pivotal Tracker's exported CSV and converts into a Story Object.
 
-        def parse_datetime(parsable_date):
-            if parsable_date in (None, ""):
-                return None
-            when = time.strptime(parsable_date, '%b %d, %Y')
-            # calendar.timegm treats the tuple as GMT
-            output = calendar.timegm(when)
-            return output
-
-        # these are the expected columns
-        #   0     1        2         3            4                  5                6             7           8                9             10             11          12              13             14     15            16             17          18          19
-        # ['Id', 'Story', 'Labels', 'Iteration', 'Iteration Start', 'Iteration End', 'Story Type', 'Estimate', 'Current State', 'Created at', 'Accepted at', 'Deadline', 'Requested By', 'Description', 'URL', 'Zendesk ID', 'Integration', 'Owned By', 'Owned By', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Comment', 'Task', 'Task Status', 'Task', 'Task Status']
-
-        the_story_dict = {}
-        the_story_dict["story_id"] = int(row[0])
-        the_story_dict["iteration_number"] = row[3]
-        the_story_dict["created_at"] = parse_datetime(row[9])
-        the_story_dict["updated_at"] = parse_datetime(row[10])
-        the_story_dict["deadline"] = parse_datetime(row[11])
-        the_story_dict["labels"] = row[2].strip().replace(" ","").split(",")
-        if "" in the_story_dict["labels"]:
-            the_story_dict["labels"].remove("")
-
-        the_story_dict["url"] = row[14]
-        the_story_dict["requested_by"] = row[12]
-        the_story_dict["owned_by"] = row[17]
-        the_story_dict["story_type"] = row[6]
-        the_story_dict["current_state"] = row[8]
-        the_story_dict["description"] = row[13]
-        the_story_dict["name"] = row[1]
-        the_story_dict["estimate"] = row[7]
-        the_story_dict["zendesk_id"] = row[15]
-
-        for key in the_story_dict.keys():
-            if the_story_dict[key] == "":
-                the_story_dict[key] = None
-
-        return Story.FromJson(the_story_dict)
+        The row must have the columns of StoryCsvReader.TRACKER_HEADER, in
+        that order; StoryCsvReader reads rows in any column order.
+        """
+        return StoryCsvReader.Default().Read(row)
 
     @staticmethod
     def FromJson(as_json):
@@ -530,21 +2549,19 @@ class Story(object):
             #we assume it's either a json string or a dictionary
             parsed = json.loads(as_json)
         else:
-            parsed = as_json
-
-        #labels
-        if "labels" in parsed:
-            parsed["labels"] = set(parsed["labels"]) # it comes as list in JSON
-
-        if "tasks" in parsed:
-            json_tasks = parsed["tasks"]
-            parsed["tasks"] = []
-            for json_task in json_tasks:
-                the_task = Task.FromDictionary(json_task)
-                parsed["tasks"].append(the_task)
+            parsed = as_json
 
         story = Story()
-        story.__dict__ = parsed
+        for field_name, value in parsed.items():
+            if field_name not in Story.__slots__:
+                continue
+            if field_name == "labels" and value is not None:
+                value = set(value) # it comes as list in JSON
+            elif field_name == "tasks":
+                value = [Task.FromDictionary(json_task) for json_task in value or []]
+            elif field_name == "updated_fields":
+                value = list(value or [])
+            setattr(story, field_name, value)
         return story
 
     @staticmethod
@@ -564,10 +2581,10 @@ class Story(object):
         story = Story()
         story.story_id = int(parsed.getElementsByTagName('id')[0].firstChild.data)
         story.url = parsed.getElementsByTagName('url')[0].firstChild.data
-        story.owned_by = XmlDocument.GetDataFromTag(parsed, 'owned_by')
+        story.owned_by = _intern(XmlDocument.GetDataFromTag(parsed, 'owned_by'))
         story.created_at = XmlDocument.ParseDatetimeIntoSecs(parsed, 'created_at')
         story.updated_at = XmlDocument.ParseDatetimeIntoSecs(parsed, 'updated_at')
-        story.requested_by = XmlDocument.GetDataFromTag(parsed, 'requested_by')
+        story.requested_by = _intern(XmlDocument.GetDataFromTag(parsed, 'requested_by'))
         iteration = XmlDocument.GetDataFromTag(parsed, 'number')
         story.jira_url = XmlDocument.GetDataFromTag(parsed, 'jira_url')
         story.jira_id = XmlDocument.GetDataFromTag(parsed, 'jira_id')
@@ -585,19 +2602,21 @@ class Story(object):
                 storyTaskDictionary['description'] = XmlNodeList.toText(task.getElementsByTagName("description"))
                 storyTaskDictionary['complete'] = XmlNodeList.toBool(task.getElementsByTagName('complete'))
                 storyTaskDictionary['id'] = XmlNodeList.toText(task.getElementsByTagName("id"))
-                story.tasks.append(Task.FromDictionary(storyTaskDictionary))
+                story_task = Task.FromDictionary(storyTaskDictionary)
+                story_task.MarkClean()
+                story.tasks.append(story_task)
 
         story.SetStoryType(
-                parsed.getElementsByTagName('story_type')[0].firstChild.data)
+                _intern(parsed.getElementsByTagName('story_type')[0].firstChild.data))
         story.SetCurrentState(
-                parsed.getElementsByTagName('current_state')[0].firstChild.data)
+                _intern(parsed.getElementsByTagName('current_state')[0].firstChild.data))
         story.SetName(XmlDocument.GetDataFromTag(parsed, 'name'))
         story.SetDescription(XmlDocument.GetDataFromTag(parsed, 'description'))
         story.SetDeadline(XmlDocument.ParseDatetimeIntoSecs(parsed, 'deadline'))
 
         estimate = XmlDocument.GetDataFromTag(parsed, 'estimate')
         if estimate is not None:
-                story.estimate = estimate
+                story.estimate = _intern(estimate)
         labels = XmlDocument.GetDataFromTag(parsed, 'labels')
         if labels is not None:
             story.AddLabelsFromString(labels)
@@ -606,7 +2625,7 @@ class Story(object):
         return story
 
     def ClearUpdatedFields(self):
-        self.updated_fields = []
+        del self.updated_fields[:]
 
     # Immutable fields
     def GetStoryId(self):
@@ -745,7 +2764,7 @@ class Story(object):
         if self.labels is None:
             self.labels = set()
 
-        self.labels = self.labels.union([x.strip() for x in labels.split(',')])
+        self.labels = self.labels.union([_intern(x.strip()) for x in labels.split(',')])
 
     def GetLabelsAsString(self):
         """Returns the labels as a comma delimited list of strings."""
@@ -782,6 +2801,7 @@ class Story(object):
                 return "\"{}\"".format(value)
             return value
 
+        fields = dict((field_name, getattr(self, field_name)) for field_name in self.CSV_FIELDS)
         output = ""
         first = True
         for one_field in self.CSV_FIELDS:
@@ -790,32 +2810,50 @@ class Story(object):
                 template = "{}{}"
             else:
                 template = "{},{}"
-            output = template.format(output, csv_helper(self.__dict__, one_field))
+            output = template.format(output, csv_helper(fields, one_field))
         return output
 
-    def ToJson(self):
-        """Converts this Story to a JSON string."""
-        #labels
-        labels_backup = self.labels
-        if self.labels != None:
-            self.labels = list(self.labels)
-        #tasks
-        tasks_backup = self.tasks
-        self.tasks = []
-        for task in tasks_backup:
-            self.tasks.append(task.ToDictionary())
+    def ToDictionary(self):
+        """Returns the fields of this Story as JSON-compatible data."""
+        fields = dict((field_name, getattr(self, field_name)) for field_name in self.__slots__)
+        if self.labels is not None:
+            fields['labels'] = sorted(self.labels)
+        fields['tasks'] = [task.ToDictionary() for task in self.tasks or []]
+        fields['updated_fields'] = list(self.updated_fields)
+        return fields
 
-        #done
-        output =  json.dumps(self.__dict__, sort_keys=True, indent=4)
+    def ToJson(self, compact=False):
+        """Converts this Story to a JSON string.
 
-        self.labels = labels_backup
-        self.tasks = tasks_backup
-        return output
+        Args:
+            compact: write a single line, leaving out fields that are None and
+                empty task and updated field lists (FromJson restores them),
+                as in JSON Lines files.
+        """
+        fields = self.ToDictionary()
+        if not compact:
+            return json.dumps(fields, sort_keys=True, indent=4)
+        for field_name, value in list(fields.items()):
+            # An empty label set is kept: FromJson would make it None.
+            if value is None or (value == [] and field_name in ('tasks', 'updated_fields')):
+                del fields[field_name]
+        return json.dumps(fields, sort_keys=True, separators=(',', ':'))
+
+    def ToXml(self, include_tasks=False):
+        """Converts this Story to an XML string.
 
-    def ToXml(self):
-        """Converts this Story to an XML string."""
-        doc = xml.dom.getDOMImplementation().createDocument(None, 'story', None)
-        story = doc.getElementsByTagName('story')[0]
+        Args:
+            include_tasks: nest the tasks in a <tasks> element, so creating
+                the story creates them too. Updates write tasks separately.
+        """
+        parts = [_XML_DECLARATION]
+        self._WriteXml(parts, include_tasks)
+        return ''.join(parts).encode('utf-8')
+
+    def _WriteXml(self, parts, include_tasks=False):
+        """Appends the <story> element, as strings, to a list."""
+        start = len(parts)
+        parts.append('<story>')
 
         # Most fields are just simple strings or ints, so we treat them all in the
         # same way.
@@ -824,35 +2862,32 @@ class Story(object):
                 continue
             v = getattr(self, field_name)
             if v is not None:
-                new_tag = doc.createElement(field_name)
-                new_tag.appendChild(doc.createTextNode(str(v)))
-                story.appendChild(new_tag)
+                parts.append('<%s>%s</%s>' % (field_name, _XmlEscape(str(v)), field_name))
 
         # Labels are represented internally as sets.
         if self.labels is not None:
-            labels_tag = doc.createElement('labels')
-            labels_tag.appendChild(doc.createTextNode(self.GetLabelsAsString()))
-            story.appendChild(labels_tag)
+            parts.append('<labels>%s</labels>' % _XmlEscape(self.GetLabelsAsString()))
 
         # Dates are special
-        DATE_FORMAT = '%Y/%m/%d %H:%M:%S UTC'
-
         if self.deadline:
-            formatted = time.strftime(DATE_FORMAT, time.gmtime(self.deadline))
-            deadline_tag = doc.createElement('deadline')
-            deadline_tag.setAttribute('type', 'datetime')
-            deadline_tag.appendChild(doc.createTextNode(formatted))
-            story.appendChild(deadline_tag)
+            parts.append('<deadline type="datetime">%s</deadline>' %
+                         TrackerDatetime.Format(self.deadline))
 
         if self.created_at and "created_at" in self.updated_fields:
-            formatted = time.strftime(DATE_FORMAT, time.gmtime(self.created_at))
-            created_at_tag = doc.createElement('created_at')
-            created_at_tag.setAttribute('type', 'datetime')
-            created_at_tag.appendChild(doc.createTextNode(formatted))
-            story.appendChild(created_at_tag)
+            parts.append('<created_at type="datetime">%s</created_at>' %
+                         TrackerDatetime.Format(self.created_at))
+
+        if include_tasks and self.GetTasks():
+            parts.append('<tasks type="array">')
+            for task in self.GetTasks():
+                task._WriteXml(parts)
+            parts.append('</tasks>')
 
         #don't update updated_at field as it will autoupdate
-        return doc.toxml('utf-8')
+        if len(parts) == start + 1:
+            parts[start] = '<story/>'
+        else:
+            parts.append('</story>')
 
 class Task(object):
     """Represents a Story Task.
@@ -869,25 +2904,54 @@ class Task(object):
     TASK_PATH = "/tasks"
     UPDATE_TASK_METHOD = "PUT"
 
+    __slots__ = ('descriptor', '_saved')
+
     def __init__(self):
         self.descriptor = dict(description='', complete=False, id=None)
+        # _Saveable() as Tracker has it, or None if not known to be saved.
+        self._saved = None
 
     @staticmethod
     def FromDictionary(dictionary):
+        """Creates a (dirty) Task from a descriptor or from ToDictionary()."""
         task = Task()
-        if "description" in dictionary and "complete" in dictionary and "id" in dictionary:
-            task.descriptor['description'] = dictionary['description']
-            task.descriptor['complete'] = dictionary['complete']
-            task.descriptor['id'] = dictionary['id']
-        else:
-            task.__dict__ = dictionary
+        if 'descriptor' in dictionary:
+            dictionary = dictionary['descriptor']
+        for key in ('description', 'complete', 'id'):
+            if key in dictionary:
+                task.descriptor[key] = dictionary[key]
+        return task
+
+    @staticmethod
+    def FromXml(as_xml):
+        """Parses a <task> document from the Tracker API into a clean Task."""
+        parsed = minidom.parseString(as_xml)
+        task = Task.FromDictionary(dict(
+                description=XmlNodeList.toText(parsed.getElementsByTagName('description')),
+                complete=XmlNodeList.toBool(parsed.getElementsByTagName('complete')),
+                id=XmlNodeList.toText(parsed.getElementsByTagName('id'))))
+        task.MarkClean()
         return task
 
     def ToDictionary(self):
-        return self.__dict__
+        return {'descriptor': self.descriptor}
 
-    def ToJson(self):
-        """Converts this Story to a JSON string."""
+    def IsDirty(self):
+        """Returns True if the task is new or changed since it was saved."""
+        return self.descriptor.get('id') is None or self._Saveable() != self._saved
+
+    def MarkClean(self):
+        """Records that Tracker has the task as it is now."""
+        self._saved = self._Saveable()
+
+    def _Saveable(self):
+        descriptor = self.descriptor
+        return (descriptor.get('description'), descriptor.get('complete'), descriptor.get('id'))
+
+    def ToJson(self, compact=False):
+        """Converts this Task to a JSON string."""
+        if compact:
+            return json.dumps(self.ToDictionary(), sort_keys=True, separators=(',', ':'))
         output =  json.dumps(self.ToDictionary(), sort_keys=True, indent=4)
         return output
 
@@ -906,19 +2970,15 @@ class Task(object):
         return Task.FromDictionary(as_json)
 
     def ToXml(self):
-        doc = xml.dom.getDOMImplementation().createDocument(None, 'task', None)
-        task = doc.getElementsByTagName('task')[0]
-        task_description = doc.createElement('description')
-        task_description.appendChild(doc.createTextNode(self.descriptor['description']))
-        task.appendChild(task_description)
-        task_complete = doc.createElement('complete')
-        task_complete.setAttribute('type', 'boolean')
-        if self.descriptor['complete']:
-            task_complete.appendChild(doc.createTextNode('true'))
-        else:
-            task_complete.appendChild(doc.createTextNode('false'))
-        task.appendChild(task_complete)
-        return doc.toxml('utf-8')
+        parts = [_XML_DECLARATION]
+        self._WriteXml(parts)
+        return ''.join(parts).encode('utf-8')
+
+    def _WriteXml(self, parts):
+        """Appends the <task> element, as strings, to a list."""
+        parts.append('<task><description>%s</description><complete type="boolean">%s</complete></task>' % (
+                _XmlEscape(self.descriptor['description']),
+                'true' if self.descriptor['complete'] else 'false'))
 
     def GetSubPath(self):
         path = self.TASK_PATH
@@ -951,10 +3011,13 @@ class Comment(object):
     value for the field or that it has not been parsed from XML.  Comment updating
     not supported yet.
     """
-    id = None
-    text = ""
-    author = ""
-    noted_at = None
+    __slots__ = ('id', 'text', 'author', 'noted_at')
+
+    def __init__(self):
+        self.id = None
+        self.text = ""
+        self.author = ""
+        self.noted_at = None
 
     def GetId(self):
         return self.id
@@ -992,41 +3055,947 @@ class Comment(object):
         return comments
 
 
+class StoryCsvReader(object):
+    """Turns rows of a Tracker CSV export into Stories.
+
+    Columns are found by their header once, so their order and any extra
+    Comment or Task columns don't matter. When a header appears twice, as
+    'Owned By' does, the first column is used.
+    """
+    # the first columns of a Tracker export; Comment and Task columns follow
+    TRACKER_HEADER = ['Id', 'Story', 'Labels', 'Iteration', 'Iteration Start', 'Iteration End',
+                      'Story Type', 'Estimate', 'Current State', 'Created at', 'Accepted at',
+                      'Deadline', 'Requested By', 'Description', 'URL', 'Zendesk ID',
+                      'Integration', 'Owned By', 'Owned By']
+    FIELDS = {
+        'Id': 'story_id',
+        'Story': 'name',
+        'Labels': 'labels',
+        'Iteration': 'iteration_number',
+        'Story Type': 'story_type',
+        'Estimate': 'estimate',
+        'Current State': 'current_state',
+        'Created at': 'created_at',
+        'Accepted at': 'updated_at',
+        'Deadline': 'deadline',
+        'Requested By': 'requested_by',
+        'Description': 'description',
+        'URL': 'url',
+        'Zendesk ID': 'zendesk_id',
+        'Owned By': 'owned_by',
+    }
+    DATE_FIELDS = ('created_at', 'updated_at', 'deadline')
+    _default = None
+
+    def __init__(self, header):
+        """Constructor.
+
+        Args:
+            header: the header row of the export.
+        Raises:
+            ValueError: if there is no Id column.
+        """
+        self.header = list(header)
+        self.columns = {}
+        for index, title in enumerate(self.header):
+            field_name = self.FIELDS.get(title.strip())
+            if field_name is not None and field_name not in self.columns:
+                self.columns[field_name] = index
+        if 'story_id' not in self.columns:
+            raise ValueError('no Id column in the CSV header: %r' % self.header)
+
+    @staticmethod
+    def Default():
+        """Returns the reader of rows with the columns of TRACKER_HEADER."""
+        if StoryCsvReader._default is None:
+            StoryCsvReader._default = StoryCsvReader(StoryCsvReader.TRACKER_HEADER)
+        return StoryCsvReader._default
+
+    def Read(self, row):
+        """Returns the Story of a row."""
+        return Story.FromJson(self.ReadFields(row))
+
+    def ReadFields(self, row):
+        """Returns the Story fields of a row, as a dictionary for Story.FromJson."""
+        the_story_dict = dict((field_name, None) for field_name in self.FIELDS.values())
+        the_story_dict['labels'] = []
+        for field_name, index in self.columns.items():
+            value = row[index] if index < len(row) else ""
+            if field_name == 'labels':
+                labels = value.strip().replace(" ", "").split(",")
+                the_story_dict['labels'] = [label for label in labels if label != ""]
+            elif value == "":
+                continue
+            elif field_name == 'story_id':
+                the_story_dict['story_id'] = int(value)
+            elif field_name in self.DATE_FIELDS:
+                the_story_dict[field_name] = TrackerDatetime.ParseCsvDate(value)
+            else:
+                the_story_dict[field_name] = value
+        return the_story_dict
+
+
+def _CsvReader(lines):
+    delimiter=','
+    quotechar='"'
+    if sys.version_info[0] == 2: #python2
+        delimiter = delimiter.encode("ascii")
+        quotechar = quotechar.encode("ascii")
+    return csv.reader(lines, delimiter=delimiter, quotechar=quotechar)
+
+
+def IterCsvFile(csvfilename, encoding=None):
+    """Yields the Stories of a CSV file generated by PivotalTracker.
+
+    Args:
+        csvfilename: the file name.
+        encoding: of the file; the locale's if not given, as for open().
+    """
+    if encoding is None:
+        content_file = open(csvfilename, 'r')
+    else:
+        content_file = io.open(csvfilename, 'r', encoding=encoding)
+    with content_file:
+        reader = _CsvReader(content_file)
+        story_reader = None
+        for row in reader:
+            if story_reader is None:
+                story_reader = StoryCsvReader(row)
+                continue
+            yield story_reader.Read(row)
+
+
+def _CsvRecordOffsets(csvfilename, chunk_size):
+    """Splits a CSV file into byte ranges that hold whole records.
+
+    A newline ends a record unless it is inside a quoted field, which is
+    the case when an odd number of quotes precede it.
+
+    Returns:
+        the offsets where the header ends, where each range after it starts
+        and the file size, in that order.
+    """
+    with open(csvfilename, 'rb') as content_file:
+        size = os.fstat(content_file.fileno()).st_size
+        if size == 0:
+            return [0]
+        data = mmap.mmap(content_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offsets = []
+            in_quotes = False
+            position = target = 0
+            while target < size:
+                in_quotes ^= data[position:target].count(b'"') % 2 == 1
+                position = target
+                while True:
+                    newline = data.find(b'\n', position)
+                    if newline < 0:
+                        break
+                    in_quotes ^= data[position:newline].count(b'"') % 2 == 1
+                    position = newline + 1
+                    if not in_quotes:
+                        break
+                if newline < 0:
+                    break
+                offsets.append(position)
+                target = min(position + chunk_size, size)
+        finally:
+            data.close()
+    if not offsets or offsets[-1] != size:
+        offsets.append(size)
+    return offsets
+
+
+def _ReadCsvRange(job):
+    """Returns the Story fields of the records from start to end of a CSV file.
+
+    Dictionaries are returned rather than Stories because they are several
+    times faster to pickle.
+    """
+    csvfilename, header, start, end, encoding = job
+    with open(csvfilename, 'rb') as content_file:
+        content_file.seek(start)
+        data = content_file.read(end - start)
+    story_reader = StoryCsvReader(header)
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding=encoding)
+    return [story_reader.ReadFields(row) for row in _CsvReader(lines)]
+
+
+def IterCsvFileParallel(csvfilename, processes=None, chunk_size=4 * 1024 * 1024,
+                        encoding=None):
+    """Yields the Stories of a CSV file generated by PivotalTracker, parsed by
+    a pool of processes.
+
+    The file is split into ranges of about chunk_size bytes at record
+    boundaries, and each range is parsed by a worker process. Stories come
+    in file order and are the same as IterCsvFile's, provided quotes only
+    appear in quoted fields, as in Tracker exports, and the encoding is
+    ASCII compatible.
+
+    Args:
+        csvfilename: the file name.
+        processes: the number of worker processes; one per CPU by default.
+        chunk_size: the approximate bytes parsed by a worker at a time.
+        encoding: of the file; the locale's if not given, as for open().
+    """
+    offsets = _CsvRecordOffsets(csvfilename, chunk_size)
+    if len(offsets) < 2:
+        return
+    with open(csvfilename, 'rb') as content_file:
+        header_data = content_file.read(offsets[0])
+    header = next(_CsvReader(io.TextIOWrapper(io.BytesIO(header_data), encoding=encoding)))
+    StoryCsvReader(header) # fails early without an Id column
+    jobs = [(csvfilename, header, start, end, encoding)
+            for start, end in zip(offsets, offsets[1:])]
+    if len(jobs) == 1:
+        for the_story_dict in _ReadCsvRange(jobs[0]):
+            yield Story.FromJson(the_story_dict)
+        return
+    with futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        for the_story_dicts in executor.map(_ReadCsvRange, jobs):
+            for the_story_dict in the_story_dicts:
+                yield Story.FromJson(the_story_dict)
+
+
+class StoryXmlWriter(object):
+    """Serializes many stories to XML, reusing one buffer.
+
+    ToXml(story) returns the same bytes as story.ToXml(include_tasks).
+    """
+
+    def __init__(self, include_tasks=False):
+        self.include_tasks = include_tasks
+        self._parts = [_XML_DECLARATION]
+
+    def ToXml(self, story):
+        parts = self._parts
+        del parts[1:]
+        story._WriteXml(parts, self.include_tasks)
+        return ''.join(parts).encode('utf-8')
+
+    def ToXmls(self, stories):
+        """Yields the XML of each story of an iterable."""
+        for story in stories:
+            yield self.ToXml(story)
+
+
+class StoryCsvWriter(object):
+    """Writes stories to a file as CSV rows, as they come.
+
+    Unlike Story.ToCsv, fields are quoted by csv.writer and labels are
+    written as a comma-separated list. Stories can be fed from
+    Tracker.IterStories, so only a page of them is in memory at a time.
+    """
+
+    def __init__(self, output, fields=None, header=True, **csv_options):
+        """Constructor.
+
+        Args:
+            output: a file opened for writing text, with newline=''. On
+                Python 2, a file opened for writing bytes ('wb'); cells are
+                written UTF-8 encoded.
+            fields: names of the Story fields to write; Story.CSV_FIELDS by
+                default.
+            header: write a first row with the field names.
+            csv_options: passed on to csv.writer.
+        """
+        self.fields = tuple(fields or Story.CSV_FIELDS)
+        for field_name in self.fields:
+            if field_name not in Story.__slots__:
+                raise ValueError("Story has no field %s" % field_name)
+        self.writer = csv.writer(output, **csv_options)
+        self.count = 0
+        if header:
+            self._WriteRow(self.fields)
+
+    def _WriteRow(self, row):
+        if sys.version_info[0] == 2: #python2's csv only writes bytes
+            row = [value.encode('utf-8') if isinstance(value, unicode) else value
+                   for value in row]
+        self.writer.writerow(row)
+
+    def WriteStory(self, story):
+        row = []
+        for field_name in self.fields:
+            value = getattr(story, field_name)
+            if value is None:
+                value = ''
+            elif field_name == 'labels':
+                value = story.GetLabelsAsString()
+            elif field_name == 'tasks':
+                value = ','.join(task.GetDictionary()['description'] for task in value)
+            row.append(value)
+        self._WriteRow(row)
+        self.count += 1
+
+    def WriteStories(self, stories):
+        """Writes every story of an iterable; returns how many there were."""
+        count = self.count
+        for story in stories:
+            self.WriteStory(story)
+        return self.count - count
+
+
+# File name endings of JSON Lines files, as the export and import scripts use them.
+JSON_LINES_EXTENSIONS = ('.jsonl', '.jsonl.gz', '.ndjson', '.ndjson.gz')
+
+
+def OpenJsonLinesFile(filename, mode='r'):
+    """Opens a JSON Lines file as UTF-8 text.
+
+    Files whose name ends in .gz are written gzip compressed; gzip files are
+    recognized by their contents when reading.
+
+    Args:
+        mode: 'r', 'w' or 'a'.
+    """
+    compressed = filename.endswith('.gz')
+    if mode == 'r':
+        with open(filename, 'rb') as raw:
+            compressed = raw.read(2) == b'\x1f\x8b'
+    if compressed:
+        binary = gzip.open(filename, mode + 'b')
+        if sys.version_info[0] == 2 and mode == 'r': #python2's GzipFile has no read1
+            binary = io.BufferedReader(binary)
+        return io.TextIOWrapper(binary, encoding='utf-8')
+    return io.open(filename, mode, encoding='utf-8')
+
+
+def IterJsonLines(lines):
+    """Yields a Story for every line of JSON Lines (a file or other iterable)."""
+    for line in lines:
+        if line.strip():
+            yield Story.FromJson(line)
+
+
+def IterJsonLinesFile(filename):
+    """Yields the Stories of a JSON Lines file, reading it as they're used."""
+    with OpenJsonLinesFile(filename) as lines:
+        for story in IterJsonLines(lines):
+            yield story
+
+
+class StoryJsonLinesWriter(object):
+    """Writes stories as JSON Lines: one compact JSON object per line.
+
+    Read them back with IterJsonLines or IterJsonLinesFile.
+    """
+
+    def __init__(self, output):
+        """Constructor.
+
+        Args:
+            output: a text file, for example from OpenJsonLinesFile(name, 'w').
+        """
+        self.output = output
+        self.count = 0
+
+    def WriteStory(self, story):
+        self.output.write(story.ToJson(compact=True))
+        self.output.write('\n')
+        self.count += 1
+
+    def WriteStories(self, stories):
+        """Writes every story of an iterable; returns how many there were."""
+        count = self.count
+        for story in stories:
+            self.WriteStory(story)
+        return self.count - count
+
+
+class StorySnapshot(object):
+    """A versioned binary format for saving and quickly reloading stories.
+
+    A snapshot is a header followed by named columns:
+
+        magic b'PYTRACKERSNAP', format version (uint16), story count (uint64),
+        column count (uint32), then for each column: name length (uint16),
+        UTF-8 name, type code ('q' int64, 'B' uint8 or 's' bytes), item
+        count (uint64) and the items, little-endian.
+
+    Each distinct string is stored once, in a NUL separated table
+    ('strings', with 'string_offsets' in characters), and referenced by
+    index, so owners, states and types cost 8 bytes per story. Every other
+    field is a pair of columns: a tag ('<field>.tag': None, int, string,
+    ...) and a fixed-width int64 value, the int itself for ids, estimates
+    and timestamps. Labels and updated fields refer to a table of the
+    distinct combinations ('label_sets', 'updated_field_lists'), and tasks
+    are columns of their own, with offsets per story.
+
+    Readers look columns up by name and ignore the ones they don't know, so
+    fields can be added without changing FORMAT_VERSION; it only changes
+    when existing columns change meaning, and newer versions are rejected.
+    """
+    MAGIC = b'PYTRACKERSNAP'
+    FORMAT_VERSION = 1
+    # in the order _Stories unpacks them; never reorder or rename
+    FIELDS = ('story_id', 'iteration_number', 'created_at', 'updated_at', 'deadline', 'url',
+              'requested_by', 'owned_by', 'story_type', 'current_state', 'description',
+              'name', 'estimate', 'jira_url', 'jira_id', 'zendesk_url', 'zendesk_id')
+    TASK_FIELDS = ('description', 'complete', 'id')
+    # tags of a value column
+    NONE, INT, STRING, FLOAT, BOOL, JSON = range(6)
+    _ITEM_SIZES = {'q': 8, 'B': 1, 's': 1}
+
+    def __init__(self):
+        self.columns = collections.OrderedDict()
+        self.strings = []
+        self._string_indexes = {}
+        self._combinations = {}
+
+    def _StringIndex(self, value):
+        index = self._string_indexes.get(value)
+        if index is None:
+            index = self._string_indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def _Column(self, name, typecode=_INT64):
+        if name not in self.columns:
+            self.columns[name] = array.array(typecode)
+        return self.columns[name]
+
+    def _AddValue(self, name, value):
+        tags = self._Column(name + '.tag', 'B')
+        values = self._Column(name)
+        if value is None:
+            tags.append(self.NONE)
+            values.append(-1)
+        elif isinstance(value, bool):
+            tags.append(self.BOOL)
+            values.append(int(value))
+        elif isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+            tags.append(self.INT)
+            values.append(value)
+        elif _is_string(value):
+            tags.append(self.STRING)
+            values.append(self._StringIndex(value))
+        elif isinstance(value, float):
+            tags.append(self.FLOAT)
+            values.append(struct.unpack('<q', struct.pack('<d', value))[0])
+        else:
+            tags.append(self.JSON)
+            values.append(self._StringIndex(json.dumps(value, sort_keys=True)))
+
+    def _AddCombination(self, name, table, values):
+        """Adds the index of a combination of strings in a table, -1 for None."""
+        if values is None:
+            self._Column(name).append(-1)
+            return
+        key = (table, tuple(values))
+        index = self._combinations.get(key)
+        if index is None:
+            items = self._Column(table)
+            items.extend(self._StringIndex(value) for value in values)
+            offsets = self._Column(table + '.offsets')
+            index = self._combinations[key] = len(offsets) - 1
+            offsets.append(len(items))
+        self._Column(name).append(index)
+
+    def Add(self, story):
+        for field_name in self.FIELDS:
+            self._AddValue(field_name, getattr(story, field_name))
+        self._AddCombination('labels', 'label_sets',
+                             None if story.labels is None else sorted(story.labels))
+        self._AddCombination('updated_fields', 'updated_field_lists', story.updated_fields)
+        for task in story.tasks or []:
+            for key in self.TASK_FIELDS:
+                self._AddValue('tasks.' + key, task.descriptor.get(key))
+            self._Column('tasks.clean', 'B').append(not task.IsDirty())
+        self._Column('tasks.offsets').append(len(self._Column('tasks.clean', 'B')))
+
+    @staticmethod
+    def Write(stories, output):
+        """Writes stories to a binary file; returns how many there were."""
+        snapshot = StorySnapshot()
+        for field_name in StorySnapshot.FIELDS:
+            snapshot._Column(field_name + '.tag', 'B')
+            snapshot._Column(field_name)
+        for name in ('labels', 'label_sets', 'updated_fields', 'updated_field_lists'):
+            snapshot._Column(name)
+        for name in ('label_sets.offsets', 'updated_field_lists.offsets', 'tasks.offsets'):
+            snapshot._Column(name).append(0)
+        for key in StorySnapshot.TASK_FIELDS:
+            snapshot._Column('tasks.%s.tag' % key, 'B')
+            snapshot._Column('tasks.' + key)
+        snapshot._Column('tasks.clean', 'B')
+        count = 0
+        for story in stories:
+            snapshot.Add(story)
+            count += 1
+
+        string_offsets = array.array(_INT64, [0])
+        for value in snapshot.strings:
+            string_offsets.append(string_offsets[-1] + len(value) + 1)
+        columns = list(snapshot.columns.items())
+        columns.append(('string_offsets', string_offsets))
+        columns.append(('strings', '\0'.join(snapshot.strings).encode('utf-8')))
+
+        output.write(StorySnapshot.MAGIC)
+        output.write(struct.pack('<HQI', StorySnapshot.FORMAT_VERSION, count, len(columns)))
+        for name, column in columns:
+            encoded_name = name.encode('utf-8')
+            typecode = column.typecode if isinstance(column, array.array) else 's'
+            if typecode == _INT64:
+                typecode = 'q'
+            output.write(struct.pack('<H', len(encoded_name)))
+            output.write(encoded_name)
+            output.write(struct.pack('<cQ', typecode.encode('ascii'), len(column)))
+            if typecode == 's':
+                output.write(column)
+                continue
+            if sys.byteorder == 'big':
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            output.write(_ArrayToBytes(column))
+        return count
+
+    @staticmethod
+    def _ReadExactly(data, size):
+        chunk = data.read(size)
+        if len(chunk) != size:
+            raise ValueError('truncated story snapshot')
+        return chunk
+
+    @staticmethod
+    def Read(data):
+        """Reads the stories of a binary file written by Write.
+
+        Raises:
+            ValueError: if it's not a snapshot, it's truncated, or it has a
+                newer format version.
+        """
+        read = StorySnapshot._ReadExactly
+        if data.read(len(StorySnapshot.MAGIC)) != StorySnapshot.MAGIC:
+            raise ValueError('not a story snapshot')
+        version, count, column_count = struct.unpack('<HQI', read(data, 14))
+        if version > StorySnapshot.FORMAT_VERSION:
+            raise ValueError('story snapshot format %d is newer than %d' %
+                             (version, StorySnapshot.FORMAT_VERSION))
+        columns = {}
+        for i in range(column_count):
+            name = read(data, struct.unpack('<H', read(data, 2))[0]).decode('utf-8')
+            typecode, length = struct.unpack('<cQ', read(data, 9))
+            typecode = typecode.decode('ascii')
+            raw = read(data, length * StorySnapshot._ITEM_SIZES[typecode])
+            if typecode == 's':
+                columns[name] = raw
+                continue
+            column = array.array(_INT64 if typecode == 'q' else typecode)
+            _ArrayFromBytes(column, raw)
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns[name] = column
+
+        # Nothing read is garbage, so don't let the allocations trigger
+        # collections that walk every object made so far.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return StorySnapshot()._Stories(columns, count)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _Stories(self, columns, count):
+        self.columns = columns
+        text = columns.get('strings', b'').decode('utf-8')
+        offsets = columns.get('string_offsets', [0])
+        if text.count('\0') == len(offsets) - 2:
+            self.strings = text.split('\0') if len(offsets) > 1 else []
+        else: # strings with NULs
+            self.strings = [text[start:end - 1] for start, end in zip(offsets, offsets[1:])]
+        # the value of NONE tags is -1
+        self.strings.append(None)
+
+        fields = [self._Values(field_name, count) for field_name in self.FIELDS]
+        labels = [None if label_set is None else set(label_set)
+                  for label_set in self._Combinations('labels', 'label_sets', count)]
+        updated_fields = [list(field_names or ()) for field_names in
+                          self._Combinations('updated_fields', 'updated_field_lists', count)]
+
+        task_count = len(columns.get('tasks.clean', ()))
+        tasks = []
+        new_task = Task.__new__
+        for clean, description, complete, task_id in zip(
+                columns.get('tasks.clean', ()),
+                *[self._Values('tasks.' + key, task_count) for key in self.TASK_FIELDS]):
+            task = new_task(Task)
+            task.descriptor = {'description': description, 'complete': complete, 'id': task_id}
+            # as MarkClean() would
+            task._saved = (description, complete, task_id) if clean else None
+            tasks.append(task)
+        task_offsets = columns.get('tasks.offsets', [0] * (count + 1))
+        story_tasks = [tasks[start:end] for start, end in zip(task_offsets, task_offsets[1:])]
+
+        # Unrolled, as this is most of the time spent; FIELDS are in this order.
+        stories = []
+        new_story = Story.__new__
+        for (story_id, iteration_number, created_at, updated_at, deadline, url, requested_by,
+             owned_by, story_type, current_state, description, name, estimate, jira_url,
+             jira_id, zendesk_url, zendesk_id, story_labels, story_task_list,
+             story_updated_fields) in zip(*(fields + [labels, story_tasks, updated_fields])):
+            story = new_story(Story)
+            story.story_id = story_id
+            story.iteration_number = iteration_number
+            story.created_at = created_at
+            story.updated_at = updated_at
+            story.deadline = deadline
+            story.labels = story_labels
+            story.url = url
+            story.requested_by = requested_by
+            story.owned_by = owned_by
+            story.story_type = story_type
+            story.current_state = current_state
+            story.description = description
+            story.name = name
+            story.estimate = estimate
+            story.jira_url = jira_url
+            story.jira_id = jira_id
+            story.zendesk_url = zendesk_url
+            story.zendesk_id = zendesk_id
+            story.tasks = story_task_list
+            story.updated_fields = story_updated_fields
+            stories.append(story)
+        return stories
+
+    @staticmethod
+    def _Pick(table, indexes):
+        if len(indexes) == 1:
+            return [table[indexes[0]]]
+        return list(operator.itemgetter(*indexes)(table)) if indexes else []
+
+    def _Values(self, name, count):
+        """Decodes a value column; all None if it's missing."""
+        if name not in self.columns:
+            return [None] * count
+        tags, values = self.columns[name + '.tag'], self.columns[name]
+        raw_tags = _ArrayToBytes(tags) # bytes.count is much faster than array.count
+        counts = dict((tag, raw_tags.count(struct.pack('B', tag)))
+                      for tag in (self.NONE, self.INT, self.STRING, self.BOOL))
+        nones = counts[self.NONE]
+        if nones == len(tags):
+            return [None] * len(tags)
+        if counts[self.STRING] + nones == len(tags):
+            return self._Pick(self.strings, values)
+        if counts[self.INT] == len(tags):
+            return values.tolist()
+        if counts[self.INT] + nones == len(tags):
+            return [value if tag else None for tag, value in zip(tags, values)]
+        if counts[self.BOOL] == len(tags):
+            return [value == 1 for value in values]
+        return [self.strings[value] if tag == self.STRING else
+                value if tag == self.INT else
+                None if tag == self.NONE else
+                self._OtherValue(tag, value)
+                for tag, value in zip(tags, values)]
+
+    def _OtherValue(self, tag, value):
+        if tag == self.BOOL:
+            return bool(value)
+        if tag == self.FLOAT:
+            return struct.unpack('<d', struct.pack('<q', value))[0]
+        if tag == self.JSON:
+            return json.loads(self.strings[value])
+        raise ValueError('unknown value tag %d in story snapshot' % tag)
+
+    def _Combinations(self, name, table, count):
+        """Decodes a column of combination indexes into tuples of strings."""
+        if name not in self.columns:
+            return [()] * count
+        items = self._Pick(self.strings, self.columns[table])
+        offsets = self.columns[table + '.offsets']
+        # the index of None is -1
+        combinations = [tuple(items[start:end])
+                        for start, end in zip(offsets, offsets[1:])] + [None]
+        return self._Pick(combinations, self.columns[name])
+
+
 class StoryList(object):
     def __init__(self, stories=None):
         if stories != None:
             self.stories = stories
         else:
             self.stories = []
+        # PivotalStatistics kept up to date by AddStory and RemoveStory,
+        # once KeepStatistics was called.
+        self._stats = None
 
-    def ImportFromCsvFile(self, csvfilename):
-        """Imports from the CSV file that is generated by PivotalTracker"""
-        stories = []
-        with open(csvfilename, 'r') as content_file:
-            delimiter=','
-            quotechar='"'
-            if sys.version_info[0] == 2: #python2
-                delimiter = delimiter.encode("ascii")
-                quotechar = quotechar.encode("ascii")
-
-            reader = csv.reader(content_file, delimiter=delimiter, quotechar=quotechar)
-            headerrow = None
-            for row in reader:
-                if headerrow is None:
-                    headerrow = row
-                    continue
-                story = Story.FromCsv(row)
-                self.stories.append(story)
+    def ImportFromCsvFile(self, csvfilename, processes=1):
+        """Imports from the CSV file that is generated by PivotalTracker
+
+        Args:
+            csvfilename: the file name.
+            processes: parse the file with a pool of this many processes (see
+                IterCsvFileParallel); None means one per CPU.
+        """
+        if processes == 1:
+            self.stories.extend(IterCsvFile(csvfilename))
+        else:
+            self.stories.extend(IterCsvFileParallel(csvfilename, processes))
 
+    def SaveSnapshot(self, path):
+        """Saves the stories to a binary snapshot file (see StorySnapshot)."""
+        with open(path, 'wb') as output:
+            StorySnapshot.Write(self.stories, output)
 
-    def RenderStatistics(self):
+    @staticmethod
+    def LoadSnapshot(path):
+        """Returns a StoryList of the stories in a snapshot file from SaveSnapshot."""
+        with open(path, 'rb') as data:
+            return StoryList(StorySnapshot.Read(data))
+
+    def AddStory(self, story):
+        self.stories.append(story)
+        if self._stats is not None:
+            self._stats.AddStory(story)
+
+    def RemoveStory(self, story):
+        self.stories.remove(story)
+        if self._stats is not None:
+            self._stats.RemoveStory(story)
+
+    def GetStatistics(self):
+        """Returns the PivotalStatistics of the stories, computed afresh."""
         stats = PivotalStatistics()
         for story in self.stories:
-            stats.CalculateStatistics(story)
-        return stats.RenderStatistics()
+            stats.AddStory(story)
+        return stats
+
+    def KeepStatistics(self):
+        """Returns PivotalStatistics that AddStory and RemoveStory keep up to date.
+
+        They are computed when this is called. Changes made to self.stories
+        or to the stories themselves in any other way are not seen until
+        KeepStatistics is called again.
+        """
+        self._stats = self.GetStatistics()
+        return self._stats
+
+    def RenderStatistics(self):
+        return self.GetStatistics().RenderStatistics()
+
+
+class TrackerFilter(object):
+    """A parsed Tracker search filter, as far as it can be evaluated locally.
+
+    Understands the terms scripts use: label:, type:, owner:, state:, id:
+    and includedone:, with "quoted" values and comma separated alternatives
+    (id:1,2,3 or state:started,finished). Terms are and'ed, alternatives
+    or'ed, and labels, owners, states and types compared case-insensitively;
+    owners are matched by name. Like Tracker, accepted stories are left out
+    unless the filter has includedone:true (Tracker still returns those of
+    the current iteration, which a local copy can't tell apart).
+
+    Anything else, such as free text or modified_since:, is kept in
+    `unsupported`; such filters can only be answered by Tracker.
+    """
+
+    # Filter keyword -> Story attribute.
+    FIELDS = {
+        'label': 'labels',
+        'type': 'story_type',
+        'owner': 'owned_by',
+        'state': 'current_state',
+        'id': 'story_id',
+    }
+
+    _TERM = re.compile(r'(\w+):((?:"[^"]*"|[^\s",]+)(?:,(?:"[^"]*"|[^\s",]+))*)|("[^"]*"|\S+)')
+    _VALUE = re.compile(r'"([^"]*)"|([^\s",]+)')
+
+    def __init__(self, terms=None, include_done=False, unsupported=None):
+        # [(attribute, set of values)]
+        self.terms = terms or []
+        self.include_done = include_done
+        self.unsupported = unsupported or []
+
+    @staticmethod
+    def Parse(filt):
+        """Returns the TrackerFilter of a filter string (None is no filter)."""
+        result = TrackerFilter()
+        for match in TrackerFilter._TERM.finditer(filt or ''):
+            keyword, values = match.group(1), match.group(2)
+            field = TrackerFilter.FIELDS.get(keyword and keyword.lower())
+            if keyword is None or (field is None and keyword.lower() != 'includedone'):
+                result.unsupported.append(match.group(0))
+                continue
+            values = [value.group(1) if value.group(1) is not None else value.group(2)
+                      for value in TrackerFilter._VALUE.finditer(values)]
+            if keyword.lower() == 'includedone':
+                result.include_done = values[-1].lower() == 'true'
+            elif field == 'story_id':
+                try:
+                    result.terms.append((field, set(int(value) for value in values)))
+                except ValueError:
+                    result.unsupported.append(match.group(0))
+            else:
+                result.terms.append((field, set(value.lower() for value in values)))
+        return result
+
+    def IsLocal(self):
+        """Whether the filter can be evaluated without Tracker."""
+        return not self.unsupported
+
+    def Matches(self, story):
+        """Whether a story satisfies the filter."""
+        if not self.IsLocal():
+            raise ValueError('filter needs Tracker: %s' % ' '.join(self.unsupported))
+        if not self.include_done and story.current_state == 'accepted':
+            return False
+        for field, values in self.terms:
+            if field == 'labels':
+                if not values.intersection(label.lower() for label in story.labels or ()):
+                    return False
+            elif field == 'story_id':
+                if story.story_id not in values:
+                    return False
+            else:
+                value = getattr(story, field)
+                if value is None or value.lower() not in values:
+                    return False
+        return True
+
+
+class StoryIndex(object):
+    """Answers Tracker search filters from a local copy of the stories.
+
+    Stories are kept by id with secondary indexes (value -> set of story
+    ids) on labels, owner, state and type, so a filter costs a few set
+    operations instead of a request:
+
+        index = StoryIndex.FromStore(StoryArchive('stories.archive'), project_id)
+        stories = index.Query('label:week106 includedone:true', fallback=tracker)
+
+    Results keep the order in which the stories were added. Stories changed
+    in place must be added again to be reindexed.
+    """
+
+    INDEXED_FIELDS = ('labels', 'owned_by', 'current_state', 'story_type')
+
+    def __init__(self, stories=()):
+        self.stories = {}
+        self._order = {}
+        self._next_position = 0
+        self._indexes = dict((field, {}) for field in self.INDEXED_FIELDS)
+        for story in stories:
+            self.AddStory(story)
+
+    @staticmethod
+    def FromStoryList(story_list):
+        return StoryIndex(story_list.stories)
+
+    @staticmethod
+    def FromStore(store, project_id):
+        """Indexes the stories of a project kept in a StoryArchive or SqliteStoryCache."""
+        return StoryIndex(store.IterStories(project_id))
+
+    def __len__(self):
+        return len(self.stories)
+
+    @staticmethod
+    def _Keys(story, field):
+        if field == 'labels':
+            return set(label.lower() for label in story.labels or ())
+        value = getattr(story, field)
+        if value is None:
+            return ()
+        return (value.lower(),)
+
+    def _Unindex(self, story):
+        for field, index in self._indexes.items():
+            for key in self._Keys(story, field):
+                ids = index[key]
+                ids.discard(story.GetStoryId())
+                if not ids:
+                    del index[key]
+
+    def AddStory(self, story):
+        """Indexes a story, replacing an indexed story with the same id.
+
+        A replaced story keeps its place in the results; a new one goes last.
+        """
+        story_id = story.GetStoryId()
+        if story_id in self.stories:
+            self._Unindex(self.stories[story_id])
+        else:
+            self._order[story_id] = self._next_position
+            self._next_position += 1
+        self.stories[story_id] = story
+        for field, index in self._indexes.items():
+            for key in self._Keys(story, field):
+                index.setdefault(key, set()).add(story_id)
+
+    def RemoveStory(self, story_id):
+        """Drops a story from the index, if it is there.
+
+        The story loses its place: if it is added again it goes last.
+        """
+        story = self.stories.pop(story_id, None)
+        if story is None:
+            return
+        del self._order[story_id]
+        self._Unindex(story)
+
+    def _Lookup(self, field, values):
+        """Returns a new set of the ids of the stories with any of the values."""
+        if field == 'story_id':
+            return set(story_id for story_id in values if story_id in self.stories)
+        index = self._indexes[field]
+        ids = set()
+        for value in values:
+            ids.update(index.get(value, ()))
+        return ids
+
+    def QueryIds(self, filt):
+        """Returns the ids of the stories satisfying a filter, in index order.
+
+        Args:
+            filt: a Tracker search filter, or a TrackerFilter.
+        Raises:
+            ValueError if the filter can't be evaluated locally.
+        """
+        if not isinstance(filt, TrackerFilter):
+            filt = TrackerFilter.Parse(filt)
+        if not filt.IsLocal():
+            raise ValueError('filter needs Tracker: %s' % ' '.join(filt.unsupported))
+        matches = [self._Lookup(field, values) for field, values in filt.terms]
+        if matches:
+            matches.sort(key=len)
+            ids = matches[0].intersection(*matches[1:])
+        else:
+            ids = self.stories
+        if not filt.include_done:
+            accepted = self._indexes['current_state'].get('accepted', ())
+            ids = [story_id for story_id in ids if story_id not in accepted]
+        return sorted(ids, key=self._order.__getitem__)
+
+    def Query(self, filt=None, fallback=None):
+        """Returns the Stories satisfying a filter, like Tracker.GetStories.
+
+        Args:
+            filt: a Tracker search filter.
+            fallback: a Tracker to send the filters that can't be evaluated
+                locally to; without one, they raise ValueError.
+        Returns:
+            List of Story().
+        """
+        parsed = TrackerFilter.Parse(filt)
+        if not parsed.IsLocal() and fallback is not None:
+            return fallback.GetStories(filt)
+        return [self.stories[story_id] for story_id in self.QueryIds(parsed)]
 
 
 class PivotalStatistics(object):
+    """Per-owner counts of accepted stories, as rendered by RenderStatistics.
+
+    Statistics are sums, so they can be computed in parts and combined:
+    stories may be added and removed one by one, statistics of disjoint sets
+    of stories (shards of a project, worker processes) merged with Merge,
+    and partial results passed around with ToJson/FromJson.
+    """
+
+    FIELDS = ("zendesk", "feature", "feature_points", "bug", "chore")
+
     def __init__(self, css_table_title="", css_odd_row="", css_even_row=""):
         self.the_stats = {}
         self.css_table_title = css_table_title
@@ -1042,33 +4011,99 @@ class PivotalStatistics(object):
         self.the_stats[owner]["bug"] = 0
         self.the_stats[owner]["chore"] = 0
 
-    def CalculateStatistics(self, the_story):
+    @staticmethod
+    def _Score(the_story):
+        """Returns (owner, {field: amount}) for a story, or None if it doesn't count."""
         if the_story.GetCurrentState() != "accepted":
-            return
+            return None
         story_type = the_story.GetStoryType()
         if story_type == "release":
-            return
+            return None
+        if story_type not in ("feature", "bug", "chore"):
+            raise KeyError(story_type)
 
         owner = the_story.GetOwnedBy()
         if owner in (None, ""):
             owner = "None"
 
-        if owner not in self.the_stats:
+        scores = {story_type: 1}
+        if story_type == "feature":
+            scores["feature_points"] = int(the_story.GetEstimate())
+        if the_story.GetZendeskKey() != None:
+            scores["zendesk"] = 1
+        return owner, scores
+
+    def _Add(self, owner, scores, sign=1):
+        owner_stats = self.the_stats.get(owner)
+        if sign < 0:
+            if owner_stats is None or any(owner_stats[field] < amount
+                                          for field, amount in scores.items()):
+                raise ValueError("%s's statistics don't include these stories" % owner)
+        elif owner_stats is None:
             self._init_stats(owner)
+            owner_stats = self.the_stats[owner]
+        for field, amount in scores.items():
+            owner_stats[field] += sign * amount
+            self.the_stats["total"][field] += sign * amount
+        if sign < 0 and not any(owner_stats[field] for field in ("feature", "bug", "chore")):
+            del self.the_stats[owner]
 
-        story_points = 1
-        self.the_stats[owner][story_type] += 1
-        self.the_stats["total"][story_type] += 1
+    def CalculateStatistics(self, the_story):
+        self.AddStory(the_story)
 
-        if story_type == "feature":
-            story_points = int(the_story.GetEstimate())
-            self.the_stats[owner]["feature_points"] += story_points
-            self.the_stats["total"]["feature_points"] += story_points
+    def AddStory(self, the_story):
+        """Counts a story."""
+        score = self._Score(the_story)
+        if score is not None:
+            self._Add(*score)
 
-        if the_story.GetZendeskKey() != None:
-            self.the_stats[owner]["zendesk"] += 1
-            self.the_stats["total"]["zendesk"] += 1
+    def RemoveStory(self, the_story):
+        """Stops counting a story that was added before.
+
+        Raises:
+            ValueError if the story could not have been counted.
+        """
+        score = self._Score(the_story)
+        if score is not None:
+            self._Add(score[0], score[1], -1)
+
+    def ApplyChange(self, old_story, new_story):
+        """Updates the counts for a story that changed.
 
+        Args:
+            old_story: the story as it was counted, or None if it is new.
+            new_story: the story now, or None if it was deleted.
+        """
+        if old_story is not None:
+            self.RemoveStory(old_story)
+        if new_story is not None:
+            self.AddStory(new_story)
+
+    def Merge(self, other):
+        """Adds the counts of another PivotalStatistics, of other stories.
+
+        Returns:
+            self
+        """
+        for owner, owner_stats in other.the_stats.items():
+            if owner != "total":
+                self._Add(owner, owner_stats)
+        return self
+
+    def ToJson(self):
+        """Converts the counts to a JSON string, for FromJson."""
+        return json.dumps([[owner, owner_stats] for owner, owner_stats in self.the_stats.items()
+                           if owner != "total"], sort_keys=True)
+
+    @staticmethod
+    def FromJson(as_json):
+        """Parses counts written by ToJson into a PivotalStatistics."""
+        if _is_string(as_json):
+            as_json = json.loads(as_json)
+        stats = PivotalStatistics()
+        for owner, owner_stats in as_json:
+            stats._Add(owner, dict((field, owner_stats[field]) for field in stats.FIELDS))
+        return stats
 
     def GetRawStatistics(self):
         return self.the_stats
@@ -1106,3 +4141,321 @@ class PivotalStatistics(object):
         self._render_stats_helper("total", "")
         self.output +="</table><br>Disclaimer: ZenDesk tickets are Features/Bugs/Chores, so they are not added to the total. Only accepted stories are considered."
         return self.output
+
+
+_NAN = float('nan')
+
+
+def _ToFloat(value):
+    """Returns value as a float, or NaN if it is missing or not a number."""
+    if value is None:
+        return _NAN
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return _NAN
+
+
+class _Categories(object):
+    """Dictionary encoding: each distinct value is stored once, with a code."""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def Encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class StoryTable(object):
+    """Stories stored column by column, for fast aggregation.
+
+    Ids are kept in an integer array and estimates and times (secs since
+    epoch) in float arrays, with NaN where a story has no value. Owners,
+    requesters, states and types are dictionary encoded: the column holds
+    an integer code per story and `categories` maps codes to values. Labels
+    are encoded the same way, with the labels of story i at
+    label_codes[label_offsets[i]:label_offsets[i + 1]].
+
+    Tables are built from any iterable of stories, so stories streamed by
+    Tracker.IterStories need not be held as Story objects:
+
+        table = StoryTable.FromStories(tracker.IterStories('label:week106'))
+
+    Where, GroupCount and GroupSum work on whole columns, with numpy when it
+    is installed and in plain Python otherwise.
+    """
+
+    NUMERIC_COLUMNS = ('estimate', 'created_at', 'updated_at', 'deadline', 'iteration_number')
+    CATEGORICAL_COLUMNS = ('owned_by', 'requested_by', 'current_state', 'story_type')
+
+    def __init__(self):
+        self.story_ids = array.array(_INT64)
+        self.numeric = dict((name, array.array('d')) for name in self.NUMERIC_COLUMNS)
+        self.codes = dict((name, array.array('i')) for name in self.CATEGORICAL_COLUMNS)
+        self.categories = dict((name, _Categories())
+                               for name in self.CATEGORICAL_COLUMNS + ('labels',))
+        self.has_zendesk = array.array('b')
+        self.label_offsets = array.array(_INT64, [0])
+        self.label_codes = array.array('i')
+
+    @staticmethod
+    def FromStories(stories):
+        """Builds a table from an iterable of Story()."""
+        table = StoryTable()
+        for story in stories:
+            table.Append(story)
+        return table
+
+    @staticmethod
+    def FromStoryList(story_list):
+        return StoryTable.FromStories(story_list.stories)
+
+    @staticmethod
+    def FromCsvFile(csvfilename):
+        """Builds a table from a CSV file generated by PivotalTracker."""
+        return StoryTable.FromStories(IterCsvFile(csvfilename))
+
+    def __len__(self):
+        return len(self.story_ids)
+
+    def Append(self, story):
+        story_id = story.GetStoryId()
+        self.story_ids.append(-1 if story_id is None else int(story_id))
+        for name in self.NUMERIC_COLUMNS:
+            self.numeric[name].append(_ToFloat(getattr(story, name)))
+        for name in self.CATEGORICAL_COLUMNS:
+            self.codes[name].append(self.categories[name].Encode(getattr(story, name)))
+        self.has_zendesk.append(story.GetZendeskKey() is not None)
+        labels = self.categories['labels']
+        for label in sorted(story.labels or ()):
+            self.label_codes.append(labels.Encode(label))
+        self.label_offsets.append(len(self.label_codes))
+
+    def Column(self, name):
+        """Returns a column as stored: an array of ids, numbers or codes."""
+        if name == 'story_id':
+            return self.story_ids
+        if name == 'has_zendesk':
+            return self.has_zendesk
+        if name in self.numeric:
+            return self.numeric[name]
+        return self.codes[name]
+
+    def Values(self, name):
+        """Returns a column as a list of values, decoding categories."""
+        if name == 'labels':
+            values = self.categories['labels'].values
+            offsets = self.label_offsets
+            return [set(values[code] for code in self.label_codes[offsets[i]:offsets[i + 1]])
+                    for i in range(len(self))]
+        column = self.Column(name)
+        if name in self.codes:
+            values = self.categories[name].values
+            return [values[code] for code in column]
+        return list(column)
+
+    def Where(self, mask=None, **conditions):
+        """Returns a mask selecting the stories that meet all conditions.
+
+        Args:
+            mask: an optional mask from a previous call to narrow down.
+            conditions: column=value or column=(values...) for categorical
+                columns, label=name for stories with that label, and
+                has_zendesk=True or False.
+        Returns:
+            a sequence with a boolean per story; a numpy array if numpy is
+            installed.
+        """
+        for name, wanted in conditions.items():
+            if name == 'has_zendesk':
+                mask = self._And(mask, self._Select(self.has_zendesk, set([int(bool(wanted))])))
+                continue
+            if name == 'label':
+                mask = self._And(mask, self._HasLabel(wanted))
+                continue
+            if _is_string(wanted) or wanted is None:
+                wanted = (wanted,)
+            codes = self.categories[name].codes
+            mask = self._And(mask, self._Select(
+                    self.codes[name], set(codes[value] for value in wanted if value in codes)))
+        if mask is None:
+            mask = self._Select(self.has_zendesk, set([0, 1]))
+        return mask
+
+    def GroupCount(self, by, where=None):
+        """Returns an OrderedDict of {value: number of stories}.
+
+        Args:
+            by: a categorical column, or 'labels'.
+            where: an optional mask from Where().
+        Returns:
+            counts for the values present in the selected stories, in the
+            order their first story appears.
+        """
+        return self._Group(by, None, where)
+
+    def GroupSum(self, by, column, where=None):
+        """Returns an OrderedDict of {value: sum of the numeric column}."""
+        return self._Group(by, self.numeric[column], where)
+
+    def CalculateStatistics(self, stats=None):
+        """Returns a PivotalStatistics as filled by CalculateStatistics on every story.
+
+        Args:
+            stats: a PivotalStatistics to fill, for its CSS settings.
+        Raises:
+            KeyError if an accepted story has an unknown type, and ValueError
+            if an accepted feature has no estimate, as PivotalStatistics would.
+        """
+        if stats is None:
+            stats = PivotalStatistics()
+        if numpy is None:
+            by_owner = self._ScoreOwners()
+        else:
+            by_owner = self._ScoreOwnersWithNumpy()
+        for owner, scores in by_owner:
+            stats._Add("None" if owner in (None, "") else owner, scores)
+        return stats
+
+    def _CheckScoredTypes(self, story_types):
+        for story_type in story_types:
+            if story_type not in ('feature', 'bug', 'chore', 'release'):
+                raise KeyError(story_type)
+
+    def _ScoreOwnersWithNumpy(self):
+        """Returns [(owner, {field: value})] in the order owners appear."""
+        accepted = self.Where(current_state='accepted')
+        self._CheckScoredTypes(self.GroupCount('story_type', accepted))
+        scored = self.Where(accepted, story_type=('feature', 'bug', 'chore'))
+        features = self.Where(scored, story_type='feature')
+        points = self.GroupSum('owned_by', 'estimate', features)
+        for owner, total in points.items():
+            if total != total: # NaN
+                raise ValueError("an accepted feature of %s has no estimate" % owner)
+
+        columns = [(story_type, self.GroupCount('owned_by', self.Where(scored, story_type=story_type)))
+                   for story_type in ('feature', 'bug', 'chore')]
+        columns.append(('feature_points', points))
+        columns.append(('zendesk', self.GroupCount('owned_by', self.Where(scored, has_zendesk=True))))
+        return [(owner, dict((field, int(by_owner.get(owner, 0))) for field, by_owner in columns))
+                for owner in self.GroupCount('owned_by', scored)]
+
+    def _ScoreOwners(self):
+        """Like _ScoreOwnersWithNumpy, in a single pass over the columns."""
+        accepted = self.categories['current_state'].codes.get('accepted', -1)
+        story_types = self.categories['story_type'].values
+        self._CheckScoredTypes(story_types[code] for code, state in
+                               zip(self.codes['story_type'], self.codes['current_state'])
+                               if state == accepted)
+        release = self.categories['story_type'].codes.get('release', -1)
+        feature = self.categories['story_type'].codes.get('feature', -1)
+        scores = {}
+        order = []
+        for owner, state, story_type, estimate, zendesk in zip(
+                self.codes['owned_by'], self.codes['current_state'], self.codes['story_type'],
+                self.numeric['estimate'], self.has_zendesk):
+            if state != accepted or story_type == release:
+                continue
+            owner_scores = scores.get(owner)
+            if owner_scores is None:
+                owner_scores = scores[owner] = dict(
+                        zendesk=0, feature=0, feature_points=0, bug=0, chore=0)
+                order.append(owner)
+            owner_scores[story_types[story_type]] += 1
+            if story_type == feature:
+                if estimate != estimate: # NaN
+                    raise ValueError("an accepted feature of %s has no estimate" %
+                                     self.categories['owned_by'].values[owner])
+                owner_scores['feature_points'] += int(estimate)
+            if zendesk:
+                owner_scores['zendesk'] += 1
+        owners = self.categories['owned_by'].values
+        return [(owners[owner], scores[owner]) for owner in order]
+
+    def RenderStatistics(self):
+        return self.CalculateStatistics().RenderStatistics()
+
+    # Column operations; numpy works on the arrays in place.
+
+    def _Select(self, column, codes):
+        if numpy is not None:
+            return numpy.isin(numpy.frombuffer(column, column.typecode), list(codes))
+        return array.array('b', [code in codes for code in column])
+
+    @staticmethod
+    def _And(mask, other):
+        if mask is None:
+            return other
+        if numpy is not None:
+            return numpy.logical_and(mask, other)
+        return array.array('b', [a and b for a, b in zip(mask, other)])
+
+    def _HasLabel(self, label):
+        code = self.categories['labels'].codes.get(label)
+        if numpy is not None:
+            has = numpy.zeros(len(self), dtype=bool)
+            if code is not None:
+                offsets = numpy.frombuffer(self.label_offsets, self.label_offsets.typecode)
+                positions = numpy.flatnonzero(
+                        numpy.frombuffer(self.label_codes, self.label_codes.typecode) == code)
+                has[numpy.searchsorted(offsets, positions, side='right') - 1] = True
+            return has
+        offsets = self.label_offsets
+        return array.array('b', [code is not None and code in self.label_codes[offsets[i]:offsets[i + 1]]
+                                 for i in range(len(self))])
+
+    def _Group(self, by, values, where):
+        if by == 'labels':
+            codes = self.label_codes
+            if where is not None:
+                where = self._PerLabel(where)
+            if values is not None:
+                values = self._PerLabel(values)
+        else:
+            codes = self.codes[by]
+        categories = self.categories[by].values
+        if numpy is not None:
+            codes = numpy.frombuffer(codes, codes.typecode)
+            if values is not None:
+                values = numpy.asarray(values) if not isinstance(values, array.array) else (
+                        numpy.frombuffer(values, values.typecode))
+            if where is not None:
+                where = numpy.asarray(where, dtype=bool)
+                codes = codes[where]
+                if values is not None:
+                    values = values[where]
+            present, first = numpy.unique(codes, return_index=True)
+            totals = numpy.bincount(codes, weights=values, minlength=len(categories))
+            result = collections.OrderedDict()
+            for code in present[numpy.argsort(first)]:
+                total = totals[code]
+                result[categories[code]] = int(total) if values is None else float(total)
+            return result
+
+        totals = [0] * len(categories)
+        seen = [False] * len(categories)
+        order = []
+        for i, code in enumerate(codes):
+            if where is not None and not where[i]:
+                continue
+            if not seen[code]:
+                seen[code] = True
+                order.append(code)
+            totals[code] += 1 if values is None else values[i]
+        return collections.OrderedDict((categories[code], totals[code]) for code in order)
+
+    def _PerLabel(self, per_story):
+        """Repeats a per-story sequence once per label of the story."""
+        offsets = self.label_offsets
+        if numpy is not None:
+            return numpy.repeat(numpy.asarray(per_story),
+                                numpy.diff(numpy.frombuffer(offsets, offsets.typecode)))
+        repeated = []
+        for i, value in enumerate(per_story):
+            repeated.extend([value] * (offsets[i + 1] - offsets[i]))
+        return repeated
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+"""asyncio client for the Tracker API.
+
+AsyncTracker mirrors the blocking Tracker class with coroutines and speaks
+HTTP/1.1 over asyncio streams, so it never blocks the event loop and needs
+no threads. It lives apart from pytracker because it requires Python 3.
+"""
+
+import asyncio
+import collections
+import ssl
+from urllib.parse import urlsplit
+
+from pytracker import (DEFAULT_BASE_API_URL, Comment, ContentDecoder, RetryPolicy,
+                       Story, Task, TransferStats, _TrackerRequests)
+
+
+class AsyncResponse(object):
+    """A fully read HTTP response."""
+
+    def __init__(self, status, reason, headers, body, url):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.url = url
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def geturl(self):
+        return self.url
+
+
+class _ServerClosed(ConnectionError):
+    """Raised when a connection is closed before a response starts."""
+
+
+class AsyncConnectionPool(object):
+    """Keep-alive HTTP/1.1 connections over asyncio streams.
+
+    Works like pytracker.HttpConnectionPool: idle connections are kept per
+    (scheme, host, port), at most `maxsize` of them, evicted after
+    `idle_timeout` seconds, and a request that fails on a reused connection
+    the server already closed is retried once on a new one.
+    """
+
+    def __init__(self, maxsize=100, idle_timeout=60, timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+
+    async def _Connect(self, key):
+        scheme, host, port = key
+        ssl_context = ssl.create_default_context() if scheme == 'https' else None
+        return await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=ssl_context), self.timeout)
+
+    def _GetIdle(self, key):
+        now = asyncio.get_running_loop().time()
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used <= self.idle_timeout and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _Release(self, key, conn):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            reader, writer = conn
+            idle.append((reader, writer, asyncio.get_running_loop().time()))
+        else:
+            conn[1].close()
+
+    def Close(self):
+        """Closes all idle connections."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for reader, writer, last_used in connections:
+                writer.close()
+
+    async def Request(self, method, url, headers, body=None):
+        """Sends a request and returns an AsyncResponse."""
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        default_port = 443 if scheme == 'https' else 80
+        port = parts.port or default_port
+        key = (scheme, parts.hostname, port)
+        host = parts.hostname if port == default_port else '%s:%d' % (parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn = self._GetIdle(key)
+        reused = conn is not None
+        if conn is None:
+            conn = await self._Connect(key)
+        try:
+            status, reason, response_headers, response_body, keep_alive = (
+                    await asyncio.wait_for(self._Send(conn, method, host, path, headers, body),
+                                           self.timeout))
+        except (_ServerClosed, ConnectionResetError, BrokenPipeError,
+                asyncio.IncompleteReadError):
+            conn[1].close()
+            if not reused:
+                raise
+            # The server dropped the idle connection; try once on a new one.
+            conn = await self._Connect(key)
+            try:
+                status, reason, response_headers, response_body, keep_alive = (
+                        await asyncio.wait_for(self._Send(conn, method, host, path, headers, body),
+                                               self.timeout))
+            except BaseException:
+                conn[1].close()
+                raise
+        except BaseException:
+            conn[1].close()
+            raise
+
+        if keep_alive:
+            self._Release(key, conn)
+        else:
+            conn[1].close()
+        return AsyncResponse(status, reason, response_headers, response_body, url)
+
+    @staticmethod
+    async def _Send(conn, method, host, path, headers, body):
+        reader, writer = conn
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host]
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        if body is not None or method in ('POST', 'PUT'):
+            lines.append('Content-Length: %d' % len(body or b''))
+        lines.extend(['', ''])
+        writer.write('\r\n'.join(lines).encode('latin-1') + (body or b''))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise _ServerClosed('connection closed before the response')
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        version, status = parts[0], int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (version == 'HTTP/1.1' and
+                      response_headers.get('connection', '').lower() != 'close')
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            response_body = b''
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass # trailers
+            response_body = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            response_body = await reader.readexactly(int(response_headers['content-length']))
+        else:
+            response_body = await reader.read()
+            keep_alive = False
+        return status, reason, response_headers, response_body, keep_alive
+
+
+class AsyncTracker(_TrackerRequests):
+    """asyncio Tracker API.
+
+    Offers awaitable versions of the Tracker methods. Requests, XML and
+    paging are shared with Tracker, so the Story and Comment objects
+    returned are the same as the blocking client's.
+    """
+
+    def __init__(self, project_id, token, base_api_url=DEFAULT_BASE_API_URL,
+                 max_concurrency=100, pool=None, retry_policy=None, rate_limiter=None):
+        """Constructor.
+
+        Args:
+            project_id: the Tracker ID (integer).
+            token: the API token.
+            base_api_url: the base URL of the HTTP API (with trailing /).
+            max_concurrency: maximum number of requests in flight.
+            pool: an AsyncConnectionPool, created if not given.
+            retry_policy: a pytracker.RetryPolicy; defaults to RetryPolicy().
+            rate_limiter: an optional pytracker.RateLimiter, which may be
+                shared with blocking Trackers.
+        """
+        self.project_id = project_id
+        self.base_api_url = base_api_url
+        self.token = token
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        if pool is None:
+            pool = AsyncConnectionPool(maxsize=max_concurrency)
+        self.pool = pool
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        # TransferStats of the most recent responses, oldest first.
+        self.transfer_stats = collections.deque(maxlen=100)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.Close()
+
+    def Close(self):
+        self.pool.Close()
+
+    async def _Api(self, the_request, method, body=None):
+        url = self._ApiUrl(the_request)
+        res = await self._Request(method, url, self._ApiHeaders(method, body), body)
+        decoder = ContentDecoder(res.getheader('Content-Encoding'))
+        data = decoder.Decompress(res.body) + decoder.Flush()
+        self.transfer_stats.append(TransferStats(method, url, res.status, decoder.encoding,
+                                                 decoder.wire_bytes, decoder.decoded_bytes))
+        if res.status >= 400:
+            raise self._ApiError(res.status, res.reason, url, data)
+        return data
+
+    async def _Request(self, method, url, headers, body):
+        """Sends the request, retrying as retry_policy allows."""
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.Reserve())
+            try:
+                async with self.semaphore:
+                    res = await self.pool.Request(method, url, headers, body)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                error = e
+                if isinstance(e, (asyncio.TimeoutError, asyncio.IncompleteReadError)):
+                    # A stalled or truncated response is retried like a reset
+                    # connection.
+                    error = ConnectionError(e)
+                if not self.retry_policy.ShouldRetry(method, attempt, error=error):
+                    raise
+                delay = self.retry_policy.GetDelay(attempt)
+            else:
+                if not self.retry_policy.ShouldRetry(method, attempt, status=res.status):
+                    return res
+                delay = self.retry_policy.GetDelay(attempt, res.getheader('Retry-After'))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def GetStory(self, story_id):
+        story_id = self._parse_story_id(story_id)
+        return self._DecodeStory(await self._Api('stories/%d' % story_id, 'GET'))
+
+    async def GetStories(self, filt=None):
+        """Fetch all Stories that satisfy the filter."""
+        stories = await self._Api(self._StoriesRequest(filt), 'GET')
+        return self._DecodeStoriesPage(stories)[0]
+
+    async def _GetStoryPage(self, filt, iteration, offset, limit):
+        if iteration is None:
+            response = await self._Api(self._StoriesRequest(filt, offset, limit), 'GET')
+            return self._DecodeStoriesPage(response)
+        response = await self._Api(self._IterationsRequest(iteration, offset, limit), 'GET')
+        return self._DecodeIterationsPage(response)
+
+    async def IterStories(self, filt=None, iteration=None, page_size=100, prefetch=True):
+        """Async iterator over the Stories that satisfy the filter.
+
+        Pages like Tracker.IterStories; with prefetch the next page is
+        requested while the caller consumes the current one.
+        """
+        offset = 0
+        pending = None
+        try:
+            while True:
+                if pending is None:
+                    page, count = await self._GetStoryPage(filt, iteration, offset, page_size)
+                else:
+                    page, count = await pending
+                    pending = None
+                offset += page_size
+                last_page = count < page_size
+                if not last_page and prefetch:
+                    pending = asyncio.ensure_future(
+                            self._GetStoryPage(filt, iteration, offset, page_size))
+                for story in page:
+                    yield story
+                if last_page:
+                    return
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def AddComment(self, story_id, comment):
+        if story_id is None:
+            return
+        await self._Api('stories/%d/notes' % story_id, 'POST', self._CommentXml(comment))
+
+    async def GetComments(self, story_id):
+        comments_xml = await self._Api('stories/%d/notes' % story_id, 'GET')
+        return Comment.ExtractAllFromXml(comments_xml)
+
+    async def AddNewStory(self, story):
+        """Persists a new story and its tasks to Tracker with a single POST."""
+        res = await self._Api('stories', 'POST', story.ToXml(include_tasks=True))
+        created = Story.FromXml(res)
+        for task in self._TasksNotCreated(created, story):
+            created.tasks.append(await self._WriteTask(created.GetStoryId(), task))
+        return created
+
+    async def UpdateStoryById(self, story_id, story):
+        """Persist changes to an existing story; see Tracker.UpdateStoryById."""
+        if story_id is None:
+            return None
+        res = await self._Api('stories/%d' % story_id, 'PUT', story.ToXml())
+        return Story.FromXml(res)
+
+    async def UpdateStory(self, story):
+        """Persists changes to an existing story; see Tracker.UpdateStory."""
+        if story.GetStoryId() is None:
+            return None
+        story_id = story.GetStoryId()
+        res = await self._Api('stories/%d' % story_id, 'PUT', story.ToXml())
+
+        dirty = [task for task in story.GetTasks() if task.IsDirty()]
+        written = await asyncio.gather(*[self._WriteTask(story_id, task) for task in dirty])
+        return self._MergeTasks(Story.FromXml(res.decode("utf-8")), story, written)
+
+    async def _WriteTask(self, story_id, task):
+        res = await self._Api('stories/%d%s' % (story_id, task.GetSubPath()),
+                              task.GetMethod(), task.ToXml())
+        saved = Task.FromXml(res)
+        if task.GetDictionary()['id'] is None:
+            task.GetDictionary()['id'] = saved.GetDictionary()['id']
+        task.MarkClean()
+        return saved
+
+    async def DeleteStory(self, story_id):
+        """Deletes a story by story ID."""
+        await self._Api('stories/%d' % story_id, 'DELETE', b"")
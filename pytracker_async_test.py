@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+"""Tests for pytracker_async."""
+
+import asyncio
+import re
+import threading
+import unittest
+
+import pytracker
+import pytracker_async
+from pytracker_test import STORY_XML, StoriesXml
+
+
+class FakeAsyncTrackerServer(object):
+    """An asyncio HTTP/1.1 stand-in for the Tracker API.
+
+    Like pytracker_test.FakeTrackerServer, but runs on the event loop of
+    the test, so no threads are involved. Routes map (method, path) to a
+    (status, body) tuple or to a callable taking (method, path, body).
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = 0
+        # the next `stalls` requests get no answer, and the next `truncations`
+        # responses are cut short
+        self.stalls = 0
+        self.truncations = 0
+
+    async def Start(self):
+        self.server = await asyncio.start_server(self._Serve, '127.0.0.1', 0,
+                                                 backlog=4096)
+        port = self.server.sockets[0].getsockname()[1]
+        self.base_api_url = 'http://127.0.0.1:%d/services/v3/' % port
+
+    async def Stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def AddRoute(self, method, the_request, response, project_id=1):
+        path = '/services/v3/projects/%d/%s' % (project_id, the_request)
+        self.routes[(method, path)] = response
+
+    async def _Serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests.append((method, path, headers, body))
+
+                if self.stalls:
+                    self.stalls -= 1
+                    await reader.read()
+                    break
+
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                self.in_flight -= 1
+
+                route = self.routes.get((method, path), (404, b'not found'))
+                if callable(route):
+                    route = route(method, path, body)
+                status, response_body = route
+                length = len(response_body)
+                if self.truncations:
+                    self.truncations -= 1
+                    length += 10
+                writer.write(b'HTTP/1.1 %d OK\r\nContent-Length: %d\r\n\r\n%s' % (
+                        status, length, response_body))
+                await writer.drain()
+                if length != len(response_body):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def StoryResponse(method, path, body):
+    story_id = int(re.findall(r'\d+', path)[-1])
+    return 200, (STORY_XML % (story_id, story_id, story_id)).encode('utf-8')
+
+
+def AsyncTest(coroutine_function):
+    """Runs a coroutine test method on the test's event loop."""
+    def Test(self):
+        self.loop.run_until_complete(coroutine_function(self))
+    Test.__name__ = coroutine_function.__name__
+    return Test
+
+
+class AsyncTrackerTest(unittest.TestCase):
+    # unittest.IsolatedAsyncioTestCase would need Python 3.8.
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        # debug mode makes thousands of connections very slow
+        self.loop.set_debug(False)
+        asyncio.set_event_loop(self.loop)
+        self.server = FakeAsyncTrackerServer()
+        self.loop.run_until_complete(self.server.Start())
+        self.tracker = pytracker_async.AsyncTracker(1, 'token', self.server.base_api_url)
+
+    def tearDown(self):
+        self.tracker.Close()
+        self.loop.run_until_complete(self.server.Stop())
+        # connections the server still serves
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    @AsyncTest
+    async def testGetStoryReusesConnection(self):
+        self.server.AddRoute('GET', 'stories/5', StoryResponse)
+        for _ in range(3):
+            story = await self.tracker.GetStory('https://www.pivotaltracker.com/story/show/5')
+            self.assertEqual(5, story.GetStoryId())
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual('token', self.server.requests[0][2]['x-trackertoken'])
+
+    @AsyncTest
+    async def testThousandsInFlightWithoutThreads(self):
+        threads = threading.active_count()
+        self.server.delay = 0.05
+        for story_id in range(2000):
+            self.server.AddRoute('GET', 'stories/%d' % story_id, StoryResponse)
+        tracker = pytracker_async.AsyncTracker(1, 'token', self.server.base_api_url,
+                                               max_concurrency=2000)
+        stories = await asyncio.gather(*[tracker.GetStory(i) for i in range(2000)])
+        tracker.Close()
+        self.assertEqual(list(range(2000)), [s.GetStoryId() for s in stories])
+        self.assertTrue(self.server.max_in_flight > 1000, self.server.max_in_flight)
+        self.assertEqual(threads, threading.active_count())
+
+    @AsyncTest
+    async def testSemaphoreBoundsConcurrency(self):
+        self.server.delay = 0.01
+        for story_id in range(50):
+            self.server.AddRoute('GET', 'stories/%d' % story_id, StoryResponse)
+        tracker = pytracker_async.AsyncTracker(1, 'token', self.server.base_api_url,
+                                               max_concurrency=5)
+        await asyncio.gather(*[tracker.GetStory(i) for i in range(50)])
+        tracker.Close()
+        self.assertEqual(5, self.server.max_in_flight)
+
+    @AsyncTest
+    async def testIterStories(self):
+        self.server.AddRoute('GET', 'stories?filter=label%3Afoo&limit=2', (200, StoriesXml([1, 2])))
+        self.server.AddRoute('GET', 'stories?filter=label%3Afoo&offset=2&limit=2', (200, StoriesXml([3])))
+        stories = [s.GetStoryId() async for s in self.tracker.IterStories('label:foo', page_size=2)]
+        self.assertEqual([1, 2, 3], stories)
+
+    @AsyncTest
+    async def testGetStories(self):
+        self.server.AddRoute('GET', 'stories?filter=type%3Abug', (200, StoriesXml([4, 5])))
+        stories = await self.tracker.GetStories('type:bug')
+        self.assertEqual([4, 5], [s.GetStoryId() for s in stories])
+
+    @AsyncTest
+    async def testUpdateAddAndDelete(self):
+        self.server.AddRoute('PUT', 'stories/7', StoryResponse)
+        self.server.AddRoute('POST', 'stories', lambda m, p, b: StoryResponse(m, 'stories/8', b))
+        self.server.AddRoute('DELETE', 'stories/7', (200, b''))
+        story = pytracker.Story()
+        story.SetName('wake up')
+        self.assertEqual(8, (await self.tracker.AddNewStory(story)).GetStoryId())
+        self.assertEqual(story.ToXml(), self.server.requests[-1][3])
+        changes = pytracker.Story()
+        changes.SetEstimate(3)
+        self.assertEqual(7, (await self.tracker.UpdateStoryById(7, changes)).GetStoryId())
+        await self.tracker.DeleteStory(7)
+        self.assertEqual('DELETE', self.server.requests[-1][0])
+
+    @AsyncTest
+    async def testComments(self):
+        notes = (b'<notes type="array"><note><id type="integer">3</id><text>hi</text>'
+                 b'<author>me</author><noted_at type="datetime">2012/04/27 19:44:46 UTC</noted_at>'
+                 b'</note></notes>')
+        self.server.AddRoute('GET', 'stories/7/notes', (200, notes))
+        self.server.AddRoute('POST', 'stories/7/notes', (200, b''))
+        await self.tracker.AddComment(7, 'a < b')
+        self.assertEqual(b'<note><text>a &lt; b</text></note>', self.server.requests[-1][3])
+        comments = await self.tracker.GetComments(7)
+        self.assertEqual(['hi'], [c.GetText() for c in comments])
+
+    @AsyncTest
+    async def testHttpErrorRaisesTrackerApiException(self):
+        with self.assertRaises(pytracker.TrackerApiException):
+            await self.tracker.GetStory(404)
+
+    @AsyncTest
+    async def testRetriesStalledAndTruncatedResponses(self):
+        self.server.AddRoute('GET', 'stories/5', StoryResponse)
+        tracker = pytracker_async.AsyncTracker(
+                1, 'token', self.server.base_api_url,
+                pool=pytracker_async.AsyncConnectionPool(timeout=0.2),
+                retry_policy=pytracker.RetryPolicy(max_retries=3, backoff=0))
+        self.server.stalls = 1
+        self.server.truncations = 1
+        self.assertEqual(5, (await tracker.GetStory(5)).GetStoryId())
+        self.assertEqual(3, len(self.server.requests))
+        self.server.truncations = 10
+        with self.assertRaises(asyncio.IncompleteReadError):
+            await tracker.GetStory(5)
+        tracker.Close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,8 +18,99 @@
  
 __author__ = 'dcoker@google.com (Doug Coker)' 
  
+import copy
+import csv
+import email.utils
+import io
+import math
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest 
+import zlib
+from xml.dom import minidom
 import pytracker 
+
+try:
+    from unittest import mock
+except ImportError: #python2
+    import mock
+
+try:
+    from http import server as http_server
+    import socketserver
+except ImportError: #python2
+    import BaseHTTPServer as http_server
+    import SocketServer as socketserver
+
+
+class FakeTrackerServer(object):
+    """A local HTTP/1.1 stand-in for the Tracker API.
+
+    Responses are looked up in `routes` by (method, path) and may be a
+    (status, headers, body) tuple or a callable taking the handler and
+    returning one. Every request is recorded in `requests` and every accepted
+    TCP connection is counted in `connections`.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+        fake = self
+
+        class Handler(http_server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                fake.connections += 1
+                http_server.BaseHTTPRequestHandler.setup(self)
+
+            def _Handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.body = self.rfile.read(length) if length else b''
+                fake.requests.append((self.command, self.path, self.headers, self.body))
+                route = fake.routes.get((self.command, self.path))
+                if route is None:
+                    route = (404, {}, b'not found')
+                if callable(route):
+                    route = route(self)
+                status, headers, body = route
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _Handle
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http_server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_api_url = 'http://127.0.0.1:%d/services/v3/' % self.server.server_address[1]
+
+    def Path(self, the_request, project_id=1):
+        return '/services/v3/projects/%d/%s' % (project_id, the_request)
+
+    def AddRoute(self, method, the_request, response, project_id=1):
+        self.routes[(method, self.Path(the_request, project_id))] = response
+
+    def Stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
  
 class StoryTest(unittest.TestCase): 
     STORY_A = """ 
@@ -205,6 +296,46 @@ class StoryTest(unittest.TestCase):
         self.assertEquals(b'<?xml version="1.0" encoding="utf-8"?><story><created_at type="datetime">2010/11/19 08:03:22 UTC</created_at></story>', 
                                             story.ToXml())
         
+    def testSlotsAndPerInstanceState(self):
+        a = pytracker.Story()
+        b = pytracker.Story()
+        a.SetName('a')
+        a.AddTask(dict(description='task', complete=False, id=None))
+        self.assertEqual(([], []), (b.updated_fields, b.GetTasks()))
+        self.assertFalse(hasattr(a, '__dict__'))
+        self.assertFalse(hasattr(pytracker.Task(), '__dict__'))
+        self.assertFalse(hasattr(pytracker.Comment(), '__dict__'))
+        self.assertRaises(AttributeError, setattr, a, 'nmae', 'typo')
+
+    def testJsonRoundTrip(self):
+        story = pytracker.Story.FromXml(StoryTest.STORY_A)
+        story.AddTask(dict(description='task', complete=True, id='12'))
+        story.SetEstimate(5)
+        as_json = story.ToJson()
+        restored = pytracker.Story.FromJson(as_json)
+        self.assertEqual(story.ToDictionary(), restored.ToDictionary())
+        self.assertEqual(as_json, restored.ToJson())
+        self.assertEqual(story.ToCsv(), restored.ToCsv())
+        self.assertEqual(['estimate'], restored.updated_fields)
+        # documents written before every field was serialized still load
+        old = pytracker.Story.FromJson('{"story_id": 3, "labels": ["a"], "unknown": 1}')
+        self.assertEqual((3, 'a', None), (old.GetStoryId(), old.GetLabelsAsString(),
+                                          old.GetName()))
+
+    def testToXmlWithTasks(self):
+        story = pytracker.Story()
+        story.SetName('checklist')
+        story.AddTask(dict(description='one', complete=False, id=None))
+        story.AddTask(dict(description='a & b', complete=True, id=None))
+        self.assertEqual(b'<?xml version="1.0" encoding="utf-8"?><story><name>checklist</name></story>',
+                         story.ToXml())
+        self.assertEqual(
+                b'<?xml version="1.0" encoding="utf-8"?><story><name>checklist</name>'
+                b'<tasks type="array">'
+                b'<task><description>one</description><complete type="boolean">false</complete></task>'
+                b'<task><description>a &amp; b</description><complete type="boolean">true</complete></task>'
+                b'</tasks></story>', story.ToXml(include_tasks=True))
+
     def testAddTask(self):
         story = pytracker.Story()
         self.assertEquals([], story.tasks)
@@ -335,6 +466,98 @@ class StoryTest(unittest.TestCase):
         self.assertEquals("TEST-1280", s.GetJiraKey())
 
         
+class TrackerDatetimeTest(unittest.TestCase):
+    def testParse(self):
+        for secs in (0, 1240433216, 951782400, 4102444799, 1239926400 + 86399):
+            formatted = time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(secs))
+            self.assertEqual(secs, pytracker.TrackerDatetime.Parse(formatted + ' UTC'))
+            self.assertEqual(secs, pytracker.TrackerDatetime.Parse(formatted + ' GMT'))
+            self.assertEqual(formatted + ' UTC', pytracker.TrackerDatetime.Format(secs))
+        # other layouts go through time.strptime
+        self.assertEqual(1240433216, pytracker.TrackerDatetime.Parse(' 2009/4/22 20:46:56 UTC'))
+        for invalid in ('2009/02/30 00:00:00 UTC', '2009/04/22 24:00:00 UTC',
+                        '2009/04/22 2:46:561 UTC', 'tomorrow'):
+            self.assertRaises(ValueError, pytracker.TrackerDatetime.Parse, invalid)
+        self.assertEqual('1969/12/31 23:59:59 UTC', pytracker.TrackerDatetime.Format(-1))
+        self.assertEqual('2009-04-22', pytracker.TrackerDatetimeToYMD('2009/04/22 20:46:56 UTC'))
+
+    def testParseCsvDate(self):
+        self.assertEqual(1239926400, pytracker.TrackerDatetime.ParseCsvDate('Apr 17, 2009'))
+        self.assertEqual(1239062400, pytracker.TrackerDatetime.ParseCsvDate('Apr 7, 2009'))
+        self.assertEqual(1239062400, pytracker.TrackerDatetime.ParseCsvDate('Apr 07, 2009'))
+        self.assertRaises(ValueError, pytracker.TrackerDatetime.ParseCsvDate, 'Feb 30, 2009')
+        self.assertRaises(ValueError, pytracker.TrackerDatetime.ParseCsvDate, '2009/04/17')
+
+    def testParseColumn(self):
+        column = pytracker.TrackerDatetime.ParseColumn(
+                ['2009/04/17 00:47:50 UTC', None, '', '2009/04/17 00:47:50 UTC'])
+        self.assertEqual([1239929270.0, 1239929270.0], [column[0], column[3]])
+        self.assertTrue(math.isnan(column[1]) and math.isnan(column[2]))
+        self.assertEqual([1239926400.0], list(pytracker.TrackerDatetime.ParseColumn(
+                ['Apr 17, 2009'], csv_dates=True)))
+
+
+class StoryXmlWriterTest(unittest.TestCase):
+    def Stories(self):
+        stories = VariedStories(30)
+        for i, story in enumerate(stories):
+            story.SetName('story <%d> & co' % i)
+            story.SetDescription('caf\u00e9 \u2603 > 1' if i % 2 else '')
+            story.SetDeadline(1240433216 + i * 3607)
+            if i % 3:
+                story.SetCreatedAt(1239929270 - i)
+            story.AddTask(dict(description='task & <%d>' % i, complete=i % 2 == 0, id=None))
+            story.AddTask(dict(description='', complete=False, id='3'))
+        stories.append(pytracker.Story())
+        return stories
+
+    def testToXml(self):
+        story = pytracker.Story()
+        story.SetName('a "b" <c> & d')
+        story.SetEstimate(2)
+        story.SetDescription('caf\u00e9 \u2603 > 1')
+        story.AddLabel('x')
+        story.AddLabel('y&z')
+        story.SetDeadline(1240433216)
+        story.SetCreatedAt(1239929270)
+        story.AddTask(dict(description='task & <1>', complete=True, id=None))
+        story.AddTask(dict(description='', complete=False, id='3'))
+        fields = (b'<?xml version="1.0" encoding="utf-8"?><story>'
+                  b'<name>a &quot;b&quot; &lt;c&gt; &amp; d</name>'
+                  b'<description>caf\xc3\xa9 \xe2\x98\x83 &gt; 1</description>'
+                  b'<estimate>2</estimate><labels>x,y&amp;z</labels>'
+                  b'<deadline type="datetime">2009/04/22 20:46:56 UTC</deadline>'
+                  b'<created_at type="datetime">2009/04/17 00:47:50 UTC</created_at>')
+        self.assertEqual(fields + b'</story>', story.ToXml())
+        self.assertEqual(fields + b'<tasks type="array">'
+                         b'<task><description>task &amp; &lt;1&gt;</description>'
+                         b'<complete type="boolean">true</complete></task>'
+                         b'<task><description></description>'
+                         b'<complete type="boolean">false</complete></task>'
+                         b'</tasks></story>', story.ToXml(include_tasks=True))
+        self.assertEqual(b'<?xml version="1.0" encoding="utf-8"?><story/>', pytracker.Story().ToXml())
+        task = pytracker.Task.FromDictionary(dict(description='say "hi"', complete=True))
+        self.assertEqual(b'<?xml version="1.0" encoding="utf-8"?><task><description>say &quot;hi&quot;'
+                         b'</description><complete type="boolean">true</complete></task>', task.ToXml())
+
+    def testParsesBack(self):
+        for story in self.Stories()[:-1]:
+            parsed = minidom.parseString(story.ToXml(include_tasks=True)).documentElement
+            self.assertEqual(story.GetName(),
+                             pytracker.XmlNodeList.toText(parsed.getElementsByTagName('name')))
+            self.assertEqual([task.GetDictionary()['description'] for task in story.GetTasks()],
+                             [pytracker.XmlNodeList.toText(task.getElementsByTagName('description'))
+                              for task in parsed.getElementsByTagName('task')])
+
+    def testWriter(self):
+        stories = self.Stories()
+        for include_tasks in (False, True):
+            writer = pytracker.StoryXmlWriter(include_tasks)
+            self.assertEqual([story.ToXml(include_tasks) for story in stories],
+                             list(writer.ToXmls(iter(stories))))
+            self.assertEqual(stories[-1].ToXml(), writer.ToXml(stories[-1]))
+
+
 class TaskTest(unittest.TestCase):
     def testCanAddTask(self):
         t = pytracker.Task()
@@ -374,5 +597,1539 @@ class ExistingCommentsTest(unittest.TestCase):
         self.assertEqual(comments[1].GetText(), "comment2")
         pass  
 
+STORY_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<story>
+    <id type="integer">%d</id>
+    <story_type>feature</story_type>
+    <url>http://tracker/story/show/%d</url>
+    <estimate type="integer">2</estimate>
+    <current_state>accepted</current_state>
+    <name>story %d</name>
+    <requested_by>Gorbachev</requested_by>
+    <owned_by>Stalin</owned_by>
+    <created_at type="datetime">2009/04/17 00:47:50 GMT</created_at>
+    <updated_at type="datetime">2009/04/22 20:46:56 UTC</updated_at>
+    <labels>alpha,beta</labels>
+</story>
+"""
+
+
+def StoryFields(story):
+    """Returns the state of a Story as plain data, for equality checks."""
+    return story.ToDictionary()
+
+
+class StoryXmlDecoderTest(unittest.TestCase):
+    STORIES = [StoryTest.STORY_A, StoryTest.STORY_B, StoryTest.STORY_C,
+               StoryTest.STORY_D, StoryTest.STORY_E, StoryTest.STORY_F]
+
+    def assertSameStories(self, expected_xmls, stories):
+        self.assertEqual(len(expected_xmls), len(stories))
+        for as_xml, story in zip(expected_xmls, stories):
+            self.assertEqual(StoryFields(pytracker.Story.FromXml(as_xml)),
+                             StoryFields(story))
+
+    def testSingleStoryMatchesFromXml(self):
+        for as_xml in self.STORIES:
+            self.assertSameStories([as_xml],
+                                   pytracker.StoryXmlDecoder.Decode(as_xml.encode('utf-8')))
+
+    def testStoriesListing(self):
+        listing = '<?xml version="1.0" encoding="UTF-8"?><stories type="array" count="6">%s</stories>' % (
+                ''.join(self.STORIES))
+        self.assertSameStories(self.STORIES,
+                               pytracker.StoryXmlDecoder.Decode(listing.encode('utf-8')))
+
+    def testIncrementalFeed(self):
+        listing = ('<stories type="array">%s</stories>' % ''.join(self.STORIES)).encode('utf-8')
+        decoder = pytracker.StoryXmlDecoder()
+        stories = []
+        for i in range(len(listing)):
+            stories.extend(decoder.Feed(listing[i:i + 1]))
+        stories.extend(decoder.Feed(b'', True))
+        self.assertSameStories(self.STORIES, stories)
+
+    def testIterationsListing(self):
+        listing = """<?xml version="1.0" encoding="UTF-8"?>
+            <iterations type="array">
+                <iteration>
+                    <id type="integer">7</id>
+                    <number type="integer">3</number>
+                    <start type="datetime">2009/01/05 00:00:02 UTC</start>
+                    <finish type="datetime">2009/01/19 00:00:02 UTC</finish>
+                    <stories type="array">%s%s</stories>
+                </iteration>
+            </iterations>""" % (StoryTest.STORY_C, StoryTest.STORY_D)
+        decoder = pytracker.StoryXmlDecoder()
+        stories = decoder.Feed(listing.encode('utf-8'), True)
+        self.assertSameStories([StoryTest.STORY_C, StoryTest.STORY_D], stories)
+        self.assertEqual([dict(id=7, number=3, start=1231113602, finish=1232323202,
+                               story_ids=[1234, 129150])], decoder.iterations)
+
+    def testInvalidXmlRaises(self):
+        import xml.parsers.expat
+        self.assertRaises(xml.parsers.expat.ExpatError,
+                          pytracker.StoryXmlDecoder.Decode, b'<stories><story>')
+
+
+class TransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        for story_id in (1, 2, 3):
+            self.server.AddRoute('GET', 'stories/%d' % story_id,
+                                 (200, {}, (STORY_XML % (story_id, story_id, story_id)).encode()))
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testPoolReusesConnection(self):
+        tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        for story_id in (1, 2, 3, 1):
+            self.assertEqual(story_id, tracker.GetStory(story_id).GetStoryId())
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual('token', self.server.requests[0][2]['X-TrackerToken'])
+
+    def testOpenerTransportFallback(self):
+        tracker = pytracker.Tracker(1, 'token', self.server.base_api_url,
+                                    transport=pytracker.OpenerTransport())
+        for story_id in (1, 2):
+            self.assertEqual(story_id, tracker.GetStory(story_id).GetStoryId())
+        self.assertEqual(2, self.server.connections)
+
+    def testHttpErrorRaisesTrackerApiException(self):
+        for transport in (pytracker.HttpConnectionPool(), pytracker.OpenerTransport()):
+            tracker = pytracker.Tracker(1, 'token', self.server.base_api_url,
+                                        transport=transport)
+            self.assertRaises(pytracker.TrackerApiException, tracker.GetStory, 404)
+            # the pooled connection is still usable after an error
+            self.assertEqual(1, tracker.GetStory(1).GetStoryId())
+
+    def testIdleConnectionsAreEvicted(self):
+        pool = pytracker.HttpConnectionPool(idle_timeout=-1)
+        tracker = pytracker.Tracker(1, 'token', self.server.base_api_url, transport=pool)
+        tracker.GetStory(1)
+        tracker.GetStory(2)
+        self.assertEqual(2, self.server.connections)
+
+    def testReconnectsOnStaleSocket(self):
+        def CloseAfterResponse(handler):
+            # keep-alive as far as the client knows, but the server hangs up
+            handler.close_connection = True
+            return (200, {}, (STORY_XML % (1, 1, 1)).encode())
+        self.server.AddRoute('GET', 'stories/1', CloseAfterResponse)
+        tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        tracker.GetStory(1)
+        self.assertEqual(2, tracker.GetStory(2).GetStoryId())
+        self.assertEqual(2, self.server.connections)
+
+    def testDoesNotResendPostOnStaleSocket(self):
+        def CloseAfterResponse(handler):
+            handler.close_connection = True
+            return (200, {}, (STORY_XML % (1, 1, 1)).encode())
+        self.server.AddRoute('GET', 'stories/1', CloseAfterResponse)
+        self.server.AddRoute('POST', 'stories', (200, {}, (STORY_XML % (4, 4, 4)).encode()))
+        pool = pytracker.HttpConnectionPool()
+        url = self.server.base_api_url + 'projects/1/stories'
+        pool.Open('GET', self.server.base_api_url + 'projects/1/stories/1', {}).read()
+        self.assertRaises(pytracker._STALE_CONNECTION_ERRORS, pool.Open,
+                          'POST', url, {}, b'<story/>')
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(['GET'], [r[0] for r in self.server.requests])
+
+def StoriesXml(story_ids):
+    return ('<?xml version="1.0" encoding="UTF-8"?><stories type="array">%s</stories>' % ''.join(
+            STORY_XML.split('?>', 1)[1] % (i, i, i) for i in story_ids)).encode('utf-8')
+
+
+class IterStoriesTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testPagesThroughFilter(self):
+        self.server.AddRoute('GET', 'stories?filter=label%3Afoo&limit=2', (200, {}, StoriesXml([1, 2])))
+        self.server.AddRoute('GET', 'stories?filter=label%3Afoo&offset=2&limit=2', (200, {}, StoriesXml([3, 4])))
+        self.server.AddRoute('GET', 'stories?filter=label%3Afoo&offset=4&limit=2', (200, {}, StoriesXml([5])))
+        for prefetch in (True, False):
+            stories = self.tracker.IterStories('label:foo', page_size=2, prefetch=prefetch)
+            self.assertEqual([1, 2, 3, 4, 5], [s.GetStoryId() for s in stories])
+        self.assertEqual(6, len(self.server.requests))
+
+    def testStopsOnEmptyPage(self):
+        self.server.AddRoute('GET', 'stories?limit=2', (200, {}, StoriesXml([1, 2])))
+        self.server.AddRoute('GET', 'stories?offset=2&limit=2', (200, {}, StoriesXml([])))
+        self.assertEqual([1, 2], [s.GetStoryId() for s in self.tracker.IterStories(page_size=2)])
+
+    def testPagesThroughIterations(self):
+        def Iterations(*groups):
+            return (200, {}, ('<iterations type="array">%s</iterations>' % ''.join(
+                    '<iteration><number>%d</number><stories>%s</stories></iteration>' % (
+                            n, StoriesXml(ids).decode('utf-8').split('?>', 1)[1])
+                    for n, ids in groups)).encode('utf-8'))
+        self.server.AddRoute('GET', 'iterations/done?limit=2', Iterations((1, [1, 2]), (2, [])))
+        self.server.AddRoute('GET', 'iterations/done?offset=2&limit=2', Iterations((3, [3])))
+        stories = self.tracker.IterStories(iteration='done', page_size=2)
+        self.assertEqual([1, 2, 3], [s.GetStoryId() for s in stories])
+
+
+class GetStoriesByIdsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        for story_id in (1, 2, 3):
+            self.server.AddRoute('GET', 'stories/%d' % story_id,
+                                 (200, {}, (STORY_XML % (story_id, story_id, story_id)).encode()))
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testFetchesInInputOrderWithErrors(self):
+        ids = [3, 'https://www.pivotaltracker.com/story/show/1', 'nope', '404', 2]
+        result = self.tracker.GetStoriesByIds(ids, use_filter=False)
+        self.assertEqual(ids, [key for key, story, e in result])
+        self.assertEqual([3, 1, 2], [story.GetStoryId() for story in result.GetStories()])
+        failed = result.GetFailed()
+        self.assertEqual(['nope', '404'], [key for key, e in failed])
+        self.assertTrue(isinstance(failed[0][1], ValueError))
+        self.assertTrue(isinstance(failed[1][1], pytracker.TrackerApiException))
+        self.assertTrue(result.HasErrors())
+
+    def testFoldsIdsIntoFilterQueries(self):
+        self.server.AddRoute('GET', 'stories?filter=id%3A3%2C1%2C404+includedone%3Atrue',
+                             (200, {}, StoriesXml([1, 3])))
+        result = self.tracker.GetStoriesByIds([3, 1, 404, 3])
+        self.assertEqual([3, 1, 3], [story.GetStoryId() for story in result.GetStories()])
+        self.assertEqual([404], [key for key, e in result.GetFailed()])
+        # one filter query, and one lookup for the story the filter missed
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual([], result.batch_errors)
+        self.assertTrue(result.GetStories()[0] is result.GetStories()[2])
+
+    def testRecordsFailedFilterQueries(self):
+        self.server.AddRoute('GET', 'stories?filter=id%3A3%2C1+includedone%3Atrue',
+                             (500, {}, b'oops'))
+        result = self.tracker.GetStoriesByIds([3, 1])
+        self.assertEqual([3, 1], [story.GetStoryId() for story in result.GetStories()])
+        self.assertEqual(['id:3,1 includedone:true'], [query for query, e in result.batch_errors])
+        self.assertTrue(isinstance(result.batch_errors[0][1], pytracker.TrackerApiException))
+
+    def testFilterQueriesRespectUrlLength(self):
+        self.tracker.MAX_URL_LENGTH = 120
+        queries = self.tracker._IdFilterQueries(list(range(1000000, 1000020)))
+        self.assertTrue(len(queries) > 1)
+        for query in queries:
+            url = self.tracker.base_api_url + 'projects/1/' + self.tracker._StoriesRequest(query)
+            self.assertTrue(len(url) <= 120)
+        ids = ','.join(q.split()[0][3:] for q in queries).split(',')
+        self.assertEqual([str(i) for i in range(1000000, 1000020)], ids)
+
+
+class UpdateStoriesTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        for story_id in (1, 3):
+            self.server.AddRoute('PUT', 'stories/%d' % story_id,
+                                 (200, {}, (STORY_XML % (story_id, story_id, story_id)).encode()))
+        self.server.AddRoute('PUT', 'stories/2', (422, {}, b'invalid'))
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testReportsPartialFailures(self):
+        stories = [pytracker.Story.FromXml(STORY_XML % (i, i, i)) for i in (1, 2, 3)]
+        for story in stories:
+            story.SetCurrentState('delivered')
+        result = self.tracker.UpdateStories(stories, max_workers=3)
+        self.assertEqual([1, 2, 3], [key for key, story, e in result])
+        self.assertEqual([1, 3], [story.GetStoryId() for story in result.GetStories()])
+        failed = result.GetFailed()
+        self.assertEqual(2, failed[0][0])
+        self.assertTrue(isinstance(failed[0][1], pytracker.TrackerApiException))
+        self.assertEqual(3, len(self.server.requests))
+
+    def testChangesWithoutParsing(self):
+        changes = pytracker.Story()
+        changes.SetOwnedBy('bro')
+        result = self.tracker.UpdateStories([(1, changes), ('3', changes)], parse_response=False)
+        self.assertEqual([(1, None), ('3', None)], result.GetSucceeded())
+        self.assertFalse(result.HasErrors())
+        self.assertEqual(changes.ToXml(), self.server.requests[0][3])
+
+    def testStoryWithoutIdFails(self):
+        result = self.tracker.UpdateStories([pytracker.Story()])
+        self.assertTrue(isinstance(result.GetFailed()[0][1], ValueError))
+
+
+TASK_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<task>
+    <id type="integer">%d</id>
+    <description>%s</description>
+    <position>1</position>
+    <complete type="boolean">%s</complete>
+</task>
+"""
+
+
+class DirtyTaskTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        tasks = ''.join('<task><id type="integer">%d</id><description>task %d</description>'
+                        '<complete type="boolean">false</complete></task>' % (i, i)
+                        for i in range(1, 16))
+        self.story_xml = (STORY_XML % (1, 1, 1)).replace(
+                '</labels>', '</labels><tasks type="array">%s</tasks>' % tasks)
+        self.server.AddRoute('PUT', 'stories/1', (200, {}, self.story_xml.encode()))
+        self.server.AddRoute('PUT', 'stories/1/tasks/3',
+                             (200, {}, (TASK_XML % (3, 'task 3', 'true')).encode()))
+        self.server.AddRoute('POST', 'stories/1/tasks',
+                             (200, {}, (TASK_XML % (16, 'new task', 'false')).encode()))
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testOnlyChangedTasksAreWritten(self):
+        story = pytracker.Story.FromXml(self.story_xml)
+        self.assertFalse(any(task.IsDirty() for task in story.GetTasks()))
+        story.AddLabel('gamma')
+        updated = self.tracker.UpdateStory(story)
+        self.assertEqual([('PUT', self.server.Path('stories/1'))],
+                         [r[:2] for r in self.server.requests])
+        self.assertEqual(15, len(updated.GetTasks()))
+
+        story.GetTasks()[2].SetComplete()
+        new_task = pytracker.Task()
+        new_task.SetDescription('new task')
+        story.AddTask(new_task)
+        updated = self.tracker.UpdateStory(story)
+        self.assertEqual(sorted([('PUT', self.server.Path('stories/1')),
+                                 ('PUT', self.server.Path('stories/1/tasks/3')),
+                                 ('POST', self.server.Path('stories/1/tasks'))]),
+                         sorted(r[:2] for r in self.server.requests[1:]))
+        # built from the responses, no GET
+        self.assertEqual(16, len(updated.GetTasks()))
+        self.assertTrue(updated.GetTasks()[2].GetDictionary()['complete'])
+        self.assertEqual('new task', updated.GetTasks()[15].GetDictionary()['description'])
+        self.assertEqual('16', new_task.GetDictionary()['id'])
+        self.assertFalse(any(task.IsDirty() for task in story.GetTasks()))
+
+        self.tracker.UpdateStory(story)
+        self.assertEqual(5, len(self.server.requests))
+
+    def testDecodedAndCachedTasksAreClean(self):
+        story = pytracker.StoryXmlDecoder.Decode(self.story_xml.encode())[0]
+        self.assertFalse(any(task.IsDirty() for task in story.GetTasks()))
+        cache = pytracker.SqliteStoryCache(':memory:')
+        cache.PutStories(1, [story])
+        cached = cache.GetStory(1, 1, 60)
+        self.assertFalse(any(task.IsDirty() for task in cached.GetTasks()))
+        # but tasks restored from JSON are not known to be saved
+        restored = pytracker.Story.FromJson(story.ToJson())
+        self.assertTrue(all(task.IsDirty() for task in restored.GetTasks()))
+
+    def testTaskWriteFailureRaises(self):
+        story = pytracker.Story.FromXml(self.story_xml)
+        story.GetTasks()[0].SetDescription('renamed')
+        self.assertRaises(pytracker.TrackerApiException, self.tracker.UpdateStory, story)
+        self.assertTrue(story.GetTasks()[0].IsDirty())
+
+
+class AddNewStoryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        self.story = pytracker.Story()
+        self.story.SetName('story 8')
+        for i in (1, 2):
+            self.story.AddTask(dict(description='task %d' % i, complete=False, id=None))
+        self.server.AddRoute('POST', 'stories/8/tasks',
+                             (200, {}, (TASK_XML % (2, 'task 2', 'false')).encode()))
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testSingleRequest(self):
+        tasks = ''.join('<task><id type="integer">%d</id><description>task %d</description>'
+                        '<complete type="boolean">false</complete></task>' % (i, i)
+                        for i in (1, 2))
+        self.server.AddRoute('POST', 'stories', (200, {}, (STORY_XML % (8, 8, 8)).replace(
+                '</labels>', '</labels><tasks type="array">%s</tasks>' % tasks).encode()))
+        created = self.tracker.AddNewStory(self.story)
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(self.story.ToXml(include_tasks=True), self.server.requests[0][3])
+        self.assertEqual(['task 1', 'task 2'],
+                         [t.GetDictionary()['description'] for t in created.GetTasks()])
+
+    def testCreatesIgnoredTasks(self):
+        self.server.AddRoute('POST', 'stories', (200, {}, (STORY_XML % (8, 8, 8)).replace(
+                '</labels>', '</labels><tasks type="array"><task><id type="integer">1</id>'
+                '<description>task 1</description></task></tasks>').encode()))
+        created = self.tracker.AddNewStory(self.story)
+        self.assertEqual(['POST', 'POST'], [r[0] for r in self.server.requests])
+        self.assertEqual(['1', '2'], [t.GetDictionary()['id'] for t in created.GetTasks()])
+        self.assertEqual([None, None], [t.GetDictionary()['id'] for t in self.story.GetTasks()])
+
+
+def VariedStories(count):
+    """Returns stories with varied owners, states, types, labels and estimates."""
+    owners = ['Stalin', None, 'Lenin', '', 'None', 'Brezhnev']
+    states = ['accepted', 'accepted', 'started', 'delivered']
+    types = ['feature', 'bug', 'chore', 'release', 'feature']
+    stories = []
+    for i in range(count):
+        story = pytracker.Story()
+        story.story_id = 1000 + i
+        story.owned_by = owners[i % len(owners)]
+        story.current_state = states[i % len(states)]
+        story.story_type = types[i % len(types)]
+        story.estimate = str(i % 4) if i % 2 else i % 4
+        story.created_at = 1240000000 + i
+        if i % 7 == 0:
+            story.zendesk_id = str(i)
+        for label in ('alpha', 'beta', 'gamma')[:i % 4]:
+            story.AddLabel(label)
+        stories.append(story)
+    return stories
+
+
+class StoryTableTest(unittest.TestCase):
+    def assertSameStatistics(self, stories):
+        expected = pytracker.PivotalStatistics()
+        for story in stories:
+            expected.CalculateStatistics(story)
+        for numpy in (pytracker.numpy, None):
+            with mock.patch.object(pytracker, 'numpy', numpy):
+                table = pytracker.StoryTable.FromStories(stories)
+                stats = table.CalculateStatistics()
+                self.assertEqual(list(expected.GetRawStatistics().items()),
+                                 list(stats.GetRawStatistics().items()))
+                self.assertEqual(expected.RenderStatistics(), table.RenderStatistics())
+
+    def testReproducesPivotalStatistics(self):
+        self.assertSameStatistics(VariedStories(500))
+        self.assertSameStatistics([])
+
+    def testFromStoryListAndCsv(self):
+        stories = VariedStories(50)
+        story_list = pytracker.StoryList(stories)
+        table = pytracker.StoryTable.FromStoryList(story_list)
+        self.assertEqual(story_list.RenderStatistics(), table.RenderStatistics())
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'stories.csv')
+        with open(path, 'w') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(pytracker.StoryCsvReader.TRACKER_HEADER)
+            for story in stories:
+                row = [''] * 20
+                row[0] = story.GetStoryId()
+                row[2] = ', '.join(sorted(story.labels or ()))
+                row[6] = story.GetStoryType()
+                row[7] = story.GetEstimate()
+                row[8] = story.GetCurrentState()
+                row[15] = story.GetZendeskKey() or ''
+                row[17] = story.GetOwnedBy() or ''
+                writer.writerow(row)
+        from_csv = pytracker.StoryList()
+        from_csv.ImportFromCsvFile(path)
+        self.assertEqual(story_list.RenderStatistics(), from_csv.RenderStatistics())
+        self.assertEqual(from_csv.RenderStatistics(),
+                         pytracker.StoryTable.FromCsvFile(path).RenderStatistics())
+
+    def testGroupBy(self):
+        for numpy in (pytracker.numpy, None):
+            with mock.patch.object(pytracker, 'numpy', numpy):
+                table = pytracker.StoryTable.FromStories(VariedStories(12))
+                self.assertEqual(12, len(table))
+                self.assertEqual(list(range(1000, 1012)), list(table.Column('story_id')))
+                accepted = table.Where(current_state='accepted')
+                self.assertEqual([('Stalin', 1), (None, 1), ('None', 1), ('Brezhnev', 1),
+                                  ('Lenin', 1), ('', 1)],
+                                 list(table.GroupCount('owned_by', accepted).items()))
+                self.assertEqual({'feature': 2.0, 'bug': 1.0},
+                                 dict(table.GroupSum('story_type', 'estimate',
+                                                     table.Where(accepted, story_type=('feature', 'bug', 'chore')))))
+                self.assertEqual({'alpha': 9, 'beta': 6, 'gamma': 3}, dict(table.GroupCount('labels')))
+                self.assertEqual({'alpha': 3, 'beta': 3, 'gamma': 3}, dict(table.GroupCount(
+                        'labels', table.Where(label='beta', current_state='delivered'))))
+                self.assertEqual([1000, 1007], [i for i, z in zip(table.Column('story_id'),
+                                                                 table.Where(has_zendesk=True)) if z])
+                self.assertEqual(set(['alpha', 'beta']), table.Values('labels')[2])
+                self.assertEqual('started', table.Values('current_state')[2])
+
+    def testMissingEstimate(self):
+        stories = VariedStories(1)
+        stories[0].estimate = None
+        self.assertRaises(TypeError, pytracker.PivotalStatistics().CalculateStatistics, stories[0])
+        self.assertRaises(ValueError, pytracker.StoryTable.FromStories(stories).CalculateStatistics)
+
+
+class PivotalStatisticsTest(unittest.TestCase):
+    def Serial(self, stories):
+        stats = pytracker.PivotalStatistics()
+        for story in stories:
+            stats.CalculateStatistics(story)
+        return stats
+
+    def assertSameStatistics(self, expected, stats):
+        self.assertEqual(list(expected.GetRawStatistics().items()),
+                         list(stats.GetRawStatistics().items()))
+
+    def testMergeShards(self):
+        stories = VariedStories(300)
+        shards = [self.Serial(stories[i:i + 70]) for i in range(0, 300, 70)]
+        merged = pytracker.PivotalStatistics()
+        for shard in shards:
+            merged.Merge(pytracker.PivotalStatistics.FromJson(shard.ToJson()))
+        self.assertSameStatistics(self.Serial(stories), merged)
+        table_shard = pytracker.StoryTable.FromStories(stories[100:]).CalculateStatistics()
+        self.assertSameStatistics(self.Serial(stories),
+                                  self.Serial(stories[:100]).Merge(table_shard))
+
+    def testAddRemoveAndChanges(self):
+        stories = VariedStories(60)
+        stats = self.Serial(stories)
+        for story in stories[40:]:
+            stats.RemoveStory(story)
+        self.assertSameStatistics(self.Serial(stories[:40]), stats)
+
+        changed = copy.deepcopy(stories[0])
+        changed.current_state = 'started'
+        stats.ApplyChange(stories[0], changed)
+        created = copy.deepcopy(stories[1])
+        created.owned_by = 'Gorbachev'
+        stats.ApplyChange(None, created)
+        stats.ApplyChange(stories[4], None)
+        expected = [changed, created] + stories[1:4] + stories[5:40]
+        self.assertEqual(sorted(self.Serial(expected).GetRawStatistics().items()),
+                         sorted(stats.GetRawStatistics().items()))
+        stats.RemoveStory(created)
+        self.assertFalse('Gorbachev' in stats.GetRawStatistics())
+        self.assertRaises(ValueError, stats.RemoveStory, created)
+
+    def testStoryListKeepsStatistics(self):
+        stories = VariedStories(30)
+        story_list = pytracker.StoryList(stories[:20])
+        stats = story_list.KeepStatistics()
+        for story in stories[20:]:
+            story_list.AddStory(story)
+        story_list.RemoveStory(stories[0])
+        # owners may be in another order, which RenderStatistics sorts
+        self.assertEqual(sorted(self.Serial(stories[1:]).GetRawStatistics().items()),
+                         sorted(stats.GetRawStatistics().items()))
+        self.assertEqual(self.Serial(stories[1:]).RenderStatistics(),
+                         story_list.RenderStatistics())
+        self.assertTrue(stats is not story_list.GetStatistics())
+
+    def testStoryListStatisticsSeeDirectChanges(self):
+        stories = VariedStories(30)
+        story_list = pytracker.StoryList(list(stories))
+        story_list.KeepStatistics()
+        # same length, other stories, and a story edited in place
+        story_list.stories[0] = stories[1]
+        story_list.stories[4].owned_by = 'Gorbachev'
+        self.assertEqual(self.Serial(story_list.stories).RenderStatistics(),
+                         story_list.RenderStatistics())
+        self.assertSameStatistics(self.Serial(story_list.stories), story_list.GetStatistics())
+        self.assertSameStatistics(self.Serial(story_list.stories), story_list.KeepStatistics())
+
+
+class StoryCsvWriterTest(unittest.TestCase):
+    def testWritesRows(self):
+        story = pytracker.Story.FromXml(STORY_XML % (5, 5, 5))
+        story.SetName('say "hi", twice')
+        story.SetZendeskKey('77')
+        output = io.StringIO()
+        writer = pytracker.StoryCsvWriter(output)
+        self.assertEqual(2, writer.WriteStories(iter([story, pytracker.Story()])))
+        rows = list(csv.reader(io.StringIO(output.getvalue())))
+        self.assertEqual([list(pytracker.Story.CSV_FIELDS),
+                          ['5', 'alpha,beta', 'feature', '2', '77', 'Stalin', 'say "hi", twice'],
+                          [''] * 7], rows)
+        self.assertEqual(pytracker.Story.CsvHeader() + '\r\n', output.getvalue().split('5,')[0])
+
+    def testChosenFields(self):
+        story = pytracker.Story.FromXml(STORY_XML % (5, 5, 5))
+        story.AddTask(dict(description='one', complete=False, id=None))
+        output = io.StringIO()
+        writer = pytracker.StoryCsvWriter(output, ['name', 'tasks', 'updated_at'],
+                                          header=False, lineterminator='\n')
+        writer.WriteStory(story)
+        self.assertEqual('story 5,one,1240433216\n', output.getvalue())
+        self.assertRaises(ValueError, pytracker.StoryCsvWriter, output, ['nmae'])
+
+    def testNonAscii(self):
+        story = pytracker.Story()
+        story.story_id = 5
+        story.SetName(u'caf\u00e9 \u2603')
+        story.AddLabel(u'na\u00efve')
+        # Python 2's csv writes bytes
+        output = io.BytesIO() if sys.version_info[0] == 2 else io.StringIO()
+        writer = pytracker.StoryCsvWriter(output, ['story_id', 'name', 'labels'],
+                                          lineterminator='\n')
+        writer.WriteStory(story)
+        written = output.getvalue()
+        if isinstance(written, bytes):
+            written = written.decode('utf-8')
+        self.assertEqual(u'story_id,name,labels\n5,caf\u00e9 \u2603,na\u00efve\n', written)
+
+
+def TrackerCsvRow(story_id, description='', owner='Lenin'):
+    """Returns a row with the columns of StoryCsvReader.TRACKER_HEADER."""
+    return [str(story_id), 'story %d' % story_id, 'ui, api', '3', '', '', 'feature', '2',
+            'accepted', 'Apr 17, 2009', 'Apr %d, 2009' % (story_id % 28 + 1), '', 'Stalin',
+            description, 'http://www.pivotaltracker.com/story/show/%d' % story_id, '',
+            '', owner, 'Brezhnev']
+
+
+class StoryCsvReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def WriteCsv(self, header, rows):
+        path = os.path.join(self.directory, 'stories.csv')
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file, lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows(rows)
+        return path
+
+    def testFromCsv(self):
+        story = pytracker.Story.FromCsv(TrackerCsvRow(5, 'why'))
+        self.assertEqual((5, 'story 5', 'api,ui', '2', 'accepted', 'Lenin', 'why', None),
+                         (story.GetStoryId(), story.GetName(), story.GetLabelsAsString(),
+                          story.GetEstimate(), story.GetCurrentState(), story.GetOwnedBy(),
+                          story.GetDescription(), story.GetZendeskKey()))
+        self.assertEqual((1239926400, 1238976000, None),
+                         (story.created_at, story.updated_at, story.deadline))
+
+    def testColumnsByHeader(self):
+        header = pytracker.StoryCsvReader.TRACKER_HEADER + ['Comment', 'Task', 'Task Status']
+        order = list(range(10, len(header))) + list(reversed(range(10)))
+        rows = [TrackerCsvRow(i, 'line one\n"quoted", line two') + ['hi', 'do', 'done']
+                for i in range(1, 4)]
+        path = self.WriteCsv([header[i] for i in order], [[row[i] for i in order] for row in rows])
+        self.assertEqual([pytracker.Story.FromCsv(row).ToDictionary() for row in rows],
+                         [story.ToDictionary() for story in pytracker.IterCsvFile(path)])
+        self.assertRaises(ValueError, pytracker.StoryCsvReader, ['Story', 'Labels'])
+
+    def testParallelMatchesSerial(self):
+        rows = [TrackerCsvRow(i, 'multi\nline "%d",' % i if i % 3 else '',
+                              ['Lenin', 'Stalin', ''][i % 3])
+                for i in range(1, 200)]
+        path = self.WriteCsv(pytracker.StoryCsvReader.TRACKER_HEADER, rows)
+        serial = [story.ToDictionary() for story in pytracker.IterCsvFile(path)]
+        self.assertEqual(199, len(serial))
+        offsets = pytracker._CsvRecordOffsets(path, 1000)
+        self.assertTrue(len(offsets) > 10)
+        for chunk_size in (1, 1000, 1 << 20):
+            parallel = pytracker.IterCsvFileParallel(path, processes=2, chunk_size=chunk_size)
+            self.assertEqual(serial, [story.ToDictionary() for story in parallel])
+        story_list = pytracker.StoryList()
+        story_list.ImportFromCsvFile(path, processes=2)
+        self.assertEqual(serial, [story.ToDictionary() for story in story_list.stories])
+
+    def testEmptyFiles(self):
+        path = self.WriteCsv(pytracker.StoryCsvReader.TRACKER_HEADER, [])
+        self.assertEqual([], list(pytracker.IterCsvFileParallel(path)))
+        open(path, 'w').close()
+        self.assertEqual([], list(pytracker.IterCsvFileParallel(path)))
+        self.assertEqual([], list(pytracker.IterCsvFile(path)))
+
+
+class StorySnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'stories.snapshot')
+
+    def Stories(self):
+        stories = VariedStories(50)
+        stories[0].AddTask(dict(description='caf\u00e9\0 task', complete=True, id='7'))
+        stories[0].tasks[0].MarkClean()
+        stories[0].AddTask(dict(description='new', complete=False, id=None))
+        stories[1].SetDeadline(1240433216)
+        stories[1].SetDescription('multi\nline \u2603')
+        stories[2].labels = None
+        stories[3].estimate = '3' # as read from CSV
+        stories[4].estimate = 2.5
+        stories[5].jira_id = ['odd', 1]
+        stories[6].iteration_number = 1 << 70
+        stories.append(pytracker.Story())
+        return stories
+
+    def testRoundTrip(self):
+        stories = self.Stories()
+        pytracker.StoryList(stories).SaveSnapshot(self.path)
+        loaded = pytracker.StoryList.LoadSnapshot(self.path).stories
+        self.assertEqual([story.ToDictionary() for story in stories],
+                         [story.ToDictionary() for story in loaded])
+        self.assertEqual([story.labels for story in stories], [story.labels for story in loaded])
+        self.assertEqual(('3', 2.5, ['odd', 1], 1 << 70),
+                         (loaded[3].estimate, loaded[4].estimate, loaded[5].jira_id,
+                          loaded[6].iteration_number))
+        self.assertEqual([False, True], [task.IsDirty() for task in loaded[0].tasks])
+        # stories with the same labels don't share them
+        loaded[9].AddLabel('mine')
+        self.assertNotIn('mine', loaded[13].labels)
+        loaded[10].SetName('changed')
+        self.assertIn('name', loaded[10].updated_fields)
+        self.assertEqual(stories[14].updated_fields, loaded[14].updated_fields)
+
+    def testEmpty(self):
+        pytracker.StoryList().SaveSnapshot(self.path)
+        self.assertEqual([], pytracker.StoryList.LoadSnapshot(self.path).stories)
+
+    def testSchema(self):
+        output = io.BytesIO()
+        self.assertEqual(1, pytracker.StorySnapshot.Write([pytracker.Story()], output))
+        data = output.getvalue()
+        self.assertEqual(b'PYTRACKERSNAP\x01\x00\x01' + b'\x00' * 7, data[:23])
+        # unknown columns are ignored and missing ones read as None
+        mangled = data.replace(b'zendesk_id', b'zendesk_xx')
+        stories = pytracker.StorySnapshot.Read(io.BytesIO(mangled))
+        self.assertEqual(pytracker.Story().ToDictionary(), stories[0].ToDictionary())
+        newer = data[:13] + b'\x02' + data[14:]
+        self.assertRaises(ValueError, pytracker.StorySnapshot.Read, io.BytesIO(newer))
+        self.assertRaises(ValueError, pytracker.StorySnapshot.Read, io.BytesIO(data[:-3]))
+        self.assertRaises(ValueError, pytracker.StorySnapshot.Read, io.BytesIO(b'[]'))
+
+
+class JsonLinesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stories = VariedStories(20)
+        self.stories[0].AddTask(dict(description='one', complete=True, id='7'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def RoundTrip(self, filename):
+        path = os.path.join(self.directory, filename)
+        with pytracker.OpenJsonLinesFile(path, 'w') as output:
+            self.assertEqual(20, pytracker.StoryJsonLinesWriter(output).WriteStories(
+                    iter(self.stories)))
+        restored = list(pytracker.IterJsonLinesFile(path))
+        self.assertEqual([story.ToDictionary() for story in self.stories],
+                         [story.ToDictionary() for story in restored])
+        return path
+
+    def testRoundTrip(self):
+        path = self.RoundTrip('stories.jsonl')
+        with open(path, 'rb') as lines:
+            self.assertEqual(20, len(lines.read().splitlines()))
+
+    def testGzipRoundTrip(self):
+        path = self.RoundTrip('stories.jsonl.gz')
+        with open(path, 'rb') as compressed:
+            self.assertEqual(b'\x1f\x8b', compressed.read(2))
+        # gzip is recognized by content, whatever the name
+        os.rename(path, path[:-len('.gz')])
+        self.assertEqual(20, len(list(pytracker.IterJsonLinesFile(path[:-len('.gz')]))))
+
+    def testGzipRoundTripNonAscii(self):
+        self.stories[1].SetName(u'caf\u00e9 \u2603')
+        self.stories[1].AddLabel(u'na\u00efve')
+        self.RoundTrip('stories.ndjson.gz')
+
+    def testReadsLazily(self):
+        lines = iter(['\n'] + [story.ToJson(compact=True) + '\n' for story in self.stories])
+        stories = pytracker.IterJsonLines(lines)
+        self.assertEqual(self.stories[0].GetStoryId(), next(stories).GetStoryId())
+        self.assertEqual(19, len(list(lines)))
+
+    def testCompact(self):
+        story = pytracker.Story()
+        story.SetName('compact')
+        self.assertEqual('{"name":"compact","updated_fields":["name"]}', story.ToJson(compact=True))
+        self.assertEqual(story.ToDictionary(),
+                         pytracker.Story.FromJson(story.ToJson(compact=True)).ToDictionary())
+        self.assertEqual('{"descriptor":{"complete":false,"description":"","id":"7"}}', pytracker.Task.FromDictionary(dict(id='7')).ToJson(compact=True))
+
+    def testCompactKeepsEmptyLabels(self):
+        story = pytracker.Story()
+        story.story_id = 5
+        story.labels = set()
+        restored = pytracker.Story.FromJson(story.ToJson(compact=True))
+        self.assertEqual(set(), restored.labels)
+        self.assertEqual(story.ToXml(), restored.ToXml())
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        archive = pytracker.StoryArchive(os.path.join(directory, 'stories.archive'))
+        self.addCleanup(archive.Close)
+        archive.PutStories(1, [story])
+        self.assertEqual(set(), archive.Get(1, 5).labels)
+
+    def testToJsonLeavesStoryAlone(self):
+        story = self.stories[0]
+        labels, tasks = story.labels, story.tasks
+        story.ToJson()
+        story.ToJson(compact=True)
+        self.assertIs(labels, story.labels)
+        self.assertIs(tasks, story.tasks)
+        self.assertIsInstance(story.tasks[0], pytracker.Task)
+
+
+class SqliteStoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.cache = pytracker.SqliteStoryCache(':memory:')
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url, cache=self.cache)
+        for story_id in (1, 2, 3):
+            self.server.AddRoute('GET', 'stories/%d' % story_id,
+                                 (200, {}, (STORY_XML % (story_id, story_id, story_id)).encode()))
+            self.server.AddRoute('PUT', 'stories/%d' % story_id,
+                                 (200, {}, (STORY_XML % (story_id, story_id, story_id)).encode()))
+        self.server.AddRoute('GET', 'stories?filter=label%3Aalpha', (200, {}, StoriesXml([1, 2])))
+
+    def tearDown(self):
+        self.server.Stop()
+        self.cache.Close()
+
+    def testGetStoryServesWithinMaxAge(self):
+        story = self.tracker.GetStory(1)
+        cached = self.tracker.GetStory(1, max_age=60)
+        self.assertEqual(StoryFields(story), StoryFields(cached))
+        self.assertEqual(1, len(self.server.requests))
+        # without a staleness bound the server is always asked
+        self.tracker.GetStory(1)
+        self.assertEqual(2, len(self.server.requests))
+        self.tracker.GetStory(1, max_age=-1)
+        self.assertEqual(3, len(self.server.requests))
+
+    def testGetStoriesServesFilterResults(self):
+        stories = self.tracker.GetStories('label:alpha')
+        cached = self.tracker.GetStories('label:alpha', max_age=60)
+        self.assertEqual([StoryFields(s) for s in stories], [StoryFields(s) for s in cached])
+        self.assertEqual(1, len(self.server.requests))
+        # stories of a filter result are cached on their own too
+        self.tracker.GetStory(2, max_age=60)
+        self.assertEqual(1, len(self.server.requests))
+
+    def testWritesInvalidateFilterResults(self):
+        self.tracker.GetStories('label:alpha')
+        changes = pytracker.Story()
+        changes.SetEstimate(3)
+        self.tracker.UpdateStoryById(3, changes, parse_response=False)
+        self.tracker.GetStories('label:alpha', max_age=60)
+        self.assertEqual(3, len(self.server.requests))
+
+    def testDeleteDropsStory(self):
+        self.server.AddRoute('DELETE', 'stories/1', (200, {}, b''))
+        self.tracker.GetStory(1)
+        self.tracker.DeleteStory(1)
+        self.assertEqual(None, self.cache.GetStory(1, 1, 60))
+
+    def testOlderCopyDoesNotReplaceNewer(self):
+        story = pytracker.Story.FromXml(STORY_XML % (1, 1, 1))
+        story.SetName('newer')
+        story.SetUpdatedAt(story.GetUpdatedAt() + 10)
+        self.cache.PutStories(1, [story])
+        self.tracker.GetStory(1)
+        self.assertEqual('newer', self.cache.GetStory(1, 1, 60).GetName())
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = pytracker.SqliteStoryCache(':memory:', max_stories=2)
+        stories = [pytracker.Story.FromXml(STORY_XML % (i, i, i)) for i in (1, 2, 3)]
+        cache.PutStories(1, stories[:2])
+        cache.GetStory(1, 1, 60)
+        cache.PutStories(1, stories[2:])
+        self.assertEqual(None, cache.GetStory(1, 2, 60))
+        self.assertEqual(1, cache.GetStory(1, 1, 60).GetStoryId())
+        self.assertEqual(3, cache.GetStory(1, 3, 60).GetStoryId())
+
+    def testCompact(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = pytracker.SqliteStoryCache(os.path.join(directory, 'stories.sqlite'))
+        self.addCleanup(cache.Close)
+        cache.PutStories(1, VariedStories(500))
+        for story_id in range(1000, 1500):
+            cache.DeleteStory(1, story_id)
+        self.assertTrue(cache.Compact() > 0)
+        self.assertEqual(0, cache.Compact())
+        self.assertEqual([], cache.GetStoryIds(1))
+
+
+class SyncProjectTest(unittest.TestCase):
+    ACTIVITIES = b"""<?xml version="1.0" encoding="UTF-8"?>
+        <activities type="array">
+            <activity>
+                <id type="integer">1031</id>
+                <event_type>story_delete</event_type>
+                <stories type="array"><story><id type="integer">2</id></story></stories>
+            </activity>
+            <activity>
+                <id type="integer">1032</id>
+                <event_type>story_update</event_type>
+                <stories type="array"><story><id type="integer">1</id></story></stories>
+            </activity>
+        </activities>"""
+    ACTIVITIES_REQUEST = 'activities?occurred_since_date=2009%2F04%2F22+20%3A46%3A56+UTC'
+
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        self.store = pytracker.SqliteStoryCache(':memory:', max_stories=None)
+
+    @staticmethod
+    def Activities(activities):
+        """Returns a feed of (activity id, event type, story id)."""
+        return ('<?xml version="1.0" encoding="UTF-8"?><activities type="array">%s</activities>' %
+                ''.join('<activity><id type="integer">%d</id><event_type>%s</event_type>'
+                        '<stories type="array"><story><id type="integer">%d</id></story></stories>'
+                        '</activity>' % activity for activity in activities)).encode()
+
+    def tearDown(self):
+        self.server.Stop()
+        self.store.Close()
+
+    def testFullThenIncrementalSync(self):
+        self.store.PutStories(1, [pytracker.Story.FromXml(STORY_XML % (9, 9, 9))])
+        self.server.AddRoute('GET', 'stories?filter=includedone%3Atrue&limit=2',
+                             (200, {}, StoriesXml([1, 2])))
+        self.server.AddRoute('GET', 'stories?filter=includedone%3Atrue&offset=2&limit=2',
+                             (200, {}, StoriesXml([3])))
+        result = self.tracker.SyncProject(self.store, page_size=2)
+        self.assertTrue(result.full)
+        self.assertEqual([1, 2, 3], result.updated)
+        self.assertEqual([9], result.deleted)
+        self.assertEqual([1, 2, 3], sorted(self.store.GetStoryIds(1)))
+        self.assertEqual(1240433216, self.store.GetSyncMark(1))
+
+        self.server.requests = []
+        self.server.AddRoute('GET', 'stories?filter=modified_since%3A04%2F21%2F2009+includedone%3Atrue&limit=2',
+                             (200, {}, StoriesXml([1])))
+        self.server.AddRoute('GET', self.ACTIVITIES_REQUEST + '&limit=2', (200, {}, self.ACTIVITIES))
+        self.server.AddRoute('GET', self.ACTIVITIES_REQUEST + '&offset=2&limit=2',
+                             (200, {}, self.Activities([])))
+        result = self.tracker.SyncProject(self.store, page_size=2)
+        self.assertFalse(result.full)
+        self.assertEqual([1], result.updated)
+        self.assertEqual([2], result.deleted)
+        self.assertEqual([1, 3], sorted(self.store.GetStoryIds(1)))
+        self.assertEqual(3, len(self.server.requests))
+
+    def testReadsEveryActivityPage(self):
+        self.store.PutStories(1, [pytracker.Story.FromXml(STORY_XML % (i, i, i)) for i in (1, 2, 3)])
+        self.store.SetSyncMark(1, 1240433216)
+        self.server.AddRoute('GET', 'stories?filter=modified_since%3A04%2F21%2F2009+includedone%3Atrue&limit=2',
+                             (200, {}, StoriesXml([])))
+        self.server.AddRoute('GET', self.ACTIVITIES_REQUEST + '&limit=2', (200, {}, self.Activities(
+                [(10, 'story_delete', 1), (11, 'story_update', 2)])))
+        self.server.AddRoute('GET', self.ACTIVITIES_REQUEST + '&offset=2&limit=2',
+                             (200, {}, self.Activities([(12, 'story_delete', 3)])))
+        result = self.tracker.SyncProject(self.store, page_size=2)
+        self.assertEqual([1, 3], result.deleted)
+        self.assertEqual([2], self.store.GetStoryIds(1))
+
+    def testStopsWhenActivityOffsetIsIgnored(self):
+        page = self.Activities([(10, 'story_delete', 1), (11, 'story_update', 2)])
+        self.server.AddRoute('GET', self.ACTIVITIES_REQUEST + '&limit=2', (200, {}, page))
+        self.server.AddRoute('GET', self.ACTIVITIES_REQUEST + '&offset=2&limit=2', (200, {}, page))
+        self.assertEqual([1], self.tracker._GetDeletedStoryIds(1240433216, page_size=2))
+        self.assertEqual(2, len(self.server.requests))
+
+    def testInvalidatesCachedQueries(self):
+        self.store.PutQuery(1, 'label:alpha', [pytracker.Story.FromXml(STORY_XML % (1, 1, 1))])
+        self.server.AddRoute('GET', 'stories?filter=includedone%3Atrue&limit=100',
+                             (200, {}, StoriesXml([2])))
+        self.tracker.SyncProject(self.store)
+        self.assertEqual(None, self.store.GetQuery(1, 'label:alpha', 60))
+
+    def testFullResyncOnDemand(self):
+        self.store.SetSyncMark(1, 1240433216)
+        self.server.AddRoute('GET', 'stories?filter=includedone%3Atrue&limit=100',
+                             (200, {}, StoriesXml([1])))
+        result = self.tracker.SyncProject(self.store, full=True)
+        self.assertTrue(result.full)
+        self.assertEqual([1], result.updated)
+
+
+class StoryArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'stories.archive')
+        self.archive = pytracker.StoryArchive(self.path)
+        self.addCleanup(self.archive.Close)
+
+    def Stories(self, story_ids, name='story'):
+        stories = []
+        for story_id in story_ids:
+            story = pytracker.Story.FromXml(STORY_XML % (story_id, story_id, story_id))
+            story.SetName('%s %d' % (name, story_id))
+            story.AddTask(dict(description='task', complete=False, id='1'))
+            stories.append(story)
+        return stories
+
+    def Open(self, **kwargs):
+        archive = pytracker.StoryArchive(self.path, **kwargs)
+        self.addCleanup(archive.Close)
+        return archive
+
+    def testPutGetDelete(self):
+        self.archive.PutStories(1, self.Stories([3, 1, 2]))
+        self.archive.PutStories(2, self.Stories([1], 'other'))
+        story = self.archive.Get(1, 2)
+        self.assertEqual(StoryFields(self.Stories([2])[0]), StoryFields(story))
+        self.assertFalse(story.GetTasks()[0].IsDirty())
+        self.assertEqual('other 1', self.archive.Get(2, 1).GetName())
+        self.assertEqual(None, self.archive.Get(1, 4))
+        self.assertEqual([1, 2, 3], self.archive.GetStoryIds(1))
+
+        self.archive.PutStories(1, self.Stories([2], 'renamed'))
+        self.assertEqual('renamed 2', self.archive.Get(1, 2).GetName())
+        older = self.Stories([2], 'older')[0]
+        older.SetUpdatedAt(older.GetUpdatedAt() - 10)
+        self.archive.PutStories(1, [older])
+        self.assertEqual('renamed 2', self.archive.Get(1, 2).GetName())
+
+        self.archive.DeleteStory(1, 2)
+        self.assertEqual(None, self.archive.Get(1, 2))
+        self.assertEqual([1, 3], [story.GetStoryId() for story in self.archive.IterStories(1)])
+        self.assertEqual(None, self.archive.GetStory(1, 1, -1))
+        self.assertEqual(1, self.archive.GetStory(1, 1, 60).GetStoryId())
+
+    def testReadersSeeAppendsAndIndex(self):
+        reader = self.Open()
+        writer = self.Open(reindex_after=3)
+        self.assertFalse(os.path.exists(self.path + '.idx'))
+        writer.PutStories(1, self.Stories([1, 2]))
+        self.assertEqual('story 2', reader.Get(1, 2).GetName())
+        writer.PutStories(1, self.Stories([5, 4]))
+        self.assertTrue(os.path.exists(self.path + '.idx'))
+        self.assertEqual({}, writer._tail)
+        writer.PutStories(1, self.Stories([3]))
+        for archive in (reader, writer, self.Open()):
+            self.assertEqual([1, 2, 3, 4, 5], archive.GetStoryIds(1))
+            self.assertEqual('story 4', archive.Get(1, 4).GetName())
+        writer.SetSyncMark(1, 1240433216)
+        self.assertEqual(1240433216, reader.GetSyncMark(1))
+        self.assertEqual(None, reader.GetSyncMark(2))
+
+    def testCompact(self):
+        reader = self.Open()
+        for name in ('a', 'b', 'c'):
+            self.archive.PutStories(1, self.Stories(range(1, 21), name))
+        self.archive.DeleteStory(1, 20)
+        self.archive.SetSyncMark(1, 1240433216)
+        self.assertEqual('c 7', reader.Get(1, 7).GetName())
+        size = os.path.getsize(self.path)
+        saved = self.archive.Compact()
+        self.assertEqual(size - os.path.getsize(self.path), saved)
+        self.assertTrue(saved > size // 2)
+        for archive in (reader, self.archive, self.Open()):
+            self.assertEqual(list(range(1, 20)), archive.GetStoryIds(1))
+            self.assertEqual('c 7', archive.Get(1, 7).GetName())
+            self.assertEqual(1240433216, archive.GetSyncMark(1))
+        reader.PutStories(1, self.Stories([20], 'd'))
+        self.assertEqual('d 20', self.archive.Get(1, 20).GetName())
+
+    def testTornRecordIsDropped(self):
+        self.archive.PutStories(1, self.Stories([1]))
+        with open(self.path, 'ab') as archive_file:
+            archive_file.write(b'\x01 half a record')
+        reader = self.Open()
+        self.assertEqual([1], reader.GetStoryIds(1))
+        reader.PutStories(1, self.Stories([2]))
+        self.assertEqual([1, 2], self.Open().GetStoryIds(1))
+
+    def testConcurrentWriters(self):
+        def Write(first):
+            archive = pytracker.StoryArchive(self.path, reindex_after=7)
+            for story_id in range(first, first + 10):
+                archive.PutStories(1, self.Stories([story_id]))
+            archive.Close()
+
+        threads = [threading.Thread(target=Write, args=(first,)) for first in (1, 11, 21, 31)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(range(1, 41)), self.Open().GetStoryIds(1))
+
+    def testTrackerCache(self):
+        server = FakeTrackerServer()
+        self.addCleanup(server.Stop)
+        server.AddRoute('GET', 'stories/1', (200, {}, (STORY_XML % (1, 1, 1)).encode()))
+        tracker = pytracker.Tracker(1, 'token', server.base_api_url, cache=self.archive)
+        story = tracker.GetStory(1)
+        self.assertEqual(StoryFields(story), StoryFields(tracker.GetStory(1, max_age=60)))
+        self.assertEqual(1, len(server.requests))
+        not_an_archive = os.path.join(self.directory, 'stories.json')
+        with open(not_an_archive, 'w') as json_file:
+            json_file.write('[{"story_id": 1}, {"story_id": 2}]')
+        self.assertRaises(ValueError, pytracker.StoryArchive, not_an_archive)
+
+
+
+class StoryArchiveSyncProjectTest(SyncProjectTest):
+    def setUp(self):
+        SyncProjectTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = pytracker.StoryArchive(os.path.join(self.directory, 'stories.archive'))
+
+
+class TrackerFilterTest(unittest.TestCase):
+    def testParse(self):
+        filt = pytracker.TrackerFilter.Parse(
+                'label:week106 owner:"Party Cat" state:started,Finished id:1,2 includedone:true')
+        self.assertEqual([('labels', set(['week106'])),
+                          ('owned_by', set(['party cat'])),
+                          ('current_state', set(['started', 'finished'])),
+                          ('story_id', set([1, 2]))], filt.terms)
+        self.assertTrue(filt.include_done)
+        self.assertTrue(filt.IsLocal())
+
+    def testDefaults(self):
+        for filt in (None, '', '  '):
+            parsed = pytracker.TrackerFilter.Parse(filt)
+            self.assertEqual([], parsed.terms)
+            self.assertFalse(parsed.include_done)
+            self.assertTrue(parsed.IsLocal())
+        self.assertFalse(pytracker.TrackerFilter.Parse('includedone:false').include_done)
+
+    def testUnsupported(self):
+        filt = pytracker.TrackerFilter.Parse('label:ui login modified_since:1/2/2009 -label:x id:abc')
+        self.assertEqual(['login', 'modified_since:1/2/2009', '-label:x', 'id:abc'],
+                         filt.unsupported)
+        self.assertFalse(filt.IsLocal())
+        self.assertRaises(ValueError, filt.Matches, pytracker.Story())
+
+    def testMatches(self):
+        story = pytracker.Story()
+        story.story_id = 7
+        story.owned_by = 'Party Cat'
+        story.current_state = 'accepted'
+        story.AddLabel('Week106')
+        matches = lambda filt: pytracker.TrackerFilter.Parse(filt).Matches(story)
+        self.assertFalse(matches('label:week106'))
+        self.assertTrue(matches('label:week106 includedone:true'))
+        self.assertTrue(matches('owner:"party cat" id:6,7 includedone:true'))
+        self.assertFalse(matches('type:bug includedone:true'))
+        self.assertFalse(matches('label:week107 includedone:true'))
+
+
+class StoryIndexTest(unittest.TestCase):
+    FILTERS = [None, 'includedone:true', 'label:alpha', 'label:beta,gamma includedone:true',
+               'label:ALPHA label:gamma includedone:true', 'owner:lenin type:feature',
+               'owner:stalin,brezhnev state:accepted includedone:true',
+               'type:bug state:started,delivered', 'id:1001,1004,1005,99 includedone:true',
+               'label:nothing', 'owner:"None" includedone:true']
+
+    def setUp(self):
+        self.stories = VariedStories(60)
+        self.index = pytracker.StoryIndex(self.stories)
+
+    def testQueryMatchesFilters(self):
+        for filt in self.FILTERS:
+            parsed = pytracker.TrackerFilter.Parse(filt)
+            expected = [story for story in self.stories if parsed.Matches(story)]
+            self.assertEqual(expected, self.index.Query(filt), filt)
+        self.assertEqual([1001, 1005], self.index.QueryIds('id:1005,1001 includedone:true'))
+
+    def testAddStoryReindexes(self):
+        story = copy.deepcopy(self.index.stories[1002])
+        story.AddLabel('delta')
+        story.owned_by = 'Trotsky'
+        self.index.AddStory(story)
+        self.assertEqual(60, len(self.index))
+        self.assertEqual([story], self.index.Query('label:delta includedone:true'))
+        self.assertEqual([story], self.index.Query('owner:trotsky includedone:true'))
+        self.assertNotIn(1002, self.index.QueryIds('owner:lenin includedone:true'))
+        # a replaced story keeps its place
+        self.assertEqual([1001, 1002, 1003], self.index.QueryIds('id:1003,1002,1001 includedone:true'))
+
+    def testRemoveStory(self):
+        self.index.RemoveStory(1001)
+        self.index.RemoveStory(1)
+        self.assertEqual(59, len(self.index))
+        self.assertNotIn(1001, self.index.QueryIds('includedone:true'))
+        self.assertEqual([], self.index.Query('id:1001 includedone:true'))
+
+    def testReAddedStoryGoesLast(self):
+        story = self.index.stories[1001]
+        self.index.RemoveStory(1001)
+        self.assertNotIn(1001, self.index._order)
+        self.index.AddStory(story)
+        self.index.AddStory(VariedStories(61)[60])
+        self.assertEqual(61, len(self.index._order))
+        self.assertEqual([1002, 1001, 1060],
+                         self.index.QueryIds('id:1060,1001,1002 includedone:true'))
+
+    def testFallback(self):
+        self.assertRaises(ValueError, self.index.Query, 'label:alpha login')
+        server = FakeTrackerServer()
+        self.addCleanup(server.Stop)
+        server.AddRoute('GET', 'stories?filter=label%3Aalpha+login', (200, {}, StoriesXml([1, 2])))
+        tracker = pytracker.Tracker(1, 'token', server.base_api_url)
+        stories = self.index.Query('label:alpha login', fallback=tracker)
+        self.assertEqual([1, 2], [story.GetStoryId() for story in stories])
+        self.index.Query('label:alpha', fallback=tracker)
+        self.assertEqual(1, len(server.requests))
+
+    def testFromStore(self):
+        cache = pytracker.SqliteStoryCache(':memory:')
+        self.addCleanup(cache.Close)
+        cache.PutStories(1, self.stories)
+        cache.PutStories(2, VariedStories(3))
+        index = pytracker.StoryIndex.FromStore(cache, 1)
+        self.assertEqual(60, len(index))
+        self.assertEqual([StoryFields(story) for story in self.index.Query('label:beta')],
+                         [StoryFields(story) for story in index.Query('label:beta')])
+        story_list = pytracker.StoryList(self.stories)
+        self.assertEqual(self.index.QueryIds('type:chore'),
+                         pytracker.StoryIndex.FromStoryList(story_list).QueryIds('type:chore'))
+
+
+class MemoryCacheTest(unittest.TestCase):
+    NOTES = (b'<notes type="array"><note><id type="integer">3</id><text>hi</text>'
+             b'<author>me</author><noted_at type="datetime">2012/04/27 19:44:46 UTC</noted_at>'
+             b'</note></notes>')
+
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.cache = pytracker.MemoryCache(capacity=2, ttl=60)
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url,
+                                         memory_cache=self.cache)
+        for story_id in (1, 2, 3):
+            self.server.AddRoute('GET', 'stories/%d' % story_id,
+                                 (200, {}, (STORY_XML % (story_id, story_id, story_id)).encode()))
+            self.server.AddRoute('PUT', 'stories/%d' % story_id,
+                                 (200, {}, (STORY_XML % (story_id, story_id, story_id)).encode()))
+        self.server.AddRoute('GET', 'stories/1/notes', (200, {}, self.NOTES))
+        self.server.AddRoute('POST', 'stories/1/notes', (200, {}, b''))
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testReturnsCopies(self):
+        story = self.tracker.GetStory(1)
+        story.AddLabel('mutated')
+        cached = self.tracker.GetStory(1)
+        self.assertEqual('alpha,beta', cached.GetLabelsAsString())
+        cached.SetName('mutated')
+        self.assertEqual('story 1', self.tracker.GetStory(1).GetName())
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual((2, 1), (self.cache.hits, self.cache.misses))
+
+    def testLruAndTtl(self):
+        for story_id in (1, 2, 1, 3, 1, 2):
+            self.tracker.GetStory(story_id)
+        # 2 was evicted by 3, being the least recently used
+        self.assertEqual(4, len(self.server.requests))
+        self.cache.ttl = -1
+        self.tracker.GetStory(3)
+        self.tracker.GetStory(3)
+        self.assertEqual(6, len(self.server.requests))
+
+    def testWritesInvalidate(self):
+        self.tracker.GetStory(1)
+        self.tracker.GetStory(2)
+        self.tracker.UpdateStory(self.tracker.GetStory(1))
+        self.tracker.UpdateStoryById(2, pytracker.Story())
+        self.tracker.GetStory(1)
+        self.tracker.GetStory(2)
+        self.assertEqual(6, len(self.server.requests))
+
+    def testComments(self):
+        self.assertEqual('hi', self.tracker.GetComments(1)[0].GetText())
+        self.tracker.GetComments(1)[0].text = 'mutated'
+        self.assertEqual('hi', self.tracker.GetComments(1)[0].GetText())
+        self.assertEqual(1, len(self.server.requests))
+        self.tracker.AddComment(1, 'more')
+        self.tracker.GetComments(1)
+        self.assertEqual(3, len(self.server.requests))
+
+
+class FlakyTransport(object):
+    """Raises `error` on the first `failures` requests, then delegates."""
+
+    def __init__(self, transport, error, failures=1):
+        self.transport = transport
+        self.error = error
+        self.failures = failures
+
+    def Open(self, method, url, headers, body=None):
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        return self.transport.Open(method, url, headers, body)
+
+
+class ResettingTransport(object):
+    """Breaks the connection while the body of the first `failures` responses is read."""
+
+    class Response(object):
+        def __init__(self, res):
+            self.res = res
+
+        def read(self, size=None):
+            self.res.read(1)
+            raise socket.error('reset')
+
+        def __getattr__(self, name):
+            return getattr(self.res, name)
+
+    def __init__(self, transport, failures=1):
+        self.transport = transport
+        self.failures = failures
+
+    def Open(self, method, url, headers, body=None):
+        res = self.transport.Open(method, url, headers, body)
+        if self.failures:
+            self.failures -= 1
+            return self.Response(res)
+        return res
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.policy = pytracker.RetryPolicy(max_retries=3, backoff=0)
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url,
+                                         retry_policy=self.policy)
+        self.statuses = []
+
+        def Respond(handler):
+            if self.statuses:
+                return self.statuses.pop(0), {'Retry-After': '0'}, b'slow down'
+            return 200, {}, (STORY_XML % (1, 1, 1)).encode()
+        self.server.AddRoute('GET', 'stories/1', Respond)
+        self.server.AddRoute('PUT', 'stories/1', Respond)
+        self.server.AddRoute('POST', 'stories', Respond)
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testRetriesIdempotentMethods(self):
+        self.statuses = [429, 503, 502]
+        self.assertEqual(1, self.tracker.GetStory(1).GetStoryId())
+        self.assertEqual(4, len(self.server.requests))
+        self.statuses = [504]
+        self.tracker.UpdateStoryById(1, pytracker.Story())
+        self.assertEqual(6, len(self.server.requests))
+        # the connection was reused across retries
+        self.assertEqual(1, self.server.connections)
+
+    def testGivesUp(self):
+        self.statuses = [503] * 4
+        self.assertRaises(pytracker.TrackerApiException, self.tracker.GetStory, 1)
+        self.assertEqual(4, len(self.server.requests))
+        self.statuses = [500]
+        self.assertRaises(pytracker.TrackerApiException, self.tracker.GetStory, 1)
+
+    def testDoesNotRetryPost(self):
+        self.statuses = [503]
+        self.assertRaises(pytracker.TrackerApiException,
+                          self.tracker.AddNewStory, pytracker.Story())
+        self.assertEqual(1, len(self.server.requests))
+
+    def testRetriesConnectionReset(self):
+        self.tracker.transport = FlakyTransport(self.tracker.transport, socket.error('reset'), 2)
+        self.assertEqual(1, self.tracker.GetStory(1).GetStoryId())
+        self.tracker.transport = FlakyTransport(self.tracker.transport, socket.timeout())
+        self.assertRaises(socket.timeout, self.tracker.GetStory, 1)
+
+    def testRetriesResetWhileReadingBody(self):
+        transport = self.tracker.transport
+        self.tracker.transport = ResettingTransport(transport, 2)
+        self.assertEqual(1, self.tracker.GetStory(1).GetStoryId())
+        self.assertEqual(3, len(self.server.requests))
+        # the stories are decoded as they arrive
+        self.server.AddRoute('GET', 'stories?filter=label%3Afoo', (200, {}, StoriesXml([1, 2])))
+        self.tracker.transport = ResettingTransport(transport, 1)
+        self.assertEqual([1, 2], [s.GetStoryId() for s in self.tracker.GetStories('label:foo')])
+        self.tracker.transport = ResettingTransport(transport, 4)
+        self.assertRaises(socket.error, self.tracker.GetStory, 1)
+        self.tracker.transport = ResettingTransport(transport, 1)
+        self.assertRaises(socket.error, self.tracker.AddNewStory, pytracker.Story())
+
+    def testDelays(self):
+        policy = pytracker.RetryPolicy(backoff=1, max_backoff=5)
+        for attempt in range(6):
+            self.assertTrue(0 <= policy.GetDelay(attempt) <= min(5, 2 ** attempt))
+        self.assertEqual(7, policy.GetDelay(0, '7'))
+        later = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assertTrue(55 < policy.GetDelay(0, later) <= 60)
+        self.assertTrue(policy.GetDelay(0, 'soon') <= 1)
+        self.assertEqual(120, policy.GetDelay(0, '86400'))
+        far = email.utils.formatdate(time.time() + 365 * 86400, usegmt=True)
+        self.assertEqual(10, pytracker.RetryPolicy(max_retry_after=10).GetDelay(0, far))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def testLimitsAcrossThreads(self):
+        limiter = pytracker.RateLimiter(100, burst=5)
+        start = time.time()
+        threads = [threading.Thread(target=lambda: [limiter.Acquire() for _ in range(10)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 5 calls from the burst, the other 35 at 100 per second
+        self.assertTrue(time.time() - start >= 0.33)
+
+    def testReserve(self):
+        limiter = pytracker.RateLimiter(10, burst=2)
+        self.assertEqual([0, 0], [limiter.Reserve(), limiter.Reserve()])
+        self.assertTrue(0.09 < limiter.Reserve() <= 0.1)
+        self.assertTrue(0.19 < limiter.Reserve() <= 0.2)
+
+
+def Compress(data, wbits):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ContentEncodingTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        self.xml = StoriesXml(range(1, 501))
+        self.server.AddRoute('GET', 'stories?filter=label%3Afoo',
+                             (200, {'Content-Encoding': 'gzip'}, Compress(self.xml, 31)))
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testGzipPage(self):
+        stories = self.tracker.GetStories('label:foo')
+        self.assertEqual(list(range(1, 501)), [s.GetStoryId() for s in stories])
+        self.assertEqual('gzip, deflate', self.server.requests[0][2]['Accept-Encoding'])
+        stats = self.tracker.transfer_stats[-1]
+        self.assertEqual(('GET', 200, 'gzip', len(self.xml)),
+                         (stats.method, stats.status, stats.content_encoding,
+                          stats.decoded_bytes))
+        self.assertEqual(len(Compress(self.xml, 31)), stats.wire_bytes)
+        self.assertTrue(stats.wire_bytes * 10 < stats.decoded_bytes)
+
+    def testDeflateStory(self):
+        story_xml = (STORY_XML % (1, 1, 1)).encode()
+        for wbits in (15, -15):
+            self.server.AddRoute('GET', 'stories/1',
+                                 (200, {'Content-Encoding': 'deflate'}, Compress(story_xml, wbits)))
+            self.assertEqual('story 1', self.tracker.GetStory(1).GetName())
+        self.assertEqual((len(story_xml), 'deflate'),
+                         (self.tracker.transfer_stats[-1].decoded_bytes,
+                          self.tracker.transfer_stats[-1].content_encoding))
+
+    def testStreamsInChunks(self):
+        decoder = pytracker.ContentDecoder('gzip')
+        compressed = Compress(self.xml, 31)
+        chunks = [decoder.Decompress(compressed[i:i + 100])
+                  for i in range(0, len(compressed), 100)] + [decoder.Flush()]
+        self.assertEqual(self.xml, b''.join(chunks))
+        self.assertTrue(len([c for c in chunks if c]) > 1)
+        self.assertEqual(500, len(list(pytracker.StoryXmlDecoder.IterDecode(chunks))))
+
+    def testUnsupportedEncoding(self):
+        self.assertRaises(pytracker.TrackerApiException, pytracker.ContentDecoder, 'br')
+
+
+class ConditionalGetTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTrackerServer()
+        self.tracker = pytracker.Tracker(1, 'token', self.server.base_api_url,
+                                         conditional_gets=True)
+        self.etag = '"v1"'
+        self.server.AddRoute('GET', 'stories/1', self.Route((STORY_XML % (1, 1, 1)).encode()))
+        self.server.AddRoute('GET', 'stories?filter=label%3Afoo', self.Route(StoriesXml([1, 2])))
+
+    def Route(self, body):
+        def Respond(handler):
+            if handler.headers.get('If-None-Match') == self.etag:
+                return 304, {'ETag': self.etag}, b''
+            return 200, {'ETag': self.etag}, body
+        return Respond
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def testNotModifiedReusesResult(self):
+        story = self.tracker.GetStory(1)
+        self.assertNotIn('If-None-Match', self.server.requests[0][2])
+        story.SetName('mutated')
+        again = self.tracker.GetStory(1)
+        self.assertEqual('"v1"', self.server.requests[1][2]['If-None-Match'])
+        self.assertEqual('story 1', again.GetName())
+        self.assertEqual(StoryFields(self.tracker.GetStory(1)), StoryFields(again))
+
+        self.etag = '"v2"'
+        self.assertEqual('story 1', self.tracker.GetStory(1).GetName())
+        self.assertEqual('"v1"', self.server.requests[3][2]['If-None-Match'])
+        self.tracker.GetStory(1)
+        self.assertEqual('"v2"', self.server.requests[4][2]['If-None-Match'])
+
+    def testPagesAndListsAreConditional(self):
+        self.assertEqual([1, 2], [s.GetStoryId() for s in self.tracker.GetStories('label:foo')])
+        self.assertEqual([1, 2], [s.GetStoryId() for s in self.tracker.GetStories('label:foo')])
+        self.assertEqual('"v1"', self.server.requests[1][2]['If-None-Match'])
+
+    def testDisabledByDefault(self):
+        tracker = pytracker.Tracker(1, 'token', self.server.base_api_url)
+        self.assertEqual(None, tracker.conditional_cache)
+        tracker.GetStory(1)
+        tracker.GetStory(1)
+        self.assertNotIn('If-None-Match', self.server.requests[1][2])
+
+    def testIterStoriesKeepsNoBodies(self):
+        for offset in (0, 2, 4):
+            ids = [offset + 1, offset + 2] if offset < 4 else [5]
+            request = 'stories?filter=label%3Afoo' + ('&offset=%d' % offset if offset else '')
+            self.server.AddRoute('GET', request + '&limit=2', self.Route(StoriesXml(ids)))
+        for _ in range(2):
+            stories = self.tracker.IterStories('label:foo', page_size=2)
+            self.assertEqual([1, 2, 3, 4, 5], [story.GetStoryId() for story in stories])
+        self.assertEqual(0, len(self.tracker.conditional_cache._entries))
+        self.assertEqual(6, len(self.server.requests))
+        for method, path, headers, body in self.server.requests:
+            self.assertNotIn('If-None-Match', headers)
+
+    def testEvictedAfterValidatorsWereSent(self):
+        self.tracker.GetStory(1)
+        add_validators = self.tracker.conditional_cache.AddValidators
+
+        def AddValidatorsThenEvict(url, headers):
+            # another thread's Put pushes the entry out meanwhile
+            validated = add_validators(url, headers)
+            self.tracker.conditional_cache._entries.clear()
+            return validated
+
+        with mock.patch.object(self.tracker.conditional_cache, 'AddValidators',
+                               AddValidatorsThenEvict):
+            story = self.tracker.GetStory(1)
+        self.assertEqual('story 1', story.GetName())
+        self.assertEqual('"v1"', self.server.requests[1][2]['If-None-Match'])
+        self.assertNotIn('If-None-Match', self.server.requests[2][2])
+
+    def testNotModifiedWithoutValidators(self):
+        self.server.AddRoute('GET', 'stories/2', (304, {}, b''))
+        self.assertRaises(pytracker.TrackerApiException, self.tracker.GetStory, 2)
+        self.assertEqual(pytracker.ConditionalGetCache.MISSING,
+                         self.tracker.conditional_cache.Get('nowhere'))
+
+    def testLastModifiedAndEviction(self):
+        cache = pytracker.ConditionalGetCache(max_entries=1)
+        cache.Put('a', None, 'Wed, 22 Apr 2009 20:46:56 GMT', b'body')
+        headers = {}
+        self.assertTrue(cache.AddValidators('a', headers))
+        self.assertEqual({'If-Modified-Since': 'Wed, 22 Apr 2009 20:46:56 GMT'}, headers)
+        self.assertEqual(b'body', cache.Get('a'))
+        cache.Put('b', '"x"', None, b'other')
+        self.assertFalse(cache.AddValidators('a', {}))
+        cache.Put('b', None, None, b'unvalidated')
+        self.assertFalse(cache.AddValidators('b', {}))
+
+
 if __name__ == '__main__': 
     unittest.main() 
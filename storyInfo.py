@@ -1,12 +1,9 @@
 #!/usr/bin/env python3
 import settings
-from pytracker import Tracker
+from pytracker import Tracker, StoryArchive
 import sys
 
-def story_info(story_id):
-    tracker = Tracker(settings.project_id, settings.token)
-    story = tracker.GetStory(story_id)
-
+def story_info(story):
     extra_info = ""
     zendesk = story.GetZendeskKey()
     if zendesk != None:
@@ -28,5 +25,14 @@ if len(sys.argv) < 2:
 	print("usage: {} story_info_to_be_shown".format(sys.argv[0]))
 	sys.exit(1)
 
-for story_id in sys.argv[1:]:
-	story_info(story_id)
+# With story_archive = "stories.archive" in settings.py (kept up to date by
+# syncProject.py), archived stories are read from it instead of Tracker.
+archive_path = getattr(settings, "story_archive", None)
+archive = StoryArchive(archive_path) if archive_path else None
+tracker = Tracker(settings.project_id, settings.token, cache=archive)
+max_age = float("inf") if archive else None
+for story_id, story, error in tracker.GetStoriesByIds(sys.argv[1:], max_age=max_age):
+	if error is not None:
+		print("Story {}: {}".format(story_id, error))
+		continue
+	story_info(story)
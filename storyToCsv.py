@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import settings
-from pytracker import Tracker, Story
+from pytracker import Tracker, StoryCsvWriter
 import sys
 
 if len(sys.argv) < 2:
@@ -9,7 +9,6 @@ if len(sys.argv) < 2:
 
 tracker = Tracker(settings.project_id, settings.token)
 
-print(Story.CsvHeader())
+writer = StoryCsvWriter(sys.stdout, lineterminator="\n")
 for story_id in sys.argv[1:]:
-    story = tracker.GetStory(story_id)
-    print(story.ToCsv())
+    writer.WriteStory(tracker.GetStory(story_id))
@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 import settings
-from pytracker import Tracker
+from pytracker import Tracker, StoryArchive
 import sys
 
 if len(sys.argv) < 2:
 	print("usage: {} story_info_to_be_shown".format(sys.argv[0]))
 	sys.exit(1)
 
-tracker = Tracker(settings.project_id, settings.token)
+# With story_archive = "stories.archive" in settings.py (kept up to date by
+# syncProject.py), archived stories are read from it instead of Tracker.
+archive_path = getattr(settings, "story_archive", None)
+archive = StoryArchive(archive_path) if archive_path else None
+tracker = Tracker(settings.project_id, settings.token, cache=archive)
+max_age = float("inf") if archive else None
 
-for story_id in sys.argv[1:]:
-    story = tracker.GetStory(story_id)
+for story_id, story, error in tracker.GetStoriesByIds(sys.argv[1:], max_age=max_age):
+    if error is not None:
+        sys.stderr.write("Story {}: {}\n".format(story_id, error))
+        continue
     # print("--------------")
     # print(story.__dict__)
     # print("--------------")
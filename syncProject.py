@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+import settings
+from pytracker import Tracker, SqliteStoryCache, StoryArchive
+import sys
+
+if len(sys.argv) < 2:
+    print("usage: {} [store.sqlite|store.archive] [--full] [--compact]\nexample: {} stories.sqlite".format(sys.argv[0],sys.argv[0]))
+    sys.exit(1)
+
+if sys.argv[1].endswith(".archive"):
+    store = StoryArchive(sys.argv[1])
+else:
+    store = SqliteStoryCache(sys.argv[1], max_stories=None)
+tracker = Tracker(settings.project_id, settings.token)
+result = tracker.SyncProject(store, full="--full" in sys.argv[2:])
+if "--compact" in sys.argv[2:]:
+    print("Compacted the store by {} bytes".format(store.Compact()))
+store.Close()
+
+print("{} sync: {} stories updated, {} deleted".format(
+    "Full" if result.full else "Incremental", len(result.updated), len(result.deleted)))
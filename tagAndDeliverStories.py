@@ -4,13 +4,29 @@ from pytracker import Tracker
 import sys
 
 
-def deliver_story(story_id, tag=None):
+def deliver_stories(story_ids, tag=None):
     tracker = Tracker(settings.project_id, settings.token)
-    story = tracker.GetStory(story_id)
-    if story.GetStoryType() in ["bug", "feature"]:
-        story.SetCurrentState("delivered")
+    stories = []
+    for story_id, story, error in tracker.GetStoriesByIds(story_ids):
+        if error is not None:
+            print("Story {}: {}".format(story_id, error))
+            continue
+        if story.GetStoryType() in ["bug", "feature"]:
+            story.SetCurrentState("delivered")
+        if tag is not None:
+            story.AddLabelsFromString(tag)
+        stories.append(story)
+
+    result = tracker.UpdateStories(stories, parse_response=False)
+    for story, (story_id, updated, error) in zip(stories, result):
+        if error is not None:
+            print("Story {} not delivered: {}".format(story_id, error))
+            continue
+        report_story(story, tag)
+
+
+def report_story(story, tag=None):
     if tag is not None:
-        story.AddLabelsFromString(tag)
         extra_info = " and tagged with [{}]".format(tag)
     else:
         extra_info = ""
@@ -19,7 +35,6 @@ def deliver_story(story_id, tag=None):
     if zendesk is not None:
         extra_info += " Zendesk: " + zendesk
 
-    tracker.UpdateStory(story)
     print("Story {} - {} - {} - {} marked as delivered{}.".format(
         story.GetStoryId(),
         story.GetStoryType(),
@@ -42,6 +57,4 @@ if len(sys.argv) < 3:
     sys.exit(1)
 
 tag = sys.argv[1]
-for story_id in sys.argv[2:]:
-    deliver_story(story_id, tag)
-
+deliver_stories(sys.argv[2:], tag)